@@ -0,0 +1,41 @@
+"""
+Sends /api/open/<key> requests against an in-process DoorPI in SIMULATION
+mode and reports the time the agent spends on them, from reading a request
+until its response is finished.
+
+    python benchmarks/api_open.py --requests 200 --concurrency 20
+
+The requests are sent from concurrency clients, each one waiting for its
+response before it sends the next request. The response times as seen by
+these clients are reported as api_open.client, they include the time the
+load generator on the same IOLoop needs to send and read the requests and
+say little about the agent.
+"""
+import argparse
+
+import tornado.ioloop
+
+import common
+import suite
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--json', action='store_true', help="print machine readable results")
+    args = parser.parse_args()
+
+    app, server, port = common.start_app()
+    server_times = suite.ServerTimes(app)
+    url = "http://127.0.0.1:%d/api/open/%s" % (port, common.MASTER_KEY)
+    samples = tornado.ioloop.IOLoop.current().run_sync(
+        lambda: suite.http(url, args.requests, args.concurrency), timeout=300)
+    server.stop()
+
+    common.report("api_open", common.summarize(server_times.take()), as_json=args.json)
+    common.report("api_open.client", common.summarize(samples), as_json=args.json)
+
+
+if __name__ == "__main__":
+    main()
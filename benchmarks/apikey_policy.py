@@ -0,0 +1,141 @@
+"""
+Compares the compiled KeyPolicy validation with the former per-request
+parsing of apikeys.json entries, for every key type.
+
+    python benchmarks/apikey_policy.py --number 100000
+
+Exits non-zero if a compiled time window, including windows wrapping
+around the week or midnight, allows a moment it should not or the other
+way round.
+"""
+import argparse
+import datetime
+import json
+import sys
+import timeit
+
+from common import doorpi
+
+APIKEYS = {
+    "master": {"type": "master", "owner": "Gatekeeper"},
+    "restricted": {"type": "restricted", "owner": "Employee"},
+    "limited": {"type": "limited", "owner": "Guest", "from": "01.01.2000", "till": "31.12.2099"},
+    "once": {"type": "once", "owner": "Visitor", "from": "01.01.2000", "till": "31.12.2099"},
+    "unknown": None,
+}
+
+
+def legacy_valid_apikey(apikeys, apikey, today):
+    """
+    The validation as done before KeyPolicy, without the usedkeys.json
+    access of one-time keys.
+    """
+    if apikey in apikeys:
+
+        api_key_type = apikeys.get(apikey).get("type")
+
+        if api_key_type == "master":
+            return True
+        else:
+            if today().weekday() > 4:
+                return False
+
+            hour = today().hour
+            if hour < 7 or hour > 18:
+                return False
+
+            if api_key_type == "restricted":
+                return True
+
+            if datetime.datetime.strptime(apikeys.get(apikey).get("from"), "%d.%m.%Y").date() \
+                    <= today().date() \
+                    <= datetime.datetime.strptime(apikeys.get(apikey).get("till"), "%d.%m.%Y").date():
+                return True
+
+    return False
+
+
+def compiled_valid_apikey(policies, apikey, today):
+    """
+    The validation of Application.valid_apikey, without the usedkeys.json
+    access of one-time keys.
+    """
+    policy = policies.get(apikey)
+    return policy is not None and policy.allows(None if policy.kind == doorpi.KeyPolicy.MASTER else today())
+
+
+# window, moment as YYYY-MM-DD HH:MM (2019-04-08 is a monday), allowed
+WINDOWS = (
+    ("Mo-Fr 07:00-19:00", "2019-04-10 12:00", True),
+    ("Mo-Fr 07:00-19:00", "2019-04-13 12:00", False),
+    ("Fr-Mo 07:00-19:00", "2019-04-12 07:00", True),
+    ("Fr-Mo 07:00-19:00", "2019-04-14 12:00", True),
+    ("Fr-Mo 07:00-19:00", "2019-04-08 18:59", True),
+    ("Fr-Mo 07:00-19:00", "2019-04-08 19:00", False),
+    ("Fr-Mo 07:00-19:00", "2019-04-10 12:00", False),
+    ("Mo 22:00-06:00", "2019-04-08 21:59", False),
+    ("Mo 22:00-06:00", "2019-04-08 23:30", True),
+    ("Mo 22:00-06:00", "2019-04-09 05:59", True),
+    ("Mo 22:00-06:00", "2019-04-09 06:00", False),
+    ("Mo 22:00-06:00", "2019-04-15 01:00", False),
+    ("Su 22:00-06:00", "2019-04-08 01:00", True),
+)
+
+
+def check_windows():
+    """
+    :return: The window checks that failed
+    :rtype: list
+    """
+    failed = []
+    for spec, at, expected in WINDOWS:
+        policy = doorpi.KeyPolicy(doorpi.KeyPolicy.RESTRICTED, doorpi.KeyPolicy.compile_window(spec))
+        allowed = policy.allows(datetime.datetime.strptime(at, "%Y-%m-%d %H:%M"))
+        if allowed != expected:
+            print "apikey_policy.window %r at %s FAILED allowed=%s" % (spec, at, allowed)
+            failed.append((spec, at))
+    try:
+        doorpi.KeyPolicy.compile_window("Mo 07:00-07:00")
+        print "apikey_policy.window 'Mo 07:00-07:00' FAILED an empty range compiled"
+        failed.append(("Mo 07:00-07:00", None))
+    except ValueError:
+        pass
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--number', type=int, default=100000)
+    parser.add_argument('--at', default="2019-04-10 12:00",
+                        help="moment both validations see as now, format YYYY-MM-DD HH:MM")
+    parser.add_argument('--json', action='store_true', help="print machine readable results")
+    args = parser.parse_args()
+
+    apikeys = dict((key, entry) for key, entry in APIKEYS.items() if entry is not None)
+    policies = doorpi.KeyPolicy.compile_all(apikeys, "Mo-Fr 07:00-19:00")
+    moment = datetime.datetime.strptime(args.at, "%Y-%m-%d %H:%M")
+
+    def today():
+        return moment
+
+    for key in sorted(APIKEYS):
+        legacy = timeit.timeit(lambda: legacy_valid_apikey(apikeys, key, today), number=args.number)
+        compiled = timeit.timeit(lambda: compiled_valid_apikey(policies, key, today), number=args.number)
+        result = {
+            "name": "apikey_policy.%s" % key,
+            "legacy_us": legacy / args.number * 1e6,
+            "compiled_us": compiled / args.number * 1e6,
+            "speedup": legacy / compiled,
+        }
+        if args.json:
+            print json.dumps(result, sort_keys=True)
+        else:
+            print "%-12s legacy=%7.3fus compiled=%7.3fus speedup=%5.1fx" % (
+                key, result["legacy_us"], result["compiled_us"], result["speedup"])
+
+    if check_windows():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Measures the CPU time of a broadcast and its delivery latency for 10, 100
+and 1000 websocket clients on /door, comparing the BroadcastHub's shared
+frames with per-client compression through write_message.
+
+    python benchmarks/broadcast.py --clients 10 100 1000 --payload 512
+"""
+import argparse
+import json
+import resource
+import time
+
+import tornado.escape
+import tornado.gen
+import tornado.ioloop
+import tornado.websocket
+
+import common
+import doorpi
+
+
+class PerClientHub(doorpi.BroadcastHub):
+    """
+    Sends through write_message, compressing every message for every client.
+    """
+
+    def send(self, client, message, frames=None):
+        client.pending += 1
+        future = client.write_message(message)
+        future.add_done_callback(lambda f: self._flushed(client, f))
+
+
+@tornado.gen.coroutine
+def receive(connection):
+    message = yield connection.read_message()
+    raise tornado.gen.Return(time.time() - json.loads(message)["sent"])
+
+
+@tornado.gen.coroutine
+def run(port, clients, messages, payload):
+    url = "ws://127.0.0.1:%d/door" % port
+    connections = []
+    for _ in range(clients):
+        connection = yield tornado.websocket.websocket_connect(url, compression_options={})
+        yield connection.read_message()
+        connections.append(connection)
+
+    hub = doorpi.DoorRegistry.get().hub
+    fan_out = hub._fan_out
+    cpu = [0.0]
+
+    def timed_fan_out(message, callback=None):
+        start = time.clock()
+        fan_out(message, callback)
+        cpu[0] += time.clock() - start
+
+    hub._fan_out = timed_fan_out
+
+    latencies = []
+    try:
+        for _ in range(messages):
+            hub.publish({"action": "ring", "sent": time.time(), "padding": "DING DONG " * (payload // 10)})
+            latencies.extend((yield [receive(client) for client in connections]))
+    finally:
+        del hub._fan_out
+
+    for connection in connections:
+        connection.close()
+    yield tornado.gen.sleep(0.5)
+    raise tornado.gen.Return((cpu[0], latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--clients', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--payload', type=int, default=512, help="approximate message size in bytes")
+    parser.add_argument('--json', action='store_true', help="print machine readable results")
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 2 * max(args.clients) + 64
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+    app, server, port = common.start_app({"webui.client.pending": "%d" % (args.messages + 1),
+                                          "webui.clients.max": "0"})
+    shared = doorpi.DoorRegistry.get().hub
+    per_client = PerClientHub(max_pending=shared.max_pending)
+    per_client.start()
+
+    for mode, hub in (("shared", shared), ("per_client", per_client)):
+        for clients in args.clients:
+            doorpi.DoorRegistry.get().hub = hub
+            cpu, latencies = tornado.ioloop.IOLoop.current().run_sync(
+                lambda: run(port, clients, args.messages, args.payload), timeout=600)
+
+            summary = common.summarize(latencies)
+            summary["cpu_per_broadcast_ms"] = cpu / args.messages * 1000.0
+            name = "broadcast.%s.%d" % (mode, clients)
+            common.report(name, summary, as_json=args.json)
+            if not args.json:
+                print "%-26s cpu per broadcast=%8.2fms" % ("", summary["cpu_per_broadcast_ms"])
+
+
+if __name__ == "__main__":
+    main()
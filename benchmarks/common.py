@@ -0,0 +1,164 @@
+"""
+Shared helpers for the DoorPI benchmarks. The benchmarks run the agent
+in-process in SIMULATION mode, using gpiozero's mock pin factory when
+gpiozero is installed.
+"""
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('GPIOZERO_PIN_FACTORY', 'mock')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tornado.concurrent
+import tornado.httpserver
+import tornado.testing
+
+import doorpi
+
+logging.getLogger().setLevel(logging.ERROR)
+logging.getLogger('tornado.access').setLevel(logging.CRITICAL)
+
+MASTER_KEY = 'bench-master-key'
+
+
+def start_app(config=None, apikeys=None):
+    """
+    Starts a DoorPI application on an unused local port.
+
+    :param config: Settings overriding the defaults
+    :param apikeys: The apikeys to use, defaults to a single master key
+    :type config: dict
+    :type apikeys: dict
+    :return: The application, its HTTP server and the port it listens on
+    :rtype: tuple
+    """
+    doorpi.import_gpiozero()
+    doorpi.SIMULATION = True
+
+    workdir = tempfile.mkdtemp(prefix='doorpi-benchmark-')
+    settings = {"door.name": "Benchmark",
+                "ratelimit.rate": 0,
+                # benchmarks ring again right after a ring was delivered
+                "ring.debounce": 0,
+                "ring.burst.window": 0,
+                "history.file": os.path.join(workdir, "doorpi_history.bin"),
+                "state.file": os.path.join(workdir, "doorpi_state.json")}
+    settings.update(config or {})
+    doorpi.Application.set_config(settings)
+
+    if apikeys is None:
+        apikeys = {MASTER_KEY: {"type": "master", "owner": "Benchmark"}}
+    doorpi.Application.set_apikeys(apikeys)
+
+    app = doorpi.Application()
+    sock, port = tornado.testing.bind_unused_port()
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+    return app, server, port
+
+
+def percentile(samples, pct):
+    """
+    Nearest-rank percentile of a list of samples.
+
+    :param samples: The samples
+    :param pct: Percentile between 0 and 100
+    :type samples: list
+    :type pct: float
+    :rtype: float
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def summarize(samples):
+    """
+    Summarizes latency samples given in seconds as milliseconds.
+
+    :param samples: The samples in seconds
+    :type samples: list
+    :return: count, min, mean, p50, p95, p99 and max
+    :rtype: dict
+    """
+    count = len(samples)
+    summary = {"count": count}
+    if count == 0:
+        return summary
+    summary.update({
+        "min": min(samples) * 1000.0,
+        "mean": sum(samples) / count * 1000.0,
+        "p50": percentile(samples, 50) * 1000.0,
+        "p95": percentile(samples, 95) * 1000.0,
+        "p99": percentile(samples, 99) * 1000.0,
+        "max": max(samples) * 1000.0,
+    })
+    return summary
+
+
+def report(name, summary, as_json=False):
+    """
+    Prints a summary either human readable or as one JSON line.
+
+    :param name: The name of the measurement
+    :param summary: The summary as returned by summarize(samples)
+    :param as_json: Print JSON instead of text
+    :type name: str
+    :type summary: dict
+    :type as_json: bool
+    """
+    if as_json:
+        print json.dumps(dict(summary, name=name), sort_keys=True)
+        return
+
+    if summary.get("count", 0) == 0:
+        print "%-26s no samples" % name
+        return
+
+    print "%-26s n=%-6d min=%8.2fms p50=%8.2fms p95=%8.2fms p99=%8.2fms max=%8.2fms" % (
+        name, summary["count"], summary["min"], summary["p50"],
+        summary["p95"], summary["p99"], summary["max"])
+
+
+class PulseRecorder(object):
+    """
+    Wraps the door-open device and records when pulses start and end.
+    """
+
+    def __init__(self, device=None, record=None):
+        """
+        :param device: The wrapped device, if any
+        :param record: Called with "pulse" and "pulse_end" as pulses start and end
+        :type record: callable
+        """
+        self.device = device
+        self.record = record
+        self.pulse = None
+
+    def expect(self):
+        """
+        :return: A future resolving to the time the next pulse starts
+        :rtype: tornado.concurrent.Future
+        """
+        self.pulse = tornado.concurrent.Future()
+        return self.pulse
+
+    def on(self):
+        if self.record is not None:
+            self.record("pulse")
+        if self.pulse is not None and not self.pulse.done():
+            self.pulse.set_result(time.time())
+        if self.device is not None:
+            self.device.on()
+
+    def off(self):
+        if self.record is not None:
+            self.record("pulse_end")
+        if self.device is not None:
+            self.device.off()
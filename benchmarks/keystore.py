@@ -0,0 +1,183 @@
+"""
+Compares apikeys.json, parsed and compiled as a whole on every reload, with
+the SQLite KeyStore for a large number of visitor keys: the time to
+(re)load, to add a single key and to look up known, uncached and unknown
+keys.
+
+    python benchmarks/keystore.py --keys 10000 --number 10000
+
+Exits non-zero if a cached lookup isn't faster than an uncached one, or if
+a one-time key used before the keys were imported into the keystore, or
+used with the keystore and then exported, opens again, or if a key redeemed
+after a torn journal entry is no longer used after a restart.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import uuid
+
+import tornado.ioloop
+
+from common import doorpi
+
+WINDOW = "Mo-Fr 07:00-19:00"
+
+
+def visitor_keys(count):
+    return dict((str(uuid.uuid4()), {"type": "once", "owner": "Visitor %d" % i,
+                                     "from": "01.01.2019", "till": "31.12.2099"})
+                for i in range(count))
+
+
+def elapsed(function):
+    start = time.time()
+    function()
+    return time.time() - start
+
+
+def lookup(keystore, keys):
+    """
+    :return: A function looking up a random key of keys on the IOLoop, as the agent does
+    :rtype: callable
+    """
+    loop = tornado.ioloop.IOLoop.current()
+    return lambda: loop.run_sync(lambda: keystore.get(random.choice(keys)))
+
+
+def check_migration(workdir):
+    """
+    Uses a one-time key with apikeys.json, imports it into the keystore and
+    tries again, then the other way round.
+
+    :return: The names of the migrations that let a used key open again
+    :rtype: list
+    """
+    entry = {"type": "once", "owner": "Visitor", "from": "01.01.2019", "till": "31.12.2099",
+             "window": "Mo-Su 00:00-24:00"}
+    keystore = doorpi.KeyStore(os.path.join(workdir, "migration.db"))
+    doorpi.Application.set_ledger(doorpi.UsedKeyLedger(os.path.join(workdir, "usedkeys.json")))
+    doorpi.Application.set_config({})
+    loop = tornado.ioloop.IOLoop.current()
+
+    failed = []
+    for name, before, after in (("import", None, keystore), ("export", keystore, None)):
+        apikey = str(uuid.uuid4())
+        doorpi.Application.set_apikeys({apikey: entry})
+        keystore.add(apikey, entry)
+        doorpi.Application.set_keystore(before)
+        first = loop.run_sync(lambda: doorpi.Application.valid_apikey(apikey))
+        doorpi.Application.set_keystore(after)
+        again = loop.run_sync(lambda: doorpi.Application.valid_apikey(apikey))
+        print "%-28s first=%-5s again=%-5s %s" % ("keystore.migration.%s" % name, first, again,
+                                                  "ok" if first and not again else "FAILED")
+        if not first or again:
+            failed.append(name)
+    doorpi.Application.set_keystore(None)
+    return failed
+
+
+def check_torn_journal(workdir):
+    """
+    Redeems a one-time key after a crash tore the last journal entry and
+    checks that the key is still used after a restart.
+
+    :return: The names of the failed checks
+    :rtype: list
+    """
+    filename = os.path.join(workdir, "torn.json")
+    with open(filename + ".journal", 'w') as journal_file:
+        journal_file.write('["torn-key", "1550')
+    apikey = str(uuid.uuid4())
+    loop = tornado.ioloop.IOLoop.current()
+    redeemed = loop.run_sync(lambda: doorpi.UsedKeyLedger(filename).redeem(apikey))
+    used = apikey in doorpi.UsedKeyLedger(filename)
+    print "%-28s redeemed=%-5s used=%-5s %s" % ("keystore.torn_journal", redeemed, used,
+                                                "ok" if redeemed and used else "FAILED")
+    return [] if redeemed and used else ["torn_journal"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--number', type=int, default=10000, help="lookups per measurement")
+    parser.add_argument('--cache', type=int, default=1024, help="policies cached by the keystore")
+    parser.add_argument('--json', action='store_true', help="print machine readable results")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='doorpi-keystore-')
+    try:
+        apikeys = visitor_keys(args.keys)
+        filename = os.path.join(workdir, "apikeys.json")
+        with open(filename, 'w') as keys_file:
+            json.dump(apikeys, keys_file)
+
+        keystore = doorpi.KeyStore(os.path.join(workdir, "apikeys.db"), args.cache, WINDOW)
+        keystore.add_all(apikeys)
+        # the same database without a cache, every lookup reads and compiles the entry
+        uncached = doorpi.KeyStore(os.path.join(workdir, "apikeys.db"), 0, WINDOW)
+        policies = doorpi.KeyPolicy.compile_all(apikeys, WINDOW)
+
+        known = random.sample(list(apikeys), min(args.cache // 2, len(apikeys)))
+        unknown = [str(uuid.uuid4()) for _ in range(100)]
+        everyone = list(apikeys)
+
+        results = {
+            "reload_ms": {
+                "json": elapsed(lambda: doorpi.KeyPolicy.compile_all(doorpi.load(filename), WINDOW)) * 1e3,
+                "keystore": elapsed(lambda: keystore.reset(WINDOW)) * 1e3,
+            },
+            "add_one_ms": {
+                "json": elapsed(lambda: doorpi.KeyPolicy.compile_all(
+                    dict(doorpi.load(filename), added={"type": "master"}), WINDOW)) * 1e3,
+                "keystore": elapsed(lambda: keystore.add("added", {"type": "master"})) * 1e3,
+            },
+        }
+        loop = tornado.ioloop.IOLoop.current()
+        for apikey in known:
+            loop.run_sync(lambda: keystore.get(apikey))
+        results.update({
+            "lookup_cached_us": {
+                "json": timeit.timeit(lambda: policies.get(random.choice(known)), number=args.number),
+                "keystore": timeit.timeit(lookup(keystore, known), number=args.number),
+            },
+            "lookup_uncached_us": {
+                "json": timeit.timeit(lambda: policies.get(random.choice(everyone)), number=args.number),
+                "keystore": timeit.timeit(lookup(uncached, everyone), number=args.number),
+            },
+            "lookup_unknown_us": {
+                "json": timeit.timeit(lambda: policies.get(random.choice(unknown)), number=args.number),
+                "keystore": timeit.timeit(lookup(keystore, unknown), number=args.number),
+            },
+        })
+        for name, result in results.items():
+            if name.endswith("_us"):
+                for backend in result:
+                    result[backend] = result[backend] / args.number * 1e6
+
+        for name in sorted(results):
+            result = dict(results[name], name="keystore.%s" % name, keys=args.keys)
+            if args.json:
+                print json.dumps(result, sort_keys=True)
+            else:
+                print "%-28s json=%10.3f keystore=%10.3f" % (result["name"], result["json"], result["keystore"])
+
+        failed = check_migration(workdir)
+        failed.extend(check_torn_journal(workdir))
+        if results["lookup_cached_us"]["keystore"] >= results["lookup_uncached_us"]["keystore"]:
+            print "keystore.lookup_cached_us    FAILED not faster than an uncached lookup"
+            failed.append("lookup_cached")
+    finally:
+        shutil.rmtree(workdir)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Measures the time logging.info takes on the calling thread when records
+are written directly to a slow stream, like a pipe to journald, and when
+they go through the LogPipeline, with and without its rate limit.
+
+    python benchmarks/logging_pipeline.py --records 2000 --write-delay 0.2
+"""
+import argparse
+import json
+import logging
+import time
+
+from common import doorpi
+
+
+class SlowStream(object):
+    """
+    A stream whose writes block for a while, collecting the lines written.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lines = []
+
+    def write(self, text):
+        time.sleep(self.delay)
+        self.lines.extend(line for line in text.splitlines() if line)
+
+    def flush(self):
+        pass
+
+
+def log(records):
+    start = time.time()
+    for i in range(records):
+        logging.info("handling RING at %s (%d presses)", "default", 1,
+                     extra={"event": "ring", "door": "default", "presses": 1, "i": i})
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--write-delay', type=float, default=0.2, help="milliseconds a write blocks")
+    parser.add_argument('--json', action='store_true', help="print machine readable results")
+    args = parser.parse_args()
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    saved = root.handlers[:]
+    results = []
+
+    for mode, rate in (("direct", None), ("pipeline", 0), ("pipeline_limited", 10.0)):
+        stream = SlowStream(args.write_delay / 1000.0)
+        if rate is None:
+            handler = logging.StreamHandler(stream)
+            handler.setFormatter(doorpi.LogFormatter(json_format=True))
+            root.handlers = [handler]
+            elapsed = log(args.records)
+        else:
+            doorpi.LogPipeline.setup(stream, "json", size=args.records + 1, rate=rate)
+            elapsed = log(args.records)
+            doorpi.LogPipeline.stop(timeout=args.records * args.write_delay)
+        root.handlers = saved[:]
+
+        written = [json.loads(line) for line in stream.lines]
+        result = {"name": "logging.%s" % mode, "records": args.records, "written": len(written),
+                  "suppressed": sum(entry.get("suppressed", 0) for entry in written),
+                  "caller_us": elapsed / args.records * 1e6}
+        results.append(result)
+        if args.json:
+            print json.dumps(result, sort_keys=True)
+        else:
+            print "%-26s records=%-6d written=%-6d caller=%8.2fus per record" % (
+                result["name"], args.records, result["written"], result["caller_us"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""
+Replays traces of rings, websocket opens and api-key opens through the
+agent on a virtual clock and checks the resulting broadcasts and GPIO
+pulses, so that timeouts, time windows and guards spanning hours or days
+are checked in seconds.
+
+    python benchmarks/replay.py
+    python benchmarks/replay.py --days 30
+    python benchmarks/replay.py --trace trace.json --output outcomes.json
+    python benchmarks/replay.py --trace trace.json --expect outcomes.json
+
+The agent runs on an IOLoop whose clock jumps to the next timer whenever
+there is nothing else to do, and doorpi's time and datetime modules are
+replaced by views of that clock. Without --trace the built-in scenarios are
+checked and the command exits non-zero if one of them yields other
+outcomes than expected.
+
+A trace is a JSON list of events, or the output of /api/history:
+
+    [{"at": 0, "do": "ring"},
+     {"at": 5, "do": "open"},
+     {"at": 3600, "do": "api", "key": "..."}]
+
+"at" is in seconds after the start of the trace, "door" selects a door,
+"open" uses the secret of the last ring unless a "secret" is given and
+"api" uses --apikey unless a "key" is given.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+import common
+from common import doorpi
+
+# Wednesday, 10 April 2019 12:00 local time
+START = time.mktime((2019, 4, 10, 12, 0, 0, 0, 0, -1))
+
+APIKEYS = {
+    "master": {"type": "master", "owner": "Gatekeeper"},
+    "restricted": {"type": "restricted", "owner": "Employee"},
+    "limited": {"type": "limited", "owner": "Guest", "from": "01.04.2019", "till": "30.04.2019"},
+    "once": {"type": "once", "owner": "Visitor", "from": "01.04.2019", "till": "30.04.2019"},
+}
+
+HOUR, DAY = 3600, 86400
+
+# name, events, expected outcomes as (seconds after the start, outcome)
+SCENARIOS = (
+    ("ring_timeout",
+     [{"at": 0, "do": "ring"}],
+     [(0, "ring"), (60, "timeout")]),
+    ("ring_open",
+     [{"at": 0, "do": "ring"}, {"at": 5, "do": "open"}],
+     [(0, "ring"), (5, "open"), (5, "pulse"), (5.5, "pulse_end")]),
+    ("wrong_secret",
+     [{"at": 0, "do": "ring"}, {"at": 5, "do": "open", "secret": "WRONG"}],
+     [(0, "ring"), (60, "timeout")]),
+    ("ring_extends_session",
+     [{"at": 0, "do": "ring"}, {"at": 50, "do": "ring"}],
+     [(0, "ring"), (50, "ring"), (120, "timeout")]),
+    ("burst_coalesced",
+     [{"at": 0, "do": "ring"}, {"at": 0.1, "do": "ring"}, {"at": 0.2, "do": "ring"}],
+     [(0, "ring"), (0.5, "presses:3"), (60, "timeout")]),
+    ("ring_after_open_guard",
+     [{"at": 0, "do": "ring"}, {"at": 1, "do": "open"}, {"at": 1.2, "do": "ring"}, {"at": 3, "do": "ring"}],
+     [(0, "ring"), (1, "open"), (1, "pulse"), (1.5, "pulse_end"), (3, "ring"), (63, "timeout")]),
+    ("api_opens_coalesced",
+     [{"at": 0, "do": "api", "key": "master"}, {"at": 0.2, "do": "api", "key": "master"}],
+     [(0, "api:accepted"), (0, "pulse"), (0.2, "api:accepted"), (0.5, "pulse_end")]),
+    ("api_windows",
+     [{"at": 0, "do": "api", "key": "restricted"},
+      {"at": 8 * HOUR, "do": "api", "key": "restricted"},
+      {"at": 8 * HOUR, "do": "api", "key": "master"},
+      {"at": 3 * DAY, "do": "api", "key": "restricted"},
+      {"at": 5 * DAY, "do": "api", "key": "restricted"}],
+     [(0, "api:accepted"), (0, "pulse"), (0.5, "pulse_end"),
+      (8 * HOUR, "api:rejected"), (8 * HOUR, "api:accepted"), (8 * HOUR, "pulse"), (8 * HOUR + 0.5, "pulse_end"),
+      (3 * DAY, "api:rejected"),
+      (5 * DAY, "api:accepted"), (5 * DAY, "pulse"), (5 * DAY + 0.5, "pulse_end")]),
+    ("limited_range",
+     [{"at": 0, "do": "api", "key": "limited"}, {"at": 21 * DAY, "do": "api", "key": "limited"}],
+     [(0, "api:accepted"), (0, "pulse"), (0.5, "pulse_end"), (21 * DAY, "api:rejected")]),
+    ("once_key",
+     [{"at": 0, "do": "api", "key": "once"}, {"at": DAY, "do": "api", "key": "once"}],
+     # the open resolves once the redemption is on disk, after the pulse started
+     [(0, "pulse"), (0, "api:accepted"), (0.5, "pulse_end"), (DAY, "api:rejected")]),
+)
+
+
+class VirtualClock(object):
+    """
+    The time seen by the agent, advanced by the VirtualIOLoop only.
+    """
+
+    def __init__(self, now=START):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class VirtualPoll(object):
+    """
+    Stands in for epoll: instead of waiting for file descriptors it moves
+    the clock forward to the next timer. The agent is driven through its
+    Python interface, not its sockets.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def register(self, fd, events):
+        pass
+
+    def modify(self, fd, events):
+        pass
+
+    def unregister(self, fd):
+        pass
+
+    def close(self):
+        pass
+
+    def poll(self, timeout):
+        self.clock.advance(timeout)
+        return []
+
+
+class VirtualIOLoop(tornado.ioloop.PollIOLoop):
+
+    def initialize(self, clock, **kwargs):
+        super(VirtualIOLoop, self).initialize(impl=VirtualPoll(clock), time_func=clock.time, **kwargs)
+
+
+class VirtualTime(object):
+    """
+    Replaces doorpi's time module, reading the virtual clock.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def time(self):
+        return self.clock.now
+
+    def gmtime(self, seconds=None):
+        return time.gmtime(self.clock.now if seconds is None else seconds)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class VirtualDatetime(object):
+    """
+    Replaces doorpi's datetime module, reading the virtual clock.
+    """
+
+    def __init__(self, clock):
+        class Datetime(datetime.datetime):
+
+            @classmethod
+            def today(cls):
+                return datetime.datetime.fromtimestamp(clock.now)
+
+            @classmethod
+            def now(cls, tz=None):
+                return datetime.datetime.fromtimestamp(clock.now, tz)
+
+        self.datetime = Datetime
+
+    def __getattr__(self, name):
+        return getattr(datetime, name)
+
+
+class Replay(object):
+    """
+    Runs traces against an agent on a virtual clock and records outcomes.
+    """
+
+    def __init__(self, clock, apikey="master"):
+        self.clock = clock
+        self.apikey = apikey
+        self.start = clock.now
+        self.outcomes = []
+        self.secrets = {}
+        for door in doorpi.DoorRegistry.doors.values():
+            door.hub.publish = self._recording(door, door.hub.publish)
+            door.actuator.device = common.PulseRecorder(door.actuator.device, self.record)
+
+    def record(self, outcome):
+        self.outcomes.append((round(self.clock.now - self.start, 3), outcome))
+
+    def reset(self, start):
+        """
+        Forgets the last ring and open and sets the clock to the start of the next trace.
+        """
+        for door in doorpi.DoorRegistry.doors.values():
+            door.state = doorpi.DoorState()
+            door.ring_input.last = None
+        self.clock.now = start
+        self.start = start
+        self.outcomes = []
+        self.secrets = {}
+
+    @tornado.gen.coroutine
+    def run(self, events):
+        """
+        Feeds the events to the agent at their virtual times and keeps the
+        clock running until all ring sessions and pulses ended.
+
+        :param events: The events of the trace
+        :type events: list
+        :return: The outcomes as (seconds after the start, outcome)
+        :rtype: list
+        """
+        for event in sorted(events, key=lambda e: e["at"]):
+            yield tornado.gen.sleep(max(0.0, self.start + event["at"] - self.clock.now))
+            yield self.dispatch(event)
+
+        doors = doorpi.DoorRegistry.doors.values()
+        yield tornado.gen.sleep(1)
+        while any(door.session is not None or door.actuator._pulsing for door in doors):
+            yield tornado.gen.sleep(1)
+        raise tornado.gen.Return(self.outcomes)
+
+    @tornado.gen.coroutine
+    def dispatch(self, event):
+        door = doorpi.DoorRegistry.get(event.get("door"))
+        action = event["do"]
+        if action == "ring":
+            if door.ring is not None:
+                door.ring.pin.drive_low()
+                door.ring.pin.drive_high()
+            else:
+                door.ring_pressed()
+        elif action == "open":
+            # as sent by the web interface over the websocket
+            door.handle_open(event.get("secret", self.secrets.get(door.id)))
+        elif action == "api":
+            opened = yield door.request_api_open(event.get("key", self.apikey))
+            self.record("api:%s" % ("accepted" if opened else "rejected"))
+        else:
+            raise ValueError("unknown event %r" % action)
+
+    def _recording(self, door, publish):
+        def recording_publish(message, callback=None):
+            payload = json.loads(message)
+            outcome = payload["action"]
+            if outcome == "ring":
+                self.secrets[door.id] = payload["secret"]
+            elif outcome == "presses":
+                outcome = "presses:%d" % payload["presses"]
+            if door.id != doorpi.DoorRegistry.DEFAULT:
+                outcome = "%s:%s" % (door.id, outcome)
+            self.record(outcome)
+            publish(message, callback)
+        return recording_publish
+
+
+def from_history(history):
+    """
+    Turns the output of /api/history into a trace starting at its first event.
+
+    :return: The start time and the events
+    :rtype: tuple
+    """
+    actions = {"ring": "ring", "open": "open", "api_open": "api"}
+    recorded = sorted((float(e["timestamp"]), e) for e in history["events"] if e["action"] in actions)
+    if not recorded:
+        return START, []
+    start = recorded[0][0]
+    events = []
+    for timestamp, event in recorded:
+        replayed = {"at": timestamp - start, "do": actions[event["action"]]}
+        if event.get("detail"):
+            replayed["door"] = event["detail"]
+        events.append(replayed)
+    return start, events
+
+
+def synthetic_days(days, seed=0):
+    """
+    A trace of days of activity: rings every 20 minutes on average, most of
+    them answered after a few seconds, api-key opens every 30 minutes.
+    """
+    generator = random.Random(seed)
+    events = []
+    at = 0.0
+    while at < days * DAY:
+        at += generator.expovariate(1.0 / 1200)
+        events.append({"at": at, "do": "ring"})
+        if generator.random() < 0.7:
+            events.append({"at": at + generator.uniform(2, 30), "do": "open"})
+    at = 0.0
+    while at < days * DAY:
+        at += generator.expovariate(1.0 / 1800)
+        events.append({"at": at, "do": "api", "key": generator.choice(sorted(APIKEYS))})
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--trace', help="replay this trace instead of the built-in scenarios")
+    parser.add_argument('--expect', help="fail unless the trace yields the outcomes of this file")
+    parser.add_argument('--output', help="write the outcomes of the trace to this file")
+    parser.add_argument('--apikey', default="master", help="api-key of api events without a key")
+    parser.add_argument('--days', type=int, default=0, help="measure the throughput of days of synthetic activity")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="print machine readable results")
+    args = parser.parse_args()
+
+    clock = VirtualClock()
+    doorpi.time = VirtualTime(clock)
+    doorpi.datetime = VirtualDatetime(clock)
+    loop = VirtualIOLoop(clock=clock)
+    # disk writes finish before the clock moves on, not whenever a thread gets to them
+    loop.set_default_executor(tornado.concurrent.dummy_executor)
+    loop.make_current()
+
+    # the timing of real rings, not the one of the latency benchmarks
+    settings = dict((key, "%s" % default) for key, default, _ in doorpi.Settings.SCHEMA
+                    if key.startswith("ring."))
+    # a lag monitor firing every half virtual second or a heartbeat would dominate long traces
+    settings["metrics.lag.interval"] = "%s" % HOUR
+    settings["webui.ping.interval"] = "0"
+    app, server, port = common.start_app(settings, apikeys=APIKEYS)
+    doorpi.Application.set_ledger(doorpi.UsedKeyLedger(os.path.join(
+        os.path.dirname(doorpi.Application.config('history.file')), 'usedkeys.json')))
+    replay = Replay(clock, args.apikey)
+
+    failed = []
+    if args.trace:
+        trace = doorpi.load(args.trace)
+        start, events = from_history(trace) if isinstance(trace, dict) else (START, trace)
+        replay.reset(start)
+        outcomes = loop.run_sync(lambda: replay.run(events))
+        for at, outcome in outcomes:
+            print "%12.3f %s" % (at, outcome)
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump(outcomes, output_file)
+        if args.expect and [tuple(o) for o in doorpi.load(args.expect)] != outcomes:
+            failed.append(args.trace)
+    elif args.days:
+        events = synthetic_days(args.days, args.seed)
+        replay.reset(START)
+        started = time.time()
+        outcomes = loop.run_sync(lambda: replay.run(events))
+        wall = time.time() - started
+        result = {"name": "replay.days.%d" % args.days, "events": len(events), "outcomes": len(outcomes),
+                  "virtual_s": clock.now - START, "wall_s": wall,
+                  "events_per_s": len(events) / wall, "speedup": (clock.now - START) / wall}
+        if args.json:
+            print json.dumps(result, sort_keys=True)
+        else:
+            print "%(name)-20s events=%(events)d outcomes=%(outcomes)d virtual=%(virtual_s).0fs " \
+                  "wall=%(wall_s).2fs events/s=%(events_per_s).0f speedup=%(speedup).0fx" % result
+    else:
+        for name, events, expected in SCENARIOS:
+            replay.reset(START)
+            outcomes = loop.run_sync(lambda: replay.run(events))
+            ok = outcomes == [(float(at), outcome) for at, outcome in expected]
+            print "%-26s events=%-3d outcomes=%-3d %s" % (name, len(events), len(outcomes),
+                                                         "ok" if ok else "FAILED %r" % outcomes)
+            if not ok:
+                failed.append(name)
+
+    server.stop()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Drives a ring button on gpiozero's mock pin factory with bouncing,
+repeated and held presses and checks the rings the RingInput makes of
+them and that each ring is handed on at the press starting its burst, then
+compares the cost of a burst of presses with and without it.
+
+    python benchmarks/ring_input.py --presses 1000
+
+Presses are timestamped on a virtual clock, so the rings found do not
+depend on the speed of the machine. Exits non-zero if a scenario yields
+other rings than expected.
+"""
+import argparse
+import sys
+import time
+
+import tornado.gen
+import tornado.ioloop
+
+import common
+from common import doorpi
+
+DEBOUNCE, WINDOW, LIMIT = 0.05, 0.3, 2.0
+
+# name, press times in seconds, expected rings as (press time it was handed on at, presses of its burst)
+SCENARIOS = (
+    ("single", [0.0], [(0.0, 1)]),
+    ("bouncing", [0.0, 0.002, 0.005, 0.011, 0.04], [(0.0, 1)]),
+    ("double", [0.0, 0.2], [(0.0, 2)]),
+    ("double_bouncing", [0.0, 0.003, 0.2, 0.201, 0.204], [(0.0, 2)]),
+    ("two_rings", [0.0, 1.0], [(0.0, 1), (1.0, 1)]),
+    ("slow_repeat", [0.0, 0.5, 1.0], [(0.0, 1), (0.5, 1), (1.0, 1)]),
+    ("held", [i * 0.15 for i in range(40)], [(0.0, 14), (2.1, 14), (4.2, 12)]),
+)
+
+
+class VirtualClock(object):
+    """
+    Hands out the press times of a scenario, far enough in the future that
+    no burst timer fires while the scenario runs.
+    """
+
+    def __init__(self):
+        self.base = time.time() + 3600
+        self.now = self.base
+
+    def at(self, offset):
+        self.now = self.base + offset
+
+
+def button():
+    """
+    A gpiozero Button on a mock pin, or None without gpiozero.
+    """
+    try:
+        from gpiozero import Button
+        from gpiozero.pins.mock import MockFactory
+    except ImportError:
+        return None
+    return Button(4, pin_factory=MockFactory())
+
+
+@tornado.gen.coroutine
+def replay(ring_button, ring_input, clock, times):
+    """
+    Presses the button at the given virtual times and collects the rings.
+
+    :return: The press time every ring was handed on at and the number of presses of its burst
+    :rtype: list
+    """
+    rings = []
+
+    def on_presses(first, presses):
+        rings[-1] = (rings[-1][0], presses)
+
+    ring_input.on_ring = lambda first: rings.append((round(clock.now - clock.base, 3), 1))
+    ring_input.on_presses = on_presses
+    for offset in times:
+        clock.at(offset)
+        if ring_button is not None:
+            ring_button.pin.drive_low()
+            ring_button.pin.drive_high()
+        else:
+            ring_input.press(clock.now)
+        yield tornado.gen.moment
+    ring_input.flush()
+    raise tornado.gen.Return(rings)
+
+
+@tornado.gen.coroutine
+def check(ring_button):
+    clock = VirtualClock()
+    ring_input = doorpi.RingInput(None, None, debounce=DEBOUNCE, window=WINDOW, limit=LIMIT)
+    if ring_button is not None:
+        ring_button.when_pressed = lambda: ring_input.press(clock.now)
+
+    failed = []
+    for name, times, expected in SCENARIOS:
+        ring_input.last = None
+        rings = yield replay(ring_button, ring_input, clock, times)
+        print "%-26s presses=%-3d rings=%-3d %s" % (name, len(times), len(rings),
+                                                    "ok" if rings == expected else "FAILED %r" % rings)
+        if rings != expected:
+            failed.append(name)
+    raise tornado.gen.Return(failed)
+
+
+@tornado.gen.coroutine
+def cost(door, presses, window):
+    """
+    Presses the ring of the door every 10ms and measures the CPU time until
+    all rings were handled.
+
+    :return: CPU seconds and the number of rings handled
+    :rtype: tuple
+    """
+    door.ring_input.debounce = 0
+    door.ring_input.window = window
+    door.ring_input.limit = presses
+    door.ring_input.last = None
+    door.state.last_open = None
+    before = doorpi.Metrics.rings.value
+
+    start = time.clock()
+    now = time.time()
+    for i in range(presses):
+        door.ring_input.press(now + i * 0.01)
+    yield tornado.gen.moment
+    door.ring_input.flush()
+    yield tornado.gen.moment
+    raise tornado.gen.Return((time.clock() - start, doorpi.Metrics.rings.value - before))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--presses', type=int, default=1000, help="presses of the burst to measure")
+    args = parser.parse_args()
+
+    app, server, port = common.start_app({"door.open.timeout": "600"})
+    loop = tornado.ioloop.IOLoop.current()
+
+    failed = loop.run_sync(lambda: check(button()))
+
+    door = doorpi.DoorRegistry.get()
+    for mode, window in (("uncoalesced", 0), ("coalesced", WINDOW)):
+        cpu, rings = loop.run_sync(lambda: cost(door, args.presses, window))
+        print "ring_input.%-15s presses=%-6d rings=%-6d cpu=%8.2fms" % (mode, args.presses, rings, cpu * 1000.0)
+
+    server.stop()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
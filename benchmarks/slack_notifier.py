@@ -0,0 +1,231 @@
+"""
+Measures SlackNotifier throughput and failure behaviour against a local
+HTTP stand-in for the Slack webhook.
+
+    python benchmarks/slack_notifier.py --messages 500 --failure-rate 0.2
+
+Exits non-zero if the IOLoop was blocked for more than --max-lag seconds
+while the messages were delivered, if a message was dropped or delivered
+other than once while the queue had room, if a burst of rings was not
+merged into one message, or if retries, backoff and drops of a full queue
+differ from what the settings ask for.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+import tornado.gen
+import tornado.httpserver
+import tornado.ioloop
+import tornado.testing
+import tornado.web
+
+import common
+import doorpi
+
+
+class WebhookStandIn(tornado.web.RequestHandler):
+    """
+    Accepts webhook posts, answering a share of them with an error status after a delay.
+    """
+    received = 0
+    failure_rate = 0.0
+    failure_status = 500
+    latency = 0.0
+
+    def check_xsrf_cookie(self):
+        pass
+
+    @tornado.gen.coroutine
+    def post(self):
+        WebhookStandIn.received += 1
+        if WebhookStandIn.latency:
+            yield tornado.gen.sleep(WebhookStandIn.latency)
+        if random.random() < WebhookStandIn.failure_rate:
+            self.set_status(WebhookStandIn.failure_status)
+        self.write("ok")
+
+
+class LagProbe(object):
+    """
+    Measures how late a timer firing every interval seconds runs, the
+    longest time the IOLoop was blocked.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.io_loop = tornado.ioloop.IOLoop.current()
+        self.max_lag = 0.0
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._schedule()
+
+    def stop(self):
+        self._running = False
+
+    def _schedule(self):
+        expected = self.io_loop.time() + self.interval
+        self.io_loop.call_at(expected, self._fire, expected)
+
+    def _fire(self, expected):
+        self.max_lag = max(self.max_lag, self.io_loop.time() - expected)
+        if self._running:
+            self._schedule()
+
+
+@tornado.gen.coroutine
+def run(notifier, messages, rings):
+    probe = LagProbe()
+    probe.start()
+    start = time.time()
+    for index in range(messages):
+        notifier.notify("benchmark message %d" % index)
+    for _ in range(rings):
+        notifier.notify("@here DING DONG ... RING RING ... KNOCK KNOCK", "http://localhost/slack/XX", ring=True)
+    yield tornado.gen.moment
+    yield notifier.join()
+    probe.stop()
+    raise tornado.gen.Return((time.time() - start, probe.max_lag))
+
+
+@tornado.gen.coroutine
+def deliver(messages, failure_rate, failure_status=500, queue_size=100, retries=3, backoff=0.01):
+    """
+    Delivers messages through a notifier of its own with the webhook
+    failing a share of the posts.
+
+    :return: The notifier, the number of posts the webhook received and the seconds taken
+    :rtype: tuple
+    """
+    WebhookStandIn.failure_rate = failure_rate
+    WebhookStandIn.failure_status = failure_status
+    WebhookStandIn.latency = 0.0
+    WebhookStandIn.received = 0
+
+    notifier = doorpi.SlackNotifier(queue_size=queue_size, retries=retries, backoff=backoff, ring_window=0)
+    notifier.start()
+    start = time.time()
+    for index in range(messages):
+        notifier.notify("check message %d" % index)
+    yield tornado.gen.moment
+    yield notifier.join()
+    raise tornado.gen.Return((notifier, WebhookStandIn.received, time.time() - start))
+
+
+@tornado.gen.coroutine
+def check_failures():
+    """
+    Checks that a failing post is retried with doubling backoff, that a
+    rejected one is not retried and that a full queue drops the messages it
+    has no room for.
+
+    :return: The names of the failed checks
+    :rtype: list
+    """
+    failed = []
+    retries, backoff = 3, 0.05
+
+    notifier, posts, elapsed = yield deliver(1, 1.0, 500, retries=retries, backoff=backoff)
+    # backoff, 2 * backoff, 4 * backoff, ...
+    waited = backoff * (2 ** retries - 1)
+    ok = notifier.failed == 1 and posts == retries + 1 and elapsed >= waited
+    print "%-26s posts=%-4d failed=%-4d elapsed=%.3fs %s" % ("slack.retry_backoff", posts, notifier.failed,
+                                                             elapsed, "ok" if ok else "FAILED")
+    if not ok:
+        failed.append("retry_backoff")
+
+    notifier, posts, elapsed = yield deliver(1, 1.0, 400, retries=retries, backoff=backoff)
+    ok = notifier.failed == 1 and posts == 1
+    print "%-26s posts=%-4d failed=%-4d %s" % ("slack.no_retry_rejected", posts, notifier.failed,
+                                               "ok" if ok else "FAILED")
+    if not ok:
+        failed.append("no_retry_rejected")
+
+    queue_size, messages = 5, 20
+    notifier, posts, elapsed = yield deliver(messages, 0.0, queue_size=queue_size)
+    # the worker takes the first message off the queue right away
+    expected = messages - queue_size - 1
+    ok = notifier.dropped == expected and notifier.sent == messages - expected
+    print "%-26s sent=%-4d dropped=%-4d %s" % ("slack.queue_full", notifier.sent, notifier.dropped,
+                                               "ok" if ok else "FAILED expected %d dropped" % expected)
+    if not ok:
+        failed.append("queue_full")
+
+    raise tornado.gen.Return(failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--rings', type=int, default=50, help="rings fired as one burst")
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0, help="webhook response delay in seconds")
+    parser.add_argument('--max-lag', type=float, default=0.1, help="seconds the IOLoop may be blocked")
+    parser.add_argument('--json', action='store_true', help="print machine readable results")
+    args = parser.parse_args()
+
+    WebhookStandIn.failure_rate = args.failure_rate
+    WebhookStandIn.latency = args.latency
+    stand_in = tornado.web.Application([(r"/hook", WebhookStandIn)])
+    sock, port = tornado.testing.bind_unused_port()
+    hook_server = tornado.httpserver.HTTPServer(stand_in)
+    hook_server.add_sockets([sock])
+
+    url = "http://127.0.0.1:%d/hook" % port
+    common.start_app({"slack.webhook": url,
+                      "slack.baseurl": url,
+                      "slack.queue.size": "%d" % (args.messages + args.rings + 1),
+                      "slack.ring.window": "0",
+                      "slack.backoff": "0.01",
+                      "slack.retries": "3"})
+    notifier = doorpi.SlackHandler.notifier
+    loop = tornado.ioloop.IOLoop.current()
+
+    elapsed, max_lag = loop.run_sync(lambda: run(notifier, args.messages, args.rings), timeout=600)
+
+    result = {
+        "name": "slack_notifier",
+        "elapsed": elapsed,
+        "throughput": (notifier.sent + notifier.failed) / elapsed,
+        "sent": notifier.sent,
+        "failed": notifier.failed,
+        "merged": notifier.merged,
+        "dropped": notifier.dropped,
+        "posts": WebhookStandIn.received,
+        "max_lag": max_lag,
+    }
+    if args.json:
+        print json.dumps(result, sort_keys=True)
+    else:
+        for key in sorted(result):
+            print "%-12s %s" % (key, result[key])
+
+    failed = []
+    # a burst of rings is merged into a single message
+    expected = args.messages + (1 if args.rings else 0)
+    if notifier.dropped or notifier.sent + notifier.failed != expected:
+        print "slack.delivery             FAILED %d messages expected, %d sent, %d failed, %d dropped" % (
+            expected, notifier.sent, notifier.failed, notifier.dropped)
+        failed.append("delivery")
+    if args.rings and notifier.merged != args.rings - 1:
+        print "slack.ring_burst           FAILED %d of %d rings merged" % (notifier.merged, args.rings)
+        failed.append("ring_burst")
+    if args.failure_rate > 0 and WebhookStandIn.received <= notifier.sent + notifier.failed:
+        print "slack.retries              FAILED failed posts were not retried"
+        failed.append("retries")
+    if max_lag > args.max_lag:
+        print "slack.ioloop_lag           FAILED IOLoop blocked for %.3fs" % max_lag
+        failed.append("ioloop_lag")
+
+    failed.extend(loop.run_sync(check_failures, timeout=60))
+    hook_server.stop()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
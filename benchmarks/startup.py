@@ -0,0 +1,124 @@
+"""
+Measures the cold start of the agent: the time to import doorpi and the
+time from starting `python doorpi.py` until the web interface answers its
+first request, with the agent binding webui.port itself and with the
+socket passed by socket activation as systemd does.
+
+    python benchmarks/startup.py --runs 5
+
+The client connects as soon as the agent process is started, like a
+browser reloading the door page during boot, and retries refused
+connections every 10ms.
+"""
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import tornado.testing
+
+DOORPI = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'doorpi.py')
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def import_time():
+    """
+    :return: Seconds a fresh interpreter takes to import doorpi
+    :rtype: float
+    """
+    code = ("import sys, time; start = time.time(); sys.path.insert(0, %r); import doorpi; "
+            "sys.stdout.write('%%f' %% (time.time() - start))" % os.path.dirname(DOORPI))
+    with open(os.devnull, 'w') as devnull:
+        return float(subprocess.check_output([sys.executable, "-c", code], stderr=devnull))
+
+
+def first_response(workdir, activated):
+    """
+    Starts the agent and requests / until it answers.
+
+    :param workdir: The directory the agent runs in
+    :param activated: Passes the listening socket to the agent as systemd does
+    :type workdir: str
+    :type activated: bool
+    :return: Seconds until the first response and the connections refused before
+    :rtype: tuple
+    """
+    sock, port = tornado.testing.bind_unused_port()
+    sock.setblocking(1)
+    with open(os.path.join(workdir, "doorpi.json"), 'w') as config_file:
+        json.dump({"door.name": "Startup", "webui.port": port}, config_file)
+
+    def pass_socket():
+        os.dup2(sock.fileno(), 3)
+        fcntl.fcntl(3, fcntl.F_SETFD, 0)
+        os.environ["LISTEN_FDS"] = "1"
+        os.environ["LISTEN_PID"] = "%d" % os.getpid()
+
+    if not activated:
+        sock.close()
+
+    refused = 0
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        agent = subprocess.Popen([sys.executable, DOORPI], cwd=workdir, stdout=devnull, stderr=devnull,
+                                 preexec_fn=pass_socket if activated else None)
+        try:
+            while True:
+                try:
+                    client = socket.create_connection(("127.0.0.1", port))
+                    break
+                except socket.error:
+                    refused += 1
+                    if agent.poll() is not None:
+                        raise RuntimeError("agent exited with %s" % agent.returncode)
+                    time.sleep(0.01)
+            client.sendall("GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n")
+            status = client.recv(64).split(" ", 2)[1]
+            elapsed = time.time() - start
+            client.close()
+        finally:
+            agent.terminate()
+            agent.wait()
+            if activated:
+                sock.close()
+    if status != "200":
+        raise RuntimeError("first response was %s" % status)
+    return elapsed, refused
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help="print machine readable results")
+    args = parser.parse_args()
+
+    results = [{"name": "startup.import", "ms": median([import_time() for _ in range(args.runs)]) * 1e3}]
+    for mode, activated in (("bound", False), ("activated", True)):
+        workdir = tempfile.mkdtemp(prefix='doorpi-startup-')
+        try:
+            runs = [first_response(workdir, activated) for _ in range(args.runs)]
+        finally:
+            shutil.rmtree(workdir)
+        results.append({"name": "startup.first_response.%s" % mode, "ms": median([run[0] for run in runs]) * 1e3,
+                        "refused": median([run[1] for run in runs])})
+
+    for result in results:
+        if args.json:
+            print json.dumps(result, sort_keys=True)
+        else:
+            print "%-34s %8.1fms%s" % (result["name"], result["ms"],
+                                        "  refused=%d" % result["refused"] if "refused" in result else "")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+Runs the agent in SIMULATION mode with websocket clients on /door, drives
+rings and opens, hammers /api/open/, /slack/ and /api/status and reports
+p50/p95/p99 of ring-to-client delivery, also with the default debounce and
+burst window, open-to-GPIO-pulse and HTTP response times, both as seen by
+the clients and as spent in the server.
+
+    python benchmarks/suite.py --clients 50 --output results.json
+    python benchmarks/suite.py --baseline results.json --tolerance 0.25
+
+p95 values are compared with the baseline relative to a calibration
+workload timed on the same host, so a baseline taken on a faster or slower
+host still applies. Only measurements of at least MIN_SAMPLES samples are
+compared, the others are reported only.
+
+Rings are driven through gpiozero's mock pin factory when gpiozero is
+installed and through the simulate_ring action otherwise.
+"""
+import argparse
+import datetime
+import json
+import sys
+import time
+
+import tornado.escape
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.queues
+import tornado.websocket
+
+import common
+import doorpi
+
+MIN_SAMPLES = 100
+
+
+class Client(object):
+    """
+    A /door websocket client recording the arrival time of every message.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.messages = tornado.queues.Queue()
+        tornado.ioloop.IOLoop.current().spawn_callback(self._read)
+
+    @classmethod
+    @tornado.gen.coroutine
+    def connect(cls, port):
+        connection = yield tornado.websocket.websocket_connect("ws://127.0.0.1:%d/door" % port,
+                                                               compression_options={})
+        raise tornado.gen.Return(cls(connection))
+
+    @tornado.gen.coroutine
+    def _read(self):
+        while True:
+            message = yield self.connection.read_message()
+            if message is None:
+                return
+            self.messages.put((time.time(), json.loads(message)))
+
+    @tornado.gen.coroutine
+    def expect(self, action, timeout=10):
+        """
+        Waits for the next message with the given action.
+
+        :return: The arrival time and the message
+        :rtype: tuple
+        """
+        while True:
+            arrived, message = yield self.messages.get(timeout=datetime.timedelta(seconds=timeout))
+            if message.get("action") == action:
+                raise tornado.gen.Return((arrived, message))
+
+    def drain(self):
+        """
+        Discards all messages received so far.
+        """
+        while self.messages.qsize():
+            self.messages.get_nowait()
+
+    def send(self, message):
+        self.connection.write_message(json.dumps(message))
+
+    def close(self):
+        self.connection.close()
+
+
+def press_ring(driver):
+    """
+    Rings the bell through the mock ring pin or, without gpiozero, the
+    simulate_ring action.
+    """
+    ring = doorpi.DoorRegistry.get().ring
+    if ring is not None:
+        ring.pin.drive_low()
+        ring.pin.drive_high()
+    else:
+        driver.send({"action": "simulate_ring"})
+
+
+@tornado.gen.coroutine
+def ring_delivery(driver, clients, rings, pause=0):
+    samples = []
+    for _ in range(rings):
+        yield tornado.gen.sleep(pause)
+        start = time.time()
+        press_ring(driver)
+        arrivals = yield [client.expect("ring") for client in clients]
+        samples.extend(arrived - start for arrived, _ in arrivals)
+    raise tornado.gen.Return(samples)
+
+
+@tornado.gen.coroutine
+def open_to_pulse(driver, clients, recorder, opens, pulse):
+    samples = []
+    for _ in range(opens):
+        # a ring within a second after an open is ignored
+        yield tornado.gen.sleep(1.0 + pulse)
+        driver.drain()
+        press_ring(driver)
+        _, ring = yield driver.expect("ring")
+        yield [client.expect("ring") for client in clients]
+
+        pulsed = recorder.expect()
+        start = time.time()
+        driver.send({"action": "open", "secret": ring["secret"]})
+        samples.append((yield pulsed) - start)
+        yield [client.expect("open") for client in clients]
+    raise tornado.gen.Return(samples)
+
+
+class ServerTimes(object):
+    """
+    Records the time the application spends on every request it finishes, from
+    reading the request headers to finishing the response. Unlike the times the
+    HTTP client sees, these don't depend on how fast the load generator is.
+    """
+
+    def __init__(self, app):
+        self.samples = []
+        app.settings["log_function"] = self.record
+
+    def record(self, handler):
+        self.samples.append(handler.request.request_time())
+
+    def take(self):
+        samples, self.samples = self.samples, []
+        return samples
+
+
+@tornado.gen.coroutine
+def http(url, requests, concurrency, headers=None):
+    """
+    Sends requests from concurrency clients, each one waiting for its response
+    before it sends the next request, so no request waits in the client.
+    """
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    samples = []
+
+    @tornado.gen.coroutine
+    def worker(count):
+        for _ in range(count):
+            start = time.time()
+            yield client.fetch(url, headers=headers, raise_error=False)
+            samples.append(time.time() - start)
+
+    yield [worker(requests // concurrency + (1 if index < requests % concurrency else 0))
+           for index in range(concurrency)]
+    client.close()
+    raise tornado.gen.Return(samples)
+
+
+@tornado.gen.coroutine
+def run(port, args, pulse, server_times):
+    driver = yield Client.connect(port)
+    clients = []
+    for _ in range(args.clients):
+        clients.append((yield Client.connect(port)))
+
+    recorder = common.PulseRecorder(doorpi.DoorRegistry.get().actuator.device)
+    doorpi.DoorRegistry.get().actuator.device = recorder
+
+    results = {}
+    results["ring_to_client"] = yield ring_delivery(driver, clients, args.rings)
+
+    # the same with the debounce and burst window of real rings, rings a burst window apart
+    ring_input = doorpi.DoorRegistry.get().ring_input
+    latency_settings = (ring_input.debounce, ring_input.window, ring_input.limit)
+    defaults = dict((key, default) for key, default, _ in doorpi.Settings.SCHEMA)
+    ring_input.debounce = defaults["ring.debounce"]
+    ring_input.window = defaults["ring.burst.window"]
+    ring_input.limit = defaults["ring.burst.limit"]
+    results["ring_to_client_default"] = yield ring_delivery(driver, clients, args.rings // 5,
+                                                            pause=ring_input.window + ring_input.debounce)
+    ring_input.debounce, ring_input.window, ring_input.limit = latency_settings
+    results["open_to_pulse"] = yield open_to_pulse(driver, clients, recorder, args.opens, pulse)
+
+    @tornado.gen.coroutine
+    def measure(name, path, headers=None):
+        server_times.take()
+        results["http_%s" % name] = yield http("http://127.0.0.1:%d%s" % (port, path),
+                                               args.requests, args.concurrency, headers)
+        results["server_%s" % name] = server_times.take()
+
+    yield measure("api_open", "/api/open/%s" % common.MASTER_KEY)
+    yield measure("api_reject", "/api/open/invalid")
+    yield measure("slack", "/slack/expired")
+    yield measure("index", "/")
+    yield measure("status", "/api/status")
+    yield measure("status_unchanged", "/api/status", {"If-None-Match": doorpi.DoorRegistry.get().state.etag()})
+
+    for client in [driver] + clients:
+        client.close()
+    raise tornado.gen.Return(results)
+
+
+def calibrate(rounds=5, number=2000):
+    """
+    Times a fixed piece of work like the agent's, encoding and decoding a door
+    message, and returns the fastest of several rounds as a measure of the
+    speed of the host.
+
+    :return: The time of a round in milliseconds
+    :rtype: float
+    """
+    message = {"action": "ring", "secret": "AB1550962295", "timestamp": "1550962295.92", "seq": 1}
+    best = None
+    for _ in range(rounds):
+        start = time.time()
+        for _ in range(number):
+            tornado.escape.json_decode(tornado.escape.json_encode(message))
+        elapsed = (time.time() - start) * 1000.0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def regressions(summaries, calibration, baseline, tolerance):
+    """
+    Compares p95 values with a baseline, scaled by the calibration of this
+    host against the one of the baseline. The http_* times include the time
+    the load generator needs to send and read a request on the same IOLoop
+    and are reported only, the server_* times of the same requests are
+    compared instead. Measurements of fewer than MIN_SAMPLES samples are
+    too noisy for their p95 and are reported only, too.
+
+    :param summaries: The summaries by measurement
+    :param calibration: The calibration of this host as returned by calibrate()
+    :param baseline: The results file to compare with
+    :param tolerance: Allowed regression, 0.25 = 25%
+    :return: Descriptions of the measurements exceeding the baseline by more than tolerance
+    :rtype: list
+    """
+    if not baseline.get("calibration_ms"):
+        return ["baseline has no calibration_ms, refresh it with --output"]
+
+    scale = calibration / baseline["calibration_ms"]
+    found = []
+    for name, summary in sorted(summaries.items()):
+        if name.startswith("http_") or summary.get("count", 0) < MIN_SAMPLES:
+            continue
+        before = baseline.get(name, {})
+        if before.get("count", 0) < MIN_SAMPLES or not before.get("p95"):
+            continue
+        allowed = before["p95"] * scale
+        if summary["p95"] > allowed * (1 + tolerance):
+            found.append("%s p95 %.2fms > %.2fms baseline on this host" % (name, summary["p95"], allowed))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--clients', type=int, default=50, help="websocket clients on /door")
+    parser.add_argument('--rings', type=int, default=50)
+    parser.add_argument('--opens', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=200, help="requests per HTTP endpoint")
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--json', action='store_true', help="print machine readable results")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', help="fail if p95 values regressed against this results file")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed p95 regression, 0.25 = 25%%")
+    args = parser.parse_args()
+
+    pulse = 0.05
+    app, server, port = common.start_app({"door.open.pulse": "%s" % pulse,
+                                          "door.open.timeout": "600",
+                                          "webui.client.pending": "1000"})
+    server_times = ServerTimes(app)
+    # before and after, the faster one is less disturbed by other load on the host
+    calibration = calibrate()
+    results = tornado.ioloop.IOLoop.current().run_sync(lambda: run(port, args, pulse, server_times),
+                                                       timeout=3600)
+    server.stop()
+    calibration = min(calibration, calibrate())
+
+    summaries = dict((name, common.summarize(samples)) for name, samples in results.items())
+    for name in sorted(summaries):
+        common.report(name, summaries[name], as_json=args.json)
+    if args.json:
+        print json.dumps({"name": "calibration", "ms": calibration}, sort_keys=True)
+    else:
+        print "%-26s %8.2fms" % ("calibration", calibration)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(dict(summaries, calibration_ms=calibration), output_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        found = regressions(summaries, calibration, doorpi.load(args.baseline), args.tolerance)
+        for regression in found:
+            print >> sys.stderr, "REGRESSION: %s" % regression
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
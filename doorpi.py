@@ -1,538 +1,3767 @@
+import bisect
 import calendar
+import collections
 import datetime
+import hashlib
 import json
 import logging
+import mimetypes
+import mmap
 import os.path
+import Queue
 import random
+import re
 import signal
+import socket
 import string
 import sys
+import struct
 import threading
 import time
-import urllib2
+import traceback
+import zlib
 
+import tornado.concurrent
 import tornado.escape
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
 import tornado.ioloop
+import tornado.iostream
 import tornado.log
+import tornado.netutil
 import tornado.options
+import tornado.process
+import tornado.queues
+import tornado.tcpserver
 import tornado.template
 import tornado.web
 import tornado.websocket
-import validators
 
 SIMULATION = False
+WORKER = False
 
-try:
-    from gpiozero import Button, DigitalOutputDevice
-except ImportError:
-    logging.basicConfig(level=logging.DEBUG)
-    logging.warn("RUNNING IN SIMULATION MODE")
-    SIMULATION = True
+# first file descriptor passed by systemd socket activation, see sd_listen_fds(3)
+LISTEN_FDS_START = 3
+SO_DOMAIN = getattr(socket, "SO_DOMAIN", 39)
 
 
 class Application(tornado.web.Application):
     """
     The main Application
     """
+    TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), "templates")
     _config = None
-    _apikeys = None
-    _slack = None
+    _policies = {}
+    _keystore = None
+    _ledger = None
+    limiter = None
 
     def __init__(self):
         """
         Init method
         """
         handlers = [(r"/", MainHandler),
-                    (r"/api/open/(.*)", ApiHandler),
+                    (r"/doors/(?P<door_id>[\w-]+)", MainHandler),
+                    (r"/api/open/(?P<apikey>.*)", ApiHandler),
+                    (r"/api/doors/(?P<door_id>[\w-]+)/open/(?P<apikey>.*)", ApiHandler),
+                    (r"/api/history", HistoryHandler),
+                    (r"/api/status", StatusHandler),
+                    (r"/api/doors/(?P<door_id>[\w-]+)/status", StatusHandler),
+                    (r"/api/events", EventStreamHandler),
+                    (r"/api/doors/(?P<door_id>[\w-]+)/events", EventStreamHandler),
                     (r"/door", DoorSocketHandler),
-                    (r"/slack/(.*)", SlackHandler)]
-
-        if SIMULATION:
-            handlers.append((r"/simulation", SimulationHandler))
+                    (r"/door/(?P<door_id>[\w-]+)", DoorSocketHandler),
+                    (r"/slack/(?P<secret>.*)", SlackHandler),
+                    (r"/doors/(?P<door_id>[\w-]+)/slack/(?P<secret>.*)", SlackHandler),
+                    (r"/metrics", MetricsHandler)]
 
         settings = dict(
             cookie_secret=Application.config('webui.cookie.secret'),
-            template_path=os.path.join(os.path.dirname(__file__), "templates"),
+            template_path=Application.TEMPLATE_PATH,
             static_path=os.path.join(os.path.dirname(__file__), "static"),
+            static_handler_class=AssetHandler,
             xsrf_cookies=True,
         )
+        StaticAssets.build(settings["static_path"])
+        settings["template_loader"], SlackHandler.loader = Prewarm.join()
+
+        if SIMULATION:
+            handlers.append((r"/simulation", SimulationHandler))
+            handlers.append((r"/doors/(?P<door_id>[\w-]+)/simulation", SimulationHandler))
+
         Application.setup_hw_interface()
+        SlackHandler.setup_notifier()
+        Application.setup_limiter()
+        Metrics.setup(DoorRegistry.io_loop, Application.config('metrics.lag.interval'))
+        EventLog.setup(Application.config('history.file'), Application.config('history.size'), readonly=WORKER)
+        if not WORKER:
+            StatePersister.setup(DoorRegistry.io_loop, Application.config('state.file'),
+                                 Application.config('state.flush.window'))
         super(Application, self).__init__(handlers, **settings)
 
+    @classmethod
+    def compile_templates(cls):
+        """
+        Compiles all templates before the first request.
+
+        :return: The loader of the web pages and the one of the Slack messages
+        :rtype: tuple
+        """
+        loader = tornado.template.Loader(Application.TEMPLATE_PATH)
+        for template_file in ("index.html", "simulation.html", "slack.html"):
+            loader.load(template_file)
+
+        slack_loader = tornado.template.Loader(Application.TEMPLATE_PATH, autoescape=None)
+        slack_loader.load("slack.json")
+        return loader, slack_loader
+
     @classmethod
     def setup_hw_interface(cls):
         """
-        Sets up the hardware interface with the before set config [set_config(config)].
+        Sets up the doors and their hardware interface with the before set config [set_config(config)].
         """
-        try:
-            if DoorSocketHandler.door is None:
-                DoorSocketHandler.door = DigitalOutputDevice(int(Application.config('gpio.open')))
+        DoorRegistry.setup(tornado.ioloop.IOLoop.current())
 
-            if DoorSocketHandler.ring is None:
-                DoorSocketHandler.ring = Button(int(Application.config('gpio.ring')), hold_time=0.25)
-                DoorSocketHandler.ring.when_pressed = DoorSocketHandler.handle_ring
-        except NameError:
-            pass
+    @classmethod
+    def setup_limiter(cls):
+        """
+        Sets up the rate limiter with the before set config [set_config(config)],
+        the current one is kept with its buckets unless the ratelimit.* settings changed.
+        """
+        limits = (Application.config('ratelimit.rate'), Application.config('ratelimit.burst'),
+                  Application.config('ratelimit.size'), Application.config('ratelimit.prefix'))
+        limiter = Application.limiter
+        if limiter is None or (limiter.rate, limiter.burst, limiter.size, limiter.prefix) != limits:
+            Application.limiter = RateLimiter(*limits)
 
     @classmethod
     def set_config(cls, config):
         """
-        Sets the apikeys to be used by examined when checking if a api key
-        is valid [valid_apikey(apikey=None)].
+        Builds a new Settings snapshot from the configuration and swaps it in.
+        An invalid configuration is rejected and the current snapshot kept.
 
         :param config: dictionary with the application configuration.
         :type config: dict
+        :return: True if the configuration was applied, False otherwise
+        :rtype: bool
         """
-        Application._config = Application.__config__(config)
+        if os.path.isfile('local_settings.json'):
+            config = dict(config, **load('local_settings.json'))
+
+        try:
+            snapshot = Settings(config)
+        except ValueError, e:
+            if Application._config is None:
+                raise
+            logging.error("keeping current configuration, %s", e)
+            return False
+
+        Application._config = snapshot
+        return True
 
     @classmethod
     def set_apikeys(cls, apikeys):
         """
-        Sets the apikeys to be used by examined when checking if a api key
-        is valid [valid_apikey(apikey=None)].
+        Compiles the apikeys into access policies to be examined when checking
+        if a api key is valid [valid_apikey(apikey=None)].
 
         :param apikeys: dictionary with the apikeys read from apikeys.json
         :type apikey: dict
         """
-        Application._apikeys = apikeys
+        Application._policies = KeyPolicy.compile_all(apikeys, Application.config('api.window'))
+
+    @classmethod
+    def set_keystore(cls, keystore):
+        """
+        Sets the keystore api keys are looked up in instead of the apikeys
+        set by [set_apikeys(apikeys)].
+
+        :param keystore: The keystore, None to use the apikeys
+        :type keystore: KeyStore
+        """
+        Application._keystore = keystore
+
+    @classmethod
+    def set_ledger(cls, ledger):
+        """
+        Sets the ledger recording redeemed one-time apikeys.
+
+        :param ledger: The ledger
+        :type ledger: UsedKeyLedger
+        """
+        Application._ledger = ledger
 
     @classmethod
-    def valid_apikey(cls, apikey=None):
+    @tornado.gen.coroutine
+    def valid_apikey(cls, apikey=None, door_id=None):
         """
         Check if a given apikey is valid for opening the door and in case
         of usage of an one-time ("type": "once") apikey invalidating by
-        recording the key in the file usedkeys.json.
+        redeeming the key at the UsedKeyLedger. Must run on the IOLoop.
 
         :param apikey: The apikey to test
+        :param door_id: The door to open, defaults to the default door
+        :type apikey: str
+        :type door_id: str
+        :return: A future resolving to True is valid, False in invalid
+        """
+        if Application._keystore is not None:
+            policy = yield Application._keystore.get(apikey)
+            # keep one-time keys out of usedkeys.json in plaintext, too
+            redeemed = KeyStore.hash(apikey) if policy is not None else None
+        else:
+            policy = Application._policies.get(apikey)
+            redeemed = apikey
+        if policy is None or not policy.allows(door_id=door_id):
+            raise tornado.gen.Return(False)
+
+        if policy.kind == KeyPolicy.ONCE:
+            # keys used before apikeys.store was set or after it was unset are recorded in the other form
+            used = apikey in Application._ledger or KeyStore.hash(apikey) in Application._ledger
+            if used or not (yield Application._ledger.redeem(redeemed)):
+                logging.warn("one-time key already used.")
+                raise tornado.gen.Return(False)
+
+            logging.warn("one-time key invalidated.")
+
+        raise tornado.gen.Return(True)
+
+    @classmethod
+    def config(cls, key=None):
+        """
+        Returns the typed value for a given key, None if the key is not
+        set, or when no key is given the whole config snapshot
+
+        :param key: The key to lookup
+        :return: The value or the config.
+        :rtype: Settings, str, int, float
+        """
+        if key is None:
+            return Application._config
+        return Application._config.get(key)
+
+    @classmethod
+    def has_valid_slack_config(cls, _config=None):
+        """
+        Check essential config settings for Slack, validated when the
+        config snapshot was built
+
+        :param _config: The config snapshot, defaults to the current one
+        :type _config: Settings
+        :return: True is setup is valid, False otherwise
+        """
+        return (_config or Application._config).slack
+
+
+class FrozenDict(collections.Mapping):
+    """
+    Read-only mapping keeping the order of its items.
+    """
+
+    def __init__(self, items=()):
+        self._items = collections.OrderedDict(items)
+
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return "FrozenDict(%r)" % self._items.items()
+
+    @classmethod
+    def freeze(cls, value):
+        """
+        Returns a value with all nested dicts frozen and lists turned into tuples.
+
+        :param value: A value as read from a JSON file
+        """
+        if isinstance(value, (dict, FrozenDict)):
+            return FrozenDict((key, FrozenDict.freeze(item)) for key, item in value.items())
+        if isinstance(value, (list, tuple)):
+            return tuple(FrozenDict.freeze(item) for item in value)
+        return value
+
+
+class Settings(object):
+    """
+    Immutable, validated snapshot of the configuration with typed values.
+    A reload builds a new snapshot and swaps it in as a whole. Nested values
+    are frozen, so a lookup result can't change the snapshot either.
+    """
+    # set once by __init__, declared for pylint, which doesn't see object.__setattr__
+    _values = FrozenDict()
+    SCHEMA = (("webui.port", 8080, int),
+              ("webui.cookie.secret", "__TODO:_GENERATE_YOUR_OWN_RANDOM_VALUE__", unicode),
+              ("webui.client.pending", 32, int),
+              ("webui.clients.max", 1000, int),
+              ("webui.ping.interval", 20.0, float),
+              ("webui.idle.timeout", 60.0, float),
+              ("webui.compression.min", 256, int),
+              ("webui.workers", 0, int),
+              ("webui.replay.size", 64, int),
+              ("ipc.socket", "doorpi.sock", unicode),
+              ("door.name", "Door", unicode),
+              ("door.open.timeout", 60, int),
+              ("door.open.pulse", 0.5, float),
+              ("ring.debounce", 0.05, float),
+              ("ring.burst.window", 0.3, float),
+              ("ring.burst.limit", 2.0, float),
+              ("api.window", "Mo-Fr 07:00-19:00", unicode),
+              ("apikeys.store", None, unicode),
+              ("apikeys.cache.size", 1024, int),
+              ("slack.webhook", None, unicode),
+              ("slack.baseurl", None, unicode),
+              ("slack.channel", None, unicode),
+              ("slack.queue.size", 100, int),
+              ("slack.retries", 5, int),
+              ("slack.backoff", 1.0, float),
+              ("slack.timeout", 10.0, float),
+              ("slack.ring.window", 60.0, float),
+              ("metrics.lag.interval", 0.5, float),
+              ("profile.interval", 0.05, float),
+              ("profile.stacks", 1000, int),
+              ("profile.threshold", 0.1, float),
+              ("profile.file", "doorpi-profile.folded", unicode),
+              ("history.file", "doorpi_history.bin", unicode),
+              ("history.size", 10000, int),
+              ("state.file", "doorpi_state.json", unicode),
+              ("state.flush.window", 10.0, float),
+              ("config.watch.interval", 0.0, float),
+              ("ratelimit.rate", 0.5, float),
+              ("ratelimit.burst", 10, int),
+              ("ratelimit.size", 1024, int),
+              ("ratelimit.prefix", 4, int),
+              ("webui.xheaders", 0, int),
+              ("log.format", "text", unicode),
+              ("log.queue.size", 10000, int),
+              ("log.rate", 10.0, float),
+              ("log.burst", 20, int),
+              ("gpio.ring", 18, int),
+              ("gpio.open", 23, int))
+
+    DOOR_KEYS = ("door.name", "door.open.timeout", "door.open.pulse", "gpio.open", "gpio.ring")
+    DOOR_ID = re.compile(r"^[A-Za-z0-9_-]{1,15}$")
+
+    def __init__(self, config):
+        """
+        Settings initialisation, converts and checks the values.
+
+        :param config: dictionary with the application configuration.
+        :type config: dict
+        :raises ValueError: on a value not convertible to its type
+        """
+        values = dict(config)
+        for key, default, kind in Settings.SCHEMA:
+            value = values.get(key, default)
+            if value is not None:
+                try:
+                    value = kind(value)
+                except (TypeError, ValueError):
+                    raise ValueError("invalid value %r for %s" % (value, key))
+            values[key] = value
+
+        try:
+            KeyPolicy.compile_window(values["api.window"])
+        except ValueError:
+            raise ValueError("invalid value %r for api.window" % values["api.window"])
+
+        if values["log.format"] not in LogPipeline.FORMATS:
+            raise ValueError("invalid value %r for log.format" % values["log.format"])
+
+        slack = Settings._check_slack(values)
+        doors = Settings._compile_doors(values)
+        object.__setattr__(self, "slack", slack)
+        object.__setattr__(self, "doors", FrozenDict.freeze(doors))
+        object.__setattr__(self, "_values", FrozenDict.freeze(values))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings are immutable, build a new snapshot instead")
+
+    def __delattr__(self, name):
+        raise AttributeError("Settings are immutable, build a new snapshot instead")
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    @classmethod
+    def _compile_doors(cls, values):
+        """
+        Builds the settings of each door, the door of the top-level settings
+        first. Entries of "doors" override its door.* and gpio.* settings.
+
+        :return: The door settings by door id
+        :rtype: collections.OrderedDict
+        :raises ValueError: on an invalid door id or value, or a GPIO pin used twice
+        """
+        kinds = dict((key, kind) for key, _, kind in Settings.SCHEMA)
+        default = dict((key, values[key]) for key in Settings.DOOR_KEYS)
+        doors = collections.OrderedDict([(DoorRegistry.DEFAULT, default)])
+
+        for door_id, overrides in sorted((values.get("doors") or {}).items()):
+            if not Settings.DOOR_ID.match(door_id) or door_id in doors or not isinstance(overrides, dict):
+                raise ValueError("invalid door %r" % door_id)
+
+            door = dict(default)
+            door["door.name"] = unicode(door_id)
+            for key in Settings.DOOR_KEYS:
+                if key in overrides:
+                    try:
+                        door[key] = kinds[key](overrides[key])
+                    except (TypeError, ValueError):
+                        raise ValueError("invalid value %r for %s of door %s" % (overrides[key], key, door_id))
+            doors[str(door_id)] = door
+
+        pins = [settings[key] for settings in doors.values() for key in ("gpio.open", "gpio.ring")]
+        if len(set(pins)) != len(pins):
+            raise ValueError("a GPIO pin is assigned to more than one door")
+
+        return doors
+
+    @classmethod
+    def _check_slack(cls, values):
+        """
+        Check essential config settings for Slack
+
+        :return: True is setup is valid, False otherwise
+        """
+        if values["slack.webhook"] is None or not values["slack.baseurl"]:
+            logging.warn("Slack deactivated because minimum setup for Slack is incomplete or incorrect.")
+            return False
+
+        # slow to import and only needed with Slack
+        import validators
+
+        if not validators.url(values["slack.webhook"]):
+            logging.warn("slack.webhook doesn't validate as URL")
+
+        if not validators.url(values["slack.baseurl"]):
+            logging.warn("slack.baseurl  doesn't validate as URL")
+
+        if values["slack.baseurl"][-1] == '/':
+            values["slack.baseurl"] = values["slack.baseurl"][0:-1]
+            logging.info("removed trailing '/' from slack.baseurl")
+
+        return True
+
+
+class DoorState(object):
+    """
+    Runtime state of a door, kept apart from the configuration.
+    Timestamps are None until the first ring or open.
+    """
+
+    def __init__(self):
+        self.last_ring = None
+        self.last_open = None
+
+    @classmethod
+    def format(cls, timestamp):
+        return "" if timestamp is None else "%s" % timestamp
+
+    def etag(self):
+        """
+        An entity tag of the state, equal in all processes for an equal state.
+
+        :rtype: str
+        """
+        return '"%s-%s"' % (DoorState.format(self.last_ring), DoorState.format(self.last_open))
+
+
+class KeyPolicy(object):
+    """
+    Access policy of an API key, compiled once from its apikeys.json entry
+    so that validation needs no parsing.
+    """
+    MASTER, RESTRICTED, LIMITED, ONCE = range(4)
+    TYPES = {"master": MASTER, "restricted": RESTRICTED, "limited": LIMITED, "once": ONCE}
+    DAYS = ("Mo", "Tu", "We", "Th", "Fr", "Sa", "Su")
+    # raised by compile(entry, default_window) on an invalid apikeys.json entry
+    INVALID = (KeyError, ValueError, TypeError, AttributeError)
+
+    __slots__ = ('kind', 'window', 'first_day', 'last_day', 'doors')
+
+    def __init__(self, kind, window=None, first_day=None, last_day=None, doors=None):
+        """
+        KeyPolicy initialisation
+
+        :param kind: One of MASTER, RESTRICTED, LIMITED or ONCE
+        :param window: Weekly time window bitmap as returned by compile_window(spec)
+        :param first_day: Ordinal of the first valid day
+        :param last_day: Ordinal of the last valid day
+        :param doors: Ids of the doors the key opens, None for all doors
+        :type kind: int
+        :type window: bytearray
+        :type first_day: int
+        :type last_day: int
+        :type doors: frozenset
+        """
+        self.kind = kind
+        self.window = window
+        self.first_day = first_day
+        self.last_day = last_day
+        self.doors = doors
+
+    def allows(self, now=None, door_id=None):
+        """
+        Check if the policy allows opening a door at a given moment. One-time
+        keys still have to be checked for prior use.
+
+        :param now: The moment to check, defaults to now
+        :param door_id: The door to open, defaults to the default door
+        :type now: datetime.datetime
+        :type door_id: str
+        :rtype: bool
+        """
+        if self.doors is not None and (door_id or DoorRegistry.DEFAULT) not in self.doors:
+            return False
+
+        if self.kind == KeyPolicy.MASTER:
+            return True
+
+        if now is None:
+            now = datetime.datetime.today()
+
+        minute = (now.weekday() * 24 + now.hour) * 60 + now.minute
+        if not self.window[minute >> 3] & (1 << (minute & 7)):
+            return False
+
+        if self.kind == KeyPolicy.RESTRICTED:
+            return True
+
+        return self.first_day <= now.toordinal() <= self.last_day
+
+    @classmethod
+    def compile_window(cls, spec):
+        """
+        Compiles a weekly time window like "Mo-Fr 07:00-19:00, Sa 09:00-12:00"
+        into a bitmap with one bit per minute of the week. Ranges wrap around,
+        "Fr-Mo" are the days from friday to monday and "22:00-06:00" ends at
+        06:00 of the following day.
+
+        :param spec: The window specification
+        :type spec: str
+        :return: The bitmap
+        :rtype: bytearray
+        :raises ValueError: on a malformed specification or an empty time range
+        """
+        week = 7 * 24 * 60
+        window = bytearray(week // 8)
+        for part in spec.split(','):
+            days, hours = part.split()
+            first_day, _, last_day = days.partition('-')
+            first_day = cls.DAYS.index(first_day)
+            last_day = cls.DAYS.index(last_day) if last_day else first_day
+            first_minute, last_minute = [cls.minute_of_day(hhmm) for hhmm in hours.split('-')]
+            if last_minute == first_minute:
+                raise ValueError("empty time range %r" % hours)
+            if last_minute < first_minute:
+                last_minute += 1440
+            for day in range(first_day, first_day + (last_day - first_day) % 7 + 1):
+                for minute in range(day * 1440 + first_minute, day * 1440 + last_minute):
+                    minute %= week
+                    window[minute >> 3] |= 1 << (minute & 7)
+        return window
+
+    @classmethod
+    def minute_of_day(cls, hhmm):
+        """
+        :param hhmm: A time of day like "07:30", "24:00" being the end of the day
+        :type hhmm: str
+        :return: The minutes since midnight
+        :rtype: int
+        :raises ValueError: on a malformed or out of range time
+        """
+        hh, mm = [int(value) for value in hhmm.split(':')]
+        if not 0 <= hh <= 24 or not 0 <= mm <= 59 or hh * 60 + mm > 1440:
+            raise ValueError("invalid time of day %r" % hhmm)
+        return hh * 60 + mm
+
+    @classmethod
+    def compile_all(cls, apikeys, default_window):
+        """
+        Compiles the entries of apikeys.json into policies. Entries may set
+        their own "window", identical windows share one bitmap, and limit
+        the key to a list of "doors".
+
+        :param apikeys: dictionary with the apikeys read from apikeys.json
+        :param default_window: Window specification for entries without one
+        :type apikeys: dict
+        :type default_window: str
+        :return: The policies by apikey
+        :rtype: dict
+        """
+        windows = {}
+        policies = {}
+        for apikey, entry in apikeys.items():
+            try:
+                policies[apikey] = cls.compile(entry, default_window, windows)
+            except KeyPolicy.INVALID:
+                owner = entry.get("owner") if isinstance(entry, dict) else None
+                logging.warn("ignoring invalid apikeys.json entry of %s", owner or "unknown owner")
+
+        return policies
+
+    @classmethod
+    def compile(cls, entry, default_window, windows=None):
+        """
+        Compiles a single apikeys.json entry into a policy.
+
+        :param entry: The entry
+        :param default_window: Window specification for an entry without one
+        :param windows: Bitmaps by window specification, shared between the policies
+        :type entry: dict
+        :type default_window: str
+        :type windows: dict
+        :rtype: KeyPolicy
+        :raises ValueError: on an invalid entry, or KeyError, TypeError, AttributeError
+        """
+        if windows is None:
+            windows = {}
+
+        kind = cls.TYPES[entry.get("type")]
+        spec = entry.get("window", default_window)
+        if spec not in windows:
+            windows[spec] = cls.compile_window(spec)
+
+        first_day = last_day = None
+        if kind in (KeyPolicy.LIMITED, KeyPolicy.ONCE):
+            first_day = datetime.datetime.strptime(entry.get("from"), "%d.%m.%Y").toordinal()
+            last_day = datetime.datetime.strptime(entry.get("till"), "%d.%m.%Y").toordinal()
+
+        doors = entry.get("doors")
+        if doors is not None:
+            if not isinstance(doors, list):
+                raise ValueError("doors must be a list")
+            doors = frozenset(doors)
+
+        return KeyPolicy(kind, windows[spec], first_day, last_day, doors)
+
+
+class KeyStore(object):
+    """
+    API keys in a SQLite database, indexed by the SHA-256 hash of the key so
+    that no key is stored or kept in memory in plaintext. Entries are
+    compiled into policies on first use and kept in a bounded LRU cache, so
+    a cached key is looked up without touching the database. Uncached keys
+    are read on the executor of the IOLoop, so a slow SD card does not stall
+    the websocket clients. Whether another connection, e.g. `doorpi.py keys`,
+    changed the database is checked in the background every check_interval
+    seconds and drops the cache, so an added or revoked key takes effect
+    within about that time.
+    """
+
+    def __init__(self, filename, size=1024, default_window="Mo-Fr 07:00-19:00", check_interval=1.0):
+        """
+        KeyStore initialisation, creates the database if missing.
+
+        :param filename: The SQLite database
+        :param size: Maximum number of cached policies
+        :param default_window: Window specification for entries without one
+        :param check_interval: Seconds between two checks for changes by other connections
+        :type filename: str
+        :type size: int
+        :type default_window: str
+        :type check_interval: float
+        """
+        self.filename = filename
+        self.size = size
+        self.default_window = default_window
+        self.check_interval = check_interval
+        self._cache = collections.OrderedDict()
+        self._windows = {}
+        # bumped whenever the cache is dropped, entries read before are not cached
+        self._generation = 0
+        # serializes the use of the connection by the executor threads
+        self._lock = threading.Lock()
+        # only needed with apikeys.store
+        import sqlite3
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS apikeys (hash TEXT PRIMARY KEY, entry TEXT NOT NULL)")
+        self._db.commit()
+        self._version = self._data_version()
+        self._checked = time.time()
+        self._checking = False
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM apikeys").fetchone()[0]
+
+    @classmethod
+    def hash(cls, apikey):
+        """
+        :param apikey: The api key
+        :type apikey: str
+        :return: The hex encoded SHA-256 hash of the key
+        :rtype: str
+        """
+        return hashlib.sha256(apikey.encode('utf-8')).hexdigest()
+
+    def reset(self, default_window):
+        """
+        Drops all cached policies, e.g. after api.window changed. Must run on the IOLoop.
+
+        :param default_window: Window specification for entries without one
+        :type default_window: str
+        """
+        self.default_window = default_window
+        self._drop_cache()
+
+    @tornado.gen.coroutine
+    def get(self, apikey):
+        """
+        Looks up the policy of an api key. Must run on the IOLoop.
+
+        :param apikey: The api key
+        :type apikey: str
+        :return: A future resolving to the policy, None for an unknown or invalid key
+        """
+        io_loop = tornado.ioloop.IOLoop.current()
+        now = time.time()
+        if abs(now - self._checked) >= self.check_interval and not self._checking:
+            self._checked = now
+            self._checking = True
+            io_loop.add_future(io_loop.run_in_executor(None, self._data_version), self._version_checked)
+
+        digest = KeyStore.hash(apikey)
+        policy = self._cache.pop(digest, None)
+        if policy is None:
+            generation = self._generation
+            entry = yield io_loop.run_in_executor(None, self._load, digest)
+            policy = self._compile(entry) if entry is not None else None
+            if policy is None or generation != self._generation:
+                raise tornado.gen.Return(policy)
+
+        self._cache[digest] = policy
+        if len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+        raise tornado.gen.Return(policy)
+
+    def add(self, apikey, entry):
+        """
+        Adds or replaces an api key.
+
+        :param apikey: The api key
+        :param entry: The entry as in apikeys.json
+        :type apikey: str
+        :type entry: dict
+        :raises ValueError: on an invalid entry
+        """
+        self.add_all({apikey: entry})
+
+    def add_all(self, apikeys):
+        """
+        Adds or replaces api keys in a single transaction, e.g. those of an
+        apikeys.json file. Writes synchronously, meant for `doorpi.py keys`.
+
+        :param apikeys: The entries by api key
+        :type apikeys: dict
+        :raises ValueError: on an invalid entry, no key is added then
+        """
+        rows = []
+        for apikey, entry in apikeys.items():
+            try:
+                KeyPolicy.compile(entry, self.default_window)
+            except KeyPolicy.INVALID:
+                raise ValueError("invalid entry of %s" % entry.get("owner", "unknown owner")
+                                 if isinstance(entry, dict) else "invalid entry")
+            rows.append((KeyStore.hash(apikey), json.dumps(entry)))
+
+        with self._lock:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO apikeys (hash, entry) VALUES (?, ?)", rows)
+        self._drop_cache()
+
+    def revoke(self, apikey):
+        """
+        Removes an api key. Writes synchronously, meant for `doorpi.py keys`.
+
+        :param apikey: The api key
+        :type apikey: str
+        :return: True if the key was known, False otherwise
+        :rtype: bool
+        """
+        digest = KeyStore.hash(apikey)
+        with self._lock:
+            with self._db:
+                revoked = self._db.execute("DELETE FROM apikeys WHERE hash = ?", (digest,)).rowcount > 0
+        self._drop_cache()
+        return revoked
+
+    def _drop_cache(self):
+        self._generation += 1
+        self._cache.clear()
+        self._windows.clear()
+
+    def _compile(self, entry):
+        try:
+            return KeyPolicy.compile(entry, self.default_window, self._windows)
+        except KeyPolicy.INVALID:
+            owner = entry.get("owner") if isinstance(entry, dict) else None
+            logging.warn("ignoring invalid keystore entry of %s", owner or "unknown owner")
+            return None
+
+    def _version_checked(self, future):
+        self._checking = False
+        version = future.result()
+        if version != self._version:
+            self._version = version
+            self._drop_cache()
+
+    def _load(self, digest):
+        # runs on an executor thread, the hash is the primary key and needs no further comparison
+        with self._lock:
+            row = self._db.execute("SELECT entry FROM apikeys WHERE hash = ?", (digest,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _data_version(self):
+        # changes whenever another connection commits to the database
+        with self._lock:
+            return self._db.execute("PRAGMA data_version").fetchone()[0]
+
+
+class UsedKeyLedger(object):
+    """
+    Records redeemed one-time API keys. Lookups are served from memory, each
+    redemption is appended and fsync'ed to a journal, which is compacted into
+    the snapshot file by an atomic rename every compact_every redemptions.
+    Journal and snapshot are written on the executor of the IOLoop, so a
+    slow SD card does not stall the websocket clients.
+    """
+
+    def __init__(self, filename='usedkeys.json', compact_every=1000):
+        """
+        UsedKeyLedger initialisation, loads the snapshot and replays the journal.
+
+        :param filename: The snapshot file, the journal is kept next to it
+        :param compact_every: Journal entries after which the snapshot is rewritten
+        :type filename: str
+        :type compact_every: int
+        """
+        self.filename = filename
+        self.journal = filename + '.journal'
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._journal_file = None
+        self._pending = 0
+        self._used = load(filename)
+        # appending to a journal ending in a torn entry would garble the next one
+        if self._replay() or self._pending:
+            self._compact()
+
+    def __contains__(self, apikey):
+        return apikey in self._used
+
+    def __len__(self):
+        return len(self._used)
+
+    @tornado.gen.coroutine
+    def redeem(self, apikey):
+        """
+        Redeems a one-time key. The key counts as used right away, the future
+        resolves once it is recorded. Must run on the IOLoop.
+
+        :param apikey: The apikey to redeem
+        :type apikey: str
+        :return: A future resolving to True if the key was unused and is now redeemed, False otherwise
+        """
+        with self._lock:
+            if apikey in self._used:
+                raise tornado.gen.Return(False)
+            timestamp = "%s" % time.time()
+            self._used[apikey] = timestamp
+
+        try:
+            yield tornado.ioloop.IOLoop.current().run_in_executor(None, self.record, apikey, timestamp)
+        except (IOError, OSError), e:
+            logging.error("can't record one-time key: %s", e)
+            with self._lock:
+                self._used.pop(apikey, None)
+            raise tornado.gen.Return(False)
+
+        raise tornado.gen.Return(True)
+
+    def record(self, apikey, timestamp):
+        """
+        Appends a redeemed key to the journal and compacts the journal when
+        due. Runs on an executor thread.
+
+        :param apikey: The redeemed apikey
+        :param timestamp: The time of the redemption
         :type apikey: str
-        :return: True is valid, False in invalid
+        :type timestamp: str
+        :raises IOError: if the key could not be recorded
+        """
+        with self._write_lock:
+            self._append(apikey, timestamp)
+            if self._pending >= self.compact_every:
+                try:
+                    self._compact()
+                except (IOError, OSError), e:
+                    logging.error("can't compact %s: %s", self.journal, e)
+
+    def _append(self, apikey, timestamp):
+        if self._journal_file is None:
+            self._journal_file = open(self.journal, 'a')
+        self._journal_file.write(json.dumps([apikey, timestamp]) + '\n')
+        self._journal_file.flush()
+        os.fsync(self._journal_file.fileno())
+        self._pending += 1
+
+    def _replay(self):
+        """
+        Adds the entries of the journal to the used keys.
+
+        :return: True if an incomplete entry was skipped
+        :rtype: bool
+        """
+        skipped = False
+        try:
+            with open(self.journal, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        apikey, timestamp = json.loads(line)
+                    except (ValueError, TypeError):
+                        logging.warn("ignoring incomplete entry in %s", self.journal)
+                        skipped = True
+                        continue
+                    self._used.setdefault(apikey, timestamp)
+                    self._pending += 1
+        except IOError:
+            pass
+        return skipped
+
+    def _compact(self):
+        with self._lock:
+            used = dict(self._used)
+        temp = self.filename + '.tmp'
+        with open(temp, 'w') as keys_file:
+            json.dump(used, keys_file)
+            keys_file.flush()
+            os.fsync(keys_file.fileno())
+        os.rename(temp, self.filename)
+        fsync_directory(self.filename)
+
+        if self._journal_file is not None:
+            self._journal_file.close()
+        self._journal_file = open(self.journal, 'w')
+        self._pending = 0
+
+
+class RateLimiter(object):
+    """
+    Token buckets per remote IP and per key prefix, kept in a bounded LRU
+    map. Checked before any key lookup, disk access or GPIO work.
+    """
+
+    def __init__(self, rate=0.5, burst=10, size=1024, prefix=4):
+        """
+        RateLimiter initialisation
+
+        :param rate: Tokens added per second to each bucket, 0 disables limiting
+        :param burst: Maximum tokens of a bucket
+        :param size: Maximum number of buckets, the least recently used are evicted
+        :param prefix: Length of the key prefix buckets are kept for
+        :type rate: float
+        :type burst: int
+        :type size: int
+        :type prefix: int
+        """
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self.prefix = prefix
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, remote_ip, key=None):
+        """
+        Takes a token from the bucket of the remote IP and of the key prefix.
+
+        :param remote_ip: The client address
+        :param key: The api-key or secret requested
+        :type remote_ip: str
+        :type key: str
+        :return: True if the request may proceed, False if it is to be rejected
         :rtype: bool
         """
-        if apikey in Application._apikeys:
+        if self.rate <= 0:
+            return True
+
+        now = time.time()
+        with self._lock:
+            if not self._take("ip:%s" % remote_ip, now):
+                Metrics.rate_limited.inc()
+                return False
+            if key and not self._take("key:%s" % key[:self.prefix], now):
+                Metrics.rate_limited.inc()
+                return False
+        return True
+
+    def _take(self, name, now):
+        tokens, last = self._buckets.pop(name, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+
+        self._buckets[name] = (tokens, now)
+        if len(self._buckets) > self.size:
+            self._buckets.popitem(last=False)
+        return allowed
+
+
+class ApiHandler(tornado.web.RequestHandler):
+    loader = None
+
+    @tornado.gen.coroutine
+    def get(self, apikey=None, door_id=None):
+        """
+        Handles get requests to /api/open/{apikey} and /api/doors/{door_id}/open/{apikey}
+
+        :param apikey: Everything in query_path behind open/
+        :param door_id: The door to open, defaults to the default door
+        :type apikey: str
+        :type door_id: str
+        """
+        door = DoorRegistry.get(door_id)
+        if door is None:
+            raise tornado.web.HTTPError(404)
+
+        if not Application.limiter.allow(self.request.remote_ip, apikey):
+            response = {'error': "Too Many Requests"}
+            self.set_status(429, reason="Too Many Requests")
+        elif (yield door.request_api_open(apikey)):
+            response = {'open': "%s" % time.time()}
+            logging.info("API open of %s for %s... (%s)", door.id, apikey[:4], self.request.remote_ip,
+                         extra={"event": "api_open", "door": door.id, "remote_ip": self.request.remote_ip})
+            Metrics.api_accepted.inc()
+        else:
+            Metrics.api_rejected.inc()
+            response = {'error': "Unauthorized"}
+            self.set_status(401)
+
+        self.set_header('Content-Type', 'text/json')
+        self.write(response)
+        self.finish()
+
+
+class SlackHandler(tornado.web.RequestHandler):
+    loader = None
+    notifier = None
+
+    @tornado.gen.coroutine
+    def get(self, secret=None, door_id=None):
+        """
+        Handles get request to /slack/{secret} and /doors/{door_id}/slack/{secret}
 
-            api_key_type = Application._apikeys.get(apikey).get("type")
+        :param secret: Everything in query_path behind slack/
+        :param door_id: The door to open, defaults to the default door
+        :type secret: str
+        :type door_id: str
+        """
+        door = DoorRegistry.get(door_id)
+        if door is None:
+            raise tornado.web.HTTPError(404)
+
+        if not Application.limiter.allow(self.request.remote_ip, secret):
+            raise tornado.web.HTTPError(429, reason="Too Many Requests")
+
+        opened = yield door.request_open(secret)
+        self.render("slack.html", config=Application.config(), door=door, opened=opened)
+
+    @classmethod
+    def setup_notifier(cls):
+        """
+        Sets up the background notifier delivering messages to Slack.
+        """
+        if SlackHandler.notifier is None:
+            SlackHandler.notifier = SlackNotifier(queue_size=Application.config('slack.queue.size'),
+                                                  retries=Application.config('slack.retries'),
+                                                  backoff=Application.config('slack.backoff'),
+                                                  timeout=Application.config('slack.timeout'),
+                                                  ring_window=Application.config('slack.ring.window'))
+            SlackHandler.notifier.start()
 
-            if api_key_type == "master":
-                return True
+    @classmethod
+    def send(cls, text, open_link=None, ring=False, username=None):
+        """
+        Queues a message for Slack and returns immediately, the message is
+        delivered by the SlackNotifier in the background.
+
+        :param text: The message
+        :param open_link: The open link
+        :param ring: Merge the message with other ring messages of a burst
+        :param username: The sender of the message, defaults to door.name
+        :type text: str
+        :type open_link: str
+        :type ring: bool
+        :type username: str
+        """
+        if Application.has_valid_slack_config():
+            if SlackHandler.notifier is None:
+                logging.warn("Slack notifier not set up, dropping message '%s'", text)
+                return
+            SlackHandler.notifier.notify(text, open_link, ring, username)
+
+    @classmethod
+    def render_message(cls, text, open_link=None, username=None):
+        """
+        Renders a message into the Slack webhook payload.
+
+        :param text: The message
+        :param open_link: The open link
+        :param username: The sender of the message, defaults to door.name
+        :type text: str
+        :type open_link: str
+        :type username: str
+        :return: The JSON payload
+        :rtype: str
+        """
+        if username is None:
+            username = Application.config('door.name')
+        return SlackHandler.loader.load('slack.json').generate(channel=Application.config('slack.channel'),
+                                                               username=username,
+                                                               text=text,
+                                                               open_link=open_link)
+
+
+class SlackNotifier(object):
+    """
+    Delivers Slack messages from a bounded queue on the IOLoop with a
+    non-blocking HTTP client, retrying failed posts with exponential backoff.
+    Ring messages of a sender arriving within ring_window seconds of its
+    last delivered ring are merged into a single message.
+    """
+
+    def __init__(self, queue_size=100, retries=5, backoff=1.0, timeout=10.0, ring_window=60.0):
+        """
+        SlackNotifier initialisation
+
+        :param queue_size: Maximum number of undelivered messages
+        :param retries: Retries per message before giving up
+        :param backoff: Delay before the first retry in seconds, doubled on each retry
+        :param timeout: Request timeout in seconds
+        :param ring_window: Window in seconds in which rings are merged
+        :type queue_size: int
+        :type retries: int
+        :type backoff: float
+        :type timeout: float
+        :type ring_window: float
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.ring_window = ring_window
+        self.queue = tornado.queues.Queue(maxsize=queue_size)
+        self.io_loop = None
+        self.client = None
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.merged = 0
+        self._ring_items = {}
+        self._last_rings = {}
+
+    def start(self, io_loop=None):
+        """
+        Starts the delivery worker on the given IOLoop.
+
+        :param io_loop: The IOLoop, defaults to the current one
+        :type io_loop: tornado.ioloop.IOLoop
+        """
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        try:
+            from tornado import curl_httpclient  # needs pycurl, enables keep-alive connections for outbound requests
+            tornado.httpclient.AsyncHTTPClient.configure(curl_httpclient.CurlAsyncHTTPClient)
+        except ImportError:
+            logging.info("pycurl is not installed, every Slack message opens a new connection")
+        self.client = tornado.httpclient.AsyncHTTPClient()
+        self.io_loop.spawn_callback(self._worker)
+
+    def notify(self, text, open_link=None, ring=False, username=None):
+        """
+        Queues a message. Safe to call from any thread, returns immediately.
+
+        :param text: The message
+        :param open_link: The open link
+        :param ring: Merge the message with other ring messages of a burst
+        :param username: The sender of the message, defaults to door.name
+        :type text: str
+        :type open_link: str
+        :type ring: bool
+        :type username: str
+        """
+        self.io_loop.add_callback(self._enqueue, text, open_link, ring, username)
+
+    def join(self, timeout=None):
+        """
+        Waits until all queued messages are delivered or given up.
+
+        :param timeout: Maximum time to wait in seconds
+        :type timeout: float
+        :return: A future resolving when the queue is empty
+        """
+        if timeout is not None:
+            timeout = datetime.timedelta(seconds=timeout)
+        return self.queue.join(timeout=timeout)
+
+    def _enqueue(self, text, open_link, ring, username=None):
+        if not ring:
+            self._put({"text": text, "open_link": open_link, "username": username, "count": 1})
+            return
+
+        item = self._ring_items.get(username)
+        if item is not None:
+            item["count"] += 1
+            item["open_link"] = open_link
+            self.merged += 1
+            return
+
+        item = self._ring_items[username] = {"text": text, "open_link": open_link, "username": username,
+                                             "ring": True, "count": 1}
+        delay = 0
+        if username in self._last_rings:
+            delay = self._last_rings[username] + self.ring_window - self.io_loop.time()
+        if delay > 0:
+            self.io_loop.call_later(delay, self._put, item)
+        else:
+            self._put(item)
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except tornado.queues.QueueFull:
+            self.dropped += 1
+            if item.get("ring"):
+                self._ring_items.pop(item["username"], None)
+            logging.warn("Slack queue full, dropping message '%s'", item["text"])
+
+    @tornado.gen.coroutine
+    def _worker(self):
+        while True:
+            item = yield self.queue.get()
+            try:
+                if item.get("ring"):
+                    self._ring_items.pop(item["username"], None)
+                    self._last_rings[item["username"]] = self.io_loop.time()
+                yield self._deliver(item)
+            except Exception:
+                logging.error("Error sending message to Slack", exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    @tornado.gen.coroutine
+    def _deliver(self, item):
+        text = item["text"]
+        if item["count"] > 1:
+            text = "%s (rang %d times)" % (text, item["count"])
+
+        request = tornado.httpclient.HTTPRequest(Application.config('slack.webhook'),
+                                                 method='POST',
+                                                 body=SlackHandler.render_message(text, item["open_link"],
+                                                                                  item["username"]),
+                                                 headers={'Content-Type': 'application/json'},
+                                                 request_timeout=self.timeout)
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            response = yield self.client.fetch(request, raise_error=False)
+            Metrics.slack_round_trip.observe(response.request_time)
+            if response.code < 400:
+                self.sent += 1
+                Metrics.slack_sent.inc()
+                logging.info("Slack responded: %s on message '%s'", response.code, text)
+                return
+
+            if 400 <= response.code < 500 and response.code != 429:
+                break
+
+            if attempt < self.retries:
+                logging.info("Slack responded: %s, retrying in %s seconds", response.code, delay)
+                yield tornado.gen.sleep(delay)
+                delay *= 2
+
+        self.failed += 1
+        Metrics.slack_failed.inc()
+        logging.warn("Slack responded: %s, giving up on message '%s'", response.code, text)
+
+
+class StatusHandler(tornado.web.RequestHandler):
+    """
+        Handles request to /api/status and /api/doors/{door_id}/status
+    """
+
+    def get(self, door_id=None):
+        door = DoorRegistry.get(door_id)
+        if door is None:
+            raise tornado.web.HTTPError(404)
+
+        # answer an unchanged state before building the response
+        self.set_header('Etag', door.state.etag())
+        self.set_header('Cache-Control', 'no-cache')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        self.set_header('Content-Type', 'text/json')
+        self.write({
+            "door": door.id,
+            "name": door.config('door.name'),
+            "last_ring": DoorState.format(door.state.last_ring),
+            "last_open": DoorState.format(door.state.last_open)
+        })
+
+
+class EventStreamHandler(tornado.web.RequestHandler):
+    """
+        Handles the Server-Sent Events stream of a door at /api/events and
+        /api/doors/{door_id}/events, carrying the messages of the websocket
+    """
+
+    def initialize(self):
+        self.pending = 0
+        self.door = None
+        self._closed = tornado.concurrent.Future()
+
+    @tornado.gen.coroutine
+    def get(self, door_id=None):
+        self.door = DoorRegistry.get(door_id)
+        if self.door is None:
+            raise tornado.web.HTTPError(404)
+        if not DoorRegistry.admit():
+            raise tornado.web.HTTPError(503)
+
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        self.door.hub.add_stream(self)
+        self.door.hub.send_event(self, tornado.escape.json_encode(self.door.update_message()))
+        yield self._closed
+
+    def on_connection_close(self):
+        if self.door is not None:
+            self.door.hub.remove(self)
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+
+class HistoryHandler(tornado.web.RequestHandler):
+    """
+        Handles request to /api/history?cursor=&limit=&since=&until=&type=
+    """
+
+    def get(self):
+        try:
+            cursor = self.get_argument('cursor', None)
+            since = self.get_argument('since', None)
+            until = self.get_argument('until', None)
+            events = EventLog.query(cursor=int(cursor) if cursor else None,
+                                    limit=max(1, min(int(self.get_argument('limit', 50)), 500)),
+                                    since=float(since) if since else None,
+                                    until=float(until) if until else None,
+                                    types=self.get_arguments('type') or None)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+        self.set_header('Content-Type', 'text/json')
+        self.write(events)
+
+
+class EventLog(object):
+    """
+    Bounded history of door events in a memory-mapped ring buffer file.
+    Records have a fixed size and are addressed by their sequence number,
+    so appends and reads touch single records and the file never grows
+    beyond its configured number of records.
+    """
+    RING, OPEN, API_OPEN, TIMEOUT = range(1, 5)
+    NAMES = {RING: "ring", OPEN: "open", API_OPEN: "api_open", TIMEOUT: "timeout"}
+
+    MAGIC = "DOORPIHL"
+    HEADER = struct.Struct("!8sIIQ8x")
+    RECORD = struct.Struct("!QdB15s")
+
+    _map = None
+    _file = None
+    _capacity = 0
+    _next = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def setup(cls, filename, capacity, readonly=False):
+        """
+        Opens or creates the history file. A file of another capacity is recreated.
+
+        :param filename: The history file
+        :param capacity: Number of records kept
+        :param readonly: Open the file of another process for queries only
+        :type filename: str
+        :type capacity: int
+        :type readonly: bool
+        """
+        if EventLog._map is not None:
+            return
+
+        if readonly:
+            EventLog._setup_readonly(filename, capacity)
+            return
+
+        size = EventLog.HEADER.size + capacity * EventLog.RECORD.size
+        try:
+            EventLog._file = open(filename, 'r+b')
+        except IOError:
+            EventLog._file = open(filename, 'w+b')
+
+        header = EventLog._file.read(EventLog.HEADER.size)
+        next_seq = 0
+        if len(header) == EventLog.HEADER.size:
+            magic, version, stored_capacity, stored_next = EventLog.HEADER.unpack(header)
+            if magic == EventLog.MAGIC and version == 1 and stored_capacity == capacity:
+                next_seq = stored_next
+            else:
+                logging.warn("recreating %s with %d records", filename, capacity)
+
+        EventLog._file.truncate(size)
+        EventLog._map = mmap.mmap(EventLog._file.fileno(), size)
+        EventLog._capacity = capacity
+        EventLog._next = next_seq
+        EventLog._map[0:EventLog.HEADER.size] = EventLog.HEADER.pack(EventLog.MAGIC, 1, capacity, next_seq)
+
+    @classmethod
+    def _setup_readonly(cls, filename, capacity):
+        size = EventLog.HEADER.size + capacity * EventLog.RECORD.size
+        try:
+            history_file = open(filename, 'rb')
+            history_map = mmap.mmap(history_file.fileno(), size, access=mmap.ACCESS_READ)
+        except (IOError, ValueError, mmap.error), e:
+            logging.warn("history %s not available: %s", filename, e)
+            return
+
+        if EventLog.HEADER.unpack_from(history_map, 0)[0:3] != (EventLog.MAGIC, 1, capacity):
+            logging.warn("history %s not available: unknown format", filename)
+            return
+
+        EventLog._file = history_file
+        EventLog._map = history_map
+        EventLog._capacity = capacity
+
+    @classmethod
+    def append(cls, kind, timestamp=None, detail=""):
+        """
+        Appends an event, overwriting the oldest one when the log is full.
+
+        :param kind: One of RING, OPEN, API_OPEN or TIMEOUT
+        :param timestamp: When the event happened, defaults to now
+        :param detail: Up to 15 bytes of additional information
+        :type kind: int
+        :type timestamp: float
+        :type detail: str
+        """
+        if EventLog._map is None:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+
+        with EventLog._lock:
+            seq = EventLog._next
+            offset = EventLog._offset(seq)
+            EventLog._map[offset:offset + EventLog.RECORD.size] = EventLog.RECORD.pack(seq, timestamp, kind, detail)
+            EventLog._next = seq + 1
+            EventLog._map[0:EventLog.HEADER.size] = EventLog.HEADER.pack(EventLog.MAGIC, 1, EventLog._capacity,
+                                                                          EventLog._next)
+
+    @classmethod
+    def query(cls, cursor=None, limit=50, since=None, until=None, types=None):
+        """
+        Returns events newest first. Pass the returned "next" as cursor to get
+        the following page, it is None on the last page.
+
+        :param cursor: Return events with a sequence number below the cursor
+        :param limit: Maximum number of events
+        :param since: Return events at or after this timestamp
+        :param until: Return events before this timestamp
+        :param types: Return events with these names only
+        :type cursor: int
+        :type limit: int
+        :type since: float
+        :type until: float
+        :type types: list
+        :return: The events and the cursor of the next page
+        :rtype: dict
+        """
+        if EventLog._map is None:
+            return {"events": [], "next": None}
+
+        with EventLog._lock:
+            # read from the file, it may be appended to by another process
+            newest = EventLog.HEADER.unpack_from(EventLog._map, 0)[3]
+        oldest = max(0, newest - EventLog._capacity)
+        end = newest if cursor is None else max(oldest, min(cursor, newest))
+
+        if until is not None:
+            # sequence numbers are in time order, find the first event at or after until
+            low, high = oldest, end
+            while low < high:
+                middle = (low + high) // 2
+                if EventLog._read(middle)[1] < until:
+                    low = middle + 1
+                else:
+                    high = middle
+            end = low
+
+        events = []
+        seq = end - 1
+        while seq >= oldest and len(events) < limit:
+            stored_seq, timestamp, kind, detail = EventLog._read(seq)
+            if stored_seq != seq or (since is not None and timestamp < since):
+                break
+            name = EventLog.NAMES.get(kind, "unknown")
+            if types is None or name in types:
+                event = {"seq": seq, "action": name, "timestamp": "%s" % timestamp}
+                detail = detail.rstrip("\0")
+                if detail:
+                    event["detail"] = detail
+                events.append(event)
+            seq -= 1
+
+        more = seq >= oldest and (since is None or EventLog._read(seq)[1] >= since)
+        return {"events": events, "next": seq + 1 if more and len(events) == limit else None}
+
+    @classmethod
+    def _offset(cls, seq):
+        return EventLog.HEADER.size + (seq % EventLog._capacity) * EventLog.RECORD.size
+
+    @classmethod
+    def _read(cls, seq):
+        offset = EventLog._offset(seq)
+        return EventLog.RECORD.unpack(EventLog._map[offset:offset + EventLog.RECORD.size])
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+        Handles request to /metrics
+    """
+
+    @tornado.gen.coroutine
+    def get(self):
+        snapshot = None
+        if EventBus.client is not None:
+            # a scrape may reach any worker, each one answers with the metrics of all processes
+            snapshot = yield EventBus.client.request(None, "metrics")
+            if not snapshot:
+                raise tornado.web.HTTPError(503)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(Metrics.expose(snapshot))
+
+
+class Counter(object):
+    """
+    A monotonically increasing Prometheus counter
+    """
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+    def merge(self, values):
+        return sum(values)
+
+    def expose(self, value=None):
+        if value is None:
+            value = self.snapshot()
+        return ["# HELP %s %s" % (self.name, self.description),
+                "# TYPE %s counter" % self.name,
+                "%s %r" % (self.name, float(value))]
+
+
+class Gauge(object):
+    """
+    A Prometheus gauge, either set explicitly or read from a function on
+    exposition. The values of several processes are merged by aggregate.
+    """
+
+    def __init__(self, name, description, function=None, aggregate=sum):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.aggregate = aggregate
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        if self.function is None:
+            return self.value
+        try:
+            return self.function()
+        except AttributeError:
+            return 0
+
+    def merge(self, values):
+        return self.aggregate(values) if values else 0
+
+    def expose(self, value=None):
+        if value is None:
+            value = self.snapshot()
+        return ["# HELP %s %s" % (self.name, self.description),
+                "# TYPE %s gauge" % self.name,
+                "%s %r" % (self.name, float(value))]
+
+
+class Histogram(object):
+    """
+    A Prometheus histogram of durations in seconds
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, description, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return [list(self.counts), self.sum]
+
+    def merge(self, values):
+        return [[sum(counts) for counts in zip(*[value[0] for value in values])] or [0] * len(self.counts),
+                sum(value[1] for value in values)]
+
+    def expose(self, value=None):
+        lines = ["# HELP %s %s" % (self.name, self.description),
+                 "# TYPE %s histogram" % self.name]
+        counts, total = value if value is not None else self.snapshot()
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%r"} %d' % (self.name, bound, cumulative))
+        cumulative += counts[-1]
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, cumulative))
+        lines.append("%s_sum %r" % (self.name, total))
+        lines.append("%s_count %d" % (self.name, cumulative))
+        return lines
+
+
+class Metrics(object):
+    """
+    The metrics exposed at /metrics in the Prometheus text format
+    """
+    rings = Counter("doorpi_rings_total", "Rings handled.")
+    ring_presses = Counter("doorpi_ring_presses_total", "Ring presses, including those coalesced into one ring.")
+    ring_bounces = Counter("doorpi_ring_bounces_total", "Ring input edges dropped as contact bounce.")
+    clients_rejected = Counter("doorpi_clients_rejected_total",
+                               "Websocket and event stream clients turned away at webui.clients.max.")
+    clients_reaped = Counter("doorpi_clients_reaped_total", "Websocket clients closed as unresponsive.")
+    log_suppressed = Counter("doorpi_log_suppressed_total", "Log records over the rate of their call site.")
+    log_dropped = Counter("doorpi_log_dropped_total", "Log records dropped because the log queue was full.")
+    opens = Counter("doorpi_opens_total", "Doors opened after a ring.")
+    api_accepted = Counter("doorpi_api_accepted_total", "Accepted /api/open requests.")
+    api_rejected = Counter("doorpi_api_rejected_total", "Rejected /api/open requests.")
+    rate_limited = Counter("doorpi_rate_limited_total", "Requests rejected by the rate limiter.")
+    slack_sent = Counter("doorpi_slack_sent_total", "Messages delivered to Slack.")
+    slack_failed = Counter("doorpi_slack_failed_total", "Messages given up after retries.")
+
+    ring_latency = Histogram("doorpi_ring_broadcast_seconds", "Time from ring detection to broadcast.")
+    pulse_duration = Histogram("doorpi_gpio_pulse_seconds", "Duration of door-open pulses.")
+    slack_round_trip = Histogram("doorpi_slack_round_trip_seconds", "Round-trip time of Slack posts.")
+    loop_lag = Histogram("doorpi_ioloop_lag_seconds", "Delay of IOLoop timer callbacks.")
+
+    clients = Gauge("doorpi_websocket_clients", "Connected websocket clients.",
+                    lambda: sum(len(door.hub.clients) for door in DoorRegistry.doors.values()))
+    streams = Gauge("doorpi_event_stream_clients", "Connected Server-Sent Events clients.",
+                    lambda: sum(len(door.hub.streams) for door in DoorRegistry.doors.values()))
+    last_loop_lag = Gauge("doorpi_ioloop_lag_last_seconds", "Last measured delay of IOLoop timer callbacks.",
+                          aggregate=max)
+
+    io_loop = None
+    lag_interval = None
+
+    @classmethod
+    def setup(cls, io_loop, lag_interval=0.5):
+        """
+        Starts the IOLoop lag monitor, which measures how late a timer fires.
+
+        :param io_loop: The IOLoop to monitor
+        :param lag_interval: Seconds between measurements
+        :type io_loop: tornado.ioloop.IOLoop
+        :type lag_interval: float
+        """
+        if Metrics.io_loop is None:
+            Metrics.io_loop = io_loop
+            Metrics.lag_interval = lag_interval
+            Metrics._schedule_lag_check()
+
+    @classmethod
+    def _schedule_lag_check(cls):
+        expected = Metrics.io_loop.time() + Metrics.lag_interval
+        Metrics.io_loop.call_at(expected, Metrics._check_lag, expected)
+
+    @classmethod
+    def _check_lag(cls, expected):
+        lag = max(0.0, Metrics.io_loop.time() - expected)
+        Metrics.loop_lag.observe(lag)
+        Metrics.last_loop_lag.set(lag)
+        Metrics._schedule_lag_check()
+
+    @classmethod
+    def metrics(cls):
+        return (Metrics.rings, Metrics.ring_presses, Metrics.ring_bounces, Metrics.opens,
+                Metrics.api_accepted, Metrics.api_rejected, Metrics.clients_rejected, Metrics.clients_reaped,
+                Metrics.rate_limited, Metrics.slack_sent, Metrics.slack_failed,
+                Metrics.log_suppressed, Metrics.log_dropped, Metrics.ring_latency,
+                Metrics.pulse_duration, Metrics.slack_round_trip, Metrics.loop_lag,
+                Metrics.clients, Metrics.streams, Metrics.last_loop_lag)
+
+    @classmethod
+    def snapshot(cls, gauges=True):
+        """
+        :param gauges: False to leave out the gauges, e.g. of a process that went away
+        :type gauges: bool
+        :return: The values of the metrics of this process by name, JSON serializable
+        :rtype: dict
+        """
+        return dict((metric.name, metric.snapshot()) for metric in Metrics.metrics()
+                    if gauges or not isinstance(metric, Gauge))
+
+    @classmethod
+    def merge(cls, snapshots, gauges=True):
+        """
+        Merges the snapshots of several processes, counters and histograms
+        are added up, gauges merged by their aggregate.
+
+        :param snapshots: Snapshots as returned by snapshot()
+        :param gauges: False to leave out the gauges
+        :type snapshots: list
+        :type gauges: bool
+        :rtype: dict
+        """
+        return dict((metric.name, metric.merge([snapshot[metric.name] for snapshot in snapshots
+                                                if metric.name in snapshot]))
+                    for metric in Metrics.metrics() if gauges or not isinstance(metric, Gauge))
+
+    @classmethod
+    def expose(cls, snapshot=None):
+        """
+        Renders all metrics in the Prometheus text format.
+
+        :param snapshot: The values to render, defaults to those of this process
+        :type snapshot: dict
+        :rtype: str
+        """
+        lines = []
+        for metric in Metrics.metrics():
+            lines.extend(metric.expose(None if snapshot is None else snapshot.get(metric.name)))
+        return "\n".join(lines) + "\n"
+
+
+class LogPipeline(object):
+    """
+    Takes writing log records off the logging thread, e.g. the IOLoop: records
+    are put on a bounded queue and written by a background thread, either as
+    text or as one JSON object per line carrying the fields given as
+    extra={...}. Each call site may log rate records per second with bursts
+    of burst records, it logs beyond are dropped, counted and reported with
+    its next record as "suppressed".
+    """
+    FORMATS = ("text", "json")
+    FIELDS = frozenset(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | frozenset(("message", "asctime"))
+    queue = None
+    thread = None
+    writer = None
+
+    @classmethod
+    def setup(cls, stream=None, log_format="text", size=10000, rate=10.0, burst=20):
+        """
+        Routes the records of the root logger through the pipeline.
+
+        :param stream: The stream to write to, defaults to stderr
+        :param log_format: One of FORMATS
+        :param size: Maximum number of queued records, further records are dropped
+        :param rate: Records below WARNING per second and call site, 0 to not limit
+        :param burst: Records a call site may log at once
+        :type stream: file
+        :type log_format: str
+        :type size: int
+        :type rate: float
+        :type burst: int
+        """
+        if LogPipeline.thread is not None:
+            return
+
+        LogPipeline.writer = logging.StreamHandler(stream)
+        LogPipeline.writer.setFormatter(LogFormatter(log_format == "json"))
+        LogPipeline.queue = Queue.Queue(size)
+
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(QueueingHandler(LogPipeline.queue, rate, burst))
+
+        LogPipeline.thread = threading.Thread(target=LogPipeline._write, name="LogPipeline")
+        LogPipeline.thread.daemon = True
+        LogPipeline.thread.start()
+
+    @classmethod
+    def stop(cls, timeout=5.0):
+        """
+        Writes the queued records and lets further records be written directly.
+
+        :param timeout: Seconds to wait for the queue to be written
+        :type timeout: float
+        """
+        if LogPipeline.thread is None:
+            return
+
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            if isinstance(handler, QueueingHandler):
+                root.removeHandler(handler)
+        root.addHandler(LogPipeline.writer)
+
+        LogPipeline.queue.put(None)
+        LogPipeline.thread.join(timeout)
+        LogPipeline.thread = None
+
+    @classmethod
+    def _write(cls):
+        while True:
+            record = LogPipeline.queue.get()
+            if record is None:
+                return
+            LogPipeline.writer.handle(record)
+
+
+class QueueingHandler(logging.Handler):
+    """
+    Rate-limits records per call site and queues them without blocking.
+    Warnings and errors are never muted, neither is the access log, which
+    logs every request from a single call site.
+    """
+    UNLIMITED = ("tornado.access",)
+
+    def __init__(self, queue, rate=10.0, burst=20):
+        """
+        QueueingHandler initialisation
+
+        :param queue: The queue records are put on
+        :param rate: Records below WARNING per second and call site, 0 to not limit
+        :param burst: Records a call site may log at once
+        :type queue: Queue.Queue
+        :type rate: float
+        :type burst: int
+        """
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.rate = rate
+        self.burst = burst
+        self._sites = {}
+
+    def emit(self, record):
+        # called with the handler's lock held
+        if self.rate > 0 and record.levelno < logging.WARNING and record.name not in QueueingHandler.UNLIMITED:
+            site = (record.pathname, record.lineno)
+            tokens, last, suppressed = self._sites.get(site, (self.burst, record.created, 0))
+            tokens = min(self.burst, tokens + (record.created - last) * self.rate)
+            if tokens < 1:
+                self._sites[site] = (tokens, record.created, suppressed + 1)
+                Metrics.log_suppressed.inc()
+                return
+            self._sites[site] = (tokens - 1, record.created, 0)
+            if suppressed:
+                record.suppressed = suppressed
+
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            Metrics.log_dropped.inc()
+
+
+class LogFormatter(logging.Formatter):
+    """
+    Formats records as text or as JSON objects with their extra fields.
+    """
+
+    def __init__(self, json_format=False):
+        logging.Formatter.__init__(self, logging.BASIC_FORMAT)
+        self.json_format = json_format
+
+    def format(self, record):
+        if not self.json_format:
+            text = logging.Formatter.format(self, record)
+            if getattr(record, "suppressed", 0):
+                text += " (%d similar records suppressed)" % record.suppressed
+            return text
+
+        entry = {"ts": record.created, "level": record.levelname, "logger": record.name,
+                 "msg": record.getMessage(), "pid": record.process}
+        for key, value in record.__dict__.items():
+            if key not in LogPipeline.FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=repr, sort_keys=True)
+
+
+class MainHandler(tornado.web.RequestHandler):
+    """
+        Handles request to / and /doors/{door_id}
+    """
+
+    def get(self, door_id=None):
+        door = DoorRegistry.get(door_id)
+        if door is None:
+            raise tornado.web.HTTPError(404)
+        self.render("index.html", config=Application.config(), door=door, doors=DoorRegistry.doors,
+                    state=door.state)
+
+
+class SimulationHandler(tornado.web.RequestHandler):
+    """
+        Handles request to /simulation and /doors/{door_id}/simulation
+    """
+
+    def get(self, door_id=None):
+        door = DoorRegistry.get(door_id)
+        if door is None:
+            raise tornado.web.HTTPError(404)
+        self.render("simulation.html", config=Application.config(), door=door)
+
+
+class StaticAssets(object):
+    """
+    The files of the static directory, fingerprinted with a hash of their
+    content once at startup. Compressible files are also compressed once
+    and kept in memory, every other file is served from disk.
+    """
+    COMPRESSIBLE = ('.css', '.html', '.js', '.json', '.svg', '.txt')
+
+    assets = {}
+    urls = {}
+
+    @classmethod
+    def build(cls, static_path):
+        """
+        Fingerprints and compresses the files of the static directory.
+
+        :param static_path: The static directory
+        :type static_path: str
+        """
+        try:
+            import brotli  # adds brotli compressed variants of the static assets
+        except ImportError:
+            brotli = None
+
+        for root, _, files in os.walk(static_path):
+            for filename in files:
+                name = os.path.relpath(os.path.join(root, filename), static_path).replace(os.path.sep, "/")
+                with open(os.path.join(root, filename), 'rb') as asset_file:
+                    data = asset_file.read()
+
+                fingerprint = hashlib.md5(data).hexdigest()[:12]
+                base, extension = os.path.splitext(name)
+                url = "%s.%s%s" % (base, fingerprint, extension)
+
+                variants = {}
+                if extension in StaticAssets.COMPRESSIBLE:
+                    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                    variants["gzip"] = compressor.compress(data) + compressor.flush()
+                    if brotli is not None:
+                        variants["br"] = brotli.compress(data)
+                    variants = dict((encoding, variant) for encoding, variant in variants.items()
+                                    if len(variant) < len(data))
+
+                StaticAssets.assets[name] = {
+                    "url": url,
+                    "fingerprint": fingerprint,
+                    "type": mimetypes.guess_type(name)[0] or "application/octet-stream",
+                    "variants": variants
+                }
+                StaticAssets.urls[url] = name
+
+    @classmethod
+    def encoding(cls, asset, accept_encoding):
+        """
+        Chooses the compressed variant of an asset for a client.
+
+        :param asset: The asset
+        :param accept_encoding: The Accept-Encoding header of the request
+        :type asset: dict
+        :type accept_encoding: str
+        :return: The content coding, None to send the file as it is
+        :rtype: str
+        """
+        accepted = set()
+        for coding in accept_encoding.split(','):
+            coding, _, parameter = coding.partition(';')
+            name, _, quality = parameter.partition('=')
+            try:
+                if name.strip() == 'q' and float(quality) <= 0:
+                    continue
+            except ValueError:
+                continue
+            accepted.add(coding.strip().lower())
+
+        for encoding in ("br", "gzip"):
+            if encoding in asset["variants"] and encoding in accepted:
+                return encoding
+        return None
+
+
+class AssetHandler(tornado.web.StaticFileHandler):
+    """
+        Handles request to /static/, fingerprinted URLs of StaticAssets are
+        cached by clients as immutable, compressed variants served from memory
+    """
+    fingerprinted = False
+
+    @classmethod
+    def make_static_url(cls, settings, path, include_version=True):
+        asset = StaticAssets.assets.get(path)
+        if asset is None or not include_version:
+            return super(AssetHandler, cls).make_static_url(settings, path, include_version)
+        return settings.get('static_url_prefix', '/static/') + asset["url"]
+
+    def parse_url_path(self, url_path):
+        name = StaticAssets.urls.get(url_path)
+        self.fingerprinted = name is not None
+        return super(AssetHandler, self).parse_url_path(name or url_path)
+
+    def get_cache_time(self, path, modified, mime_type):
+        if self.fingerprinted:
+            return self.CACHE_MAX_AGE
+        return super(AssetHandler, self).get_cache_time(path, modified, mime_type)
+
+    def set_extra_headers(self, path):
+        if self.fingerprinted:
+            self.set_header("Cache-Control", "public, max-age=%d, immutable" % self.CACHE_MAX_AGE)
+        asset = StaticAssets.assets.get(self.path.replace(os.path.sep, "/"))
+        if asset is not None and asset["variants"]:
+            self.set_header("Vary", "Accept-Encoding")
+
+    @tornado.gen.coroutine
+    def get(self, path, include_body=True):
+        self.path = self.parse_url_path(path)
+        asset = StaticAssets.assets.get(self.path.replace(os.path.sep, "/"))
+        encoding = None
+        if asset is not None:
+            encoding = StaticAssets.encoding(asset, self.request.headers.get("Accept-Encoding", ""))
+
+        if encoding is None:
+            yield super(AssetHandler, self).get(path, include_body)
+            return
+
+        body = asset["variants"][encoding]
+        self.set_header("Content-Type", asset["type"])
+        self.set_header("Etag", '"%s-%s"' % (asset["fingerprint"], encoding))
+        self.set_extra_headers(self.path)
+        if not self.fingerprinted:
+            self.set_header("Cache-Control", "no-cache")
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        self.set_header("Content-Encoding", encoding)
+        self.set_header("Content-Length", len(body))
+        if include_body:
+            self.write(body)
+
+
+class DoorSocketHandler(tornado.websocket.WebSocketHandler):
+    """
+        Handles the websocket of a door at /door and /door/{door_id}
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(DoorSocketHandler, self).__init__(*args, **kwargs)
+        self.pending = 0
+        self.door = None
+        self.last_seen = None
+
+    def prepare(self):
+        self.door = DoorRegistry.get(self.path_kwargs.get('door_id'))
+        if self.door is None:
+            raise tornado.web.HTTPError(404)
+        if not DoorRegistry.admit():
+            raise tornado.web.HTTPError(503)
+
+    def get_compression_options(self):
+        # Non-None enables compression, the BroadcastHub decides per message.
+        return {}
+
+    def open(self, door_id=None):
+        logging.info("Client IP: %s connected to %s.", self.request.remote_ip, self.door.id,
+                     extra={"event": "client_connected", "door": self.door.id, "remote_ip": self.request.remote_ip})
+        self.last_seen = self.door.hub.io_loop.time()
+        self.door.hub.add(self)
+        self.door.hub.send(self, tornado.escape.json_encode(self.door.update_message()))
+
+        # a reconnecting client gets the messages it missed
+        try:
+            seq = int(self.get_argument('seq', ''))
+        except ValueError:
+            return
+        missed = self.door.missed(self.get_argument('epoch', None), seq)
+        if missed:
+            self.door.hub.send(self, '{"action": "replay", "events": [%s]}' % ", ".join(missed))
+
+    def on_close(self):
+        logging.info("Client IP: %s disconnected.", self.request.remote_ip,
+                     extra={"event": "client_disconnected", "remote_ip": self.request.remote_ip})
+        self.door.hub.remove(self)
+
+    def on_pong(self, data):
+        self.last_seen = self.door.hub.io_loop.time()
+
+    def on_message(self, message):
+        self.last_seen = self.door.hub.io_loop.time()
+        logging.info("got message %s from %s", message, self.request.remote_ip,
+                     extra={"event": "client_message", "door": self.door.id, "remote_ip": self.request.remote_ip})
+        payload = tornado.escape.json_decode(message)
+
+        if payload['action'] == "open":
+            self.door.handle_open(payload.get('secret'))
+        elif payload['action'] == "simulate_ring":
+            if SIMULATION:
+                self.door.ring_pressed()
+
+
+class Door(object):
+    """
+    A door driven by this agent, with its own GPIO pins, ring session,
+    websocket clients and state. All doors share the IOLoop, handlers and
+    background services of the agent.
+    """
+
+    def __init__(self, door_id, settings):
+        """
+        Door initialisation
+
+        :param door_id: The id of the door in URLs and apikeys.json
+        :param settings: The door settings, as built by the config snapshot
+        :type door_id: str
+        :type settings: FrozenDict
+        """
+        self.id = door_id
+        self.settings = settings
+        self.state = DoorState()
+        self.hub = None
+        self.actuator = None
+        self.device = None
+        self.ring = None
+        self.ring_input = None
+        self.session = None
+        self.io_loop = None
+        self.epoch = "%x" % int(time.time() * 1000)
+        self.sequence = 0
+        self.replay = collections.deque(maxlen=Application.config('webui.replay.size'))
+        self._lock = threading.Lock()
+
+    def config(self, key):
+        """
+        Returns a door setting of the current config snapshot, or the one
+        the door was started with if the door was removed from it since.
+
+        :param key: One of Settings.DOOR_KEYS
+        :type key: str
+        """
+        return Application.config().doors.get(self.id, self.settings)[key]
+
+    def start(self, io_loop):
+        """
+        Sets up the broadcast hub, the actuator, the ring input and the GPIO devices of the door.
+
+        :param io_loop: The IOLoop the door is driven from
+        :type io_loop: tornado.ioloop.IOLoop
+        """
+        self.io_loop = io_loop
+        self.hub = BroadcastHub(max_pending=Application.config('webui.client.pending'),
+                                compress_min=Application.config('webui.compression.min'),
+                                ping_interval=Application.config('webui.ping.interval'),
+                                idle_timeout=Application.config('webui.idle.timeout'))
+        self.hub.start(io_loop)
+        self.actuator = DoorActuator(pulse=self.settings['door.open.pulse'])
+        self.actuator.start(io_loop)
+        self.ring_input = RingInput(self.handle_ring, self.handle_presses,
+                                    debounce=Application.config('ring.debounce'),
+                                    window=Application.config('ring.burst.window'),
+                                    limit=Application.config('ring.burst.limit'),
+                                    io_loop=io_loop)
+
+        try:
+            self.device = DigitalOutputDevice(self.settings['gpio.open'])
+            self.actuator.device = self.device
+
+            self.ring = Button(self.settings['gpio.ring'], hold_time=0.25)
+            self.ring.when_pressed = self.ring_pressed
+        except NameError:
+            pass
+
+    def path(self, resource=""):
+        """
+        The URL path of a resource of this door, e.g. path("/slack/" + secret).
+
+        :param resource: The resource of the default door
+        :type resource: str
+        :rtype: str
+        """
+        if self.id == DoorRegistry.DEFAULT:
+            return resource or "/"
+        return "/doors/%s%s" % (self.id, resource)
+
+    def socket_path(self):
+        """
+        The URL path of the websocket of this door.
+
+        :rtype: str
+        """
+        if self.id == DoorRegistry.DEFAULT:
+            return "/door"
+        return "/door/%s" % self.id
+
+    def update_message(self):
+        return {
+            "action": "update",
+            "last_open": DoorState.format(self.state.last_open),
+            "last_ring": DoorState.format(self.state.last_ring),
+            "epoch": self.epoch,
+            "seq": self.sequence,
+            "timestamp": "%s" % time.time()
+        }
+
+    def missed(self, epoch, seq):
+        """
+        Returns the messages sent after a sequence number that are still in
+        the replay buffer.
+
+        :param epoch: The epoch the sequence number belongs to
+        :param seq: The sequence number of the last message received
+        :type epoch: str
+        :type seq: int
+        :return: The JSON encoded messages, oldest first
+        :rtype: list
+        """
+        if epoch != self.epoch:
+            return []
+        with self._lock:
+            return [message for message_seq, message in self.replay if message_seq > seq]
+
+    def ring_pressed(self):
+        """
+           Hands a press of the ring button, e.g. detected on gpiozero's thread,
+           to the ring input. Safe to call from any thread.
+        """
+        self.ring_input.press()
+
+    def handle_ring(self, pressed=None):
+        """
+           Handle a ring event by enabling the _Open Door_ button for a given time.
+           Must run on the IOLoop.
+
+           :param pressed: When the ring was detected, defaults to now
+           :type pressed: float
+        """
+        timestamp = time.time()
+        if pressed is None:
+            pressed = timestamp
+
+        if self.state.last_open is not None and timestamp - self.state.last_open < 1.0:
+            logging.info("RING at %s too close to last open", self.id, extra={"event": "ring_ignored", "door": self.id})
+            return
+
+        logging.info("handling RING at %s", self.id, extra={"event": "ring", "door": self.id})
+        self.state.last_ring = timestamp
+        Metrics.rings.inc()
+        EventLog.append(EventLog.RING, timestamp, self.id)
+        StatePersister.mark_dirty()
+
+        if self.session is None:
+            # 1st ring: start a session enabling open button for door.open.timeout seconds
+            self.session = RingSession(timeout=self.config('door.open.timeout'),
+                                       on_expire=self.handle_timeout,
+                                       io_loop=self.io_loop)
+        else:
+            # Follow-up ring: extend the time of the running session
+            self.session.extend()
+
+        secret = self.session.secret
+        payload = {
+            "action": "ring",
+            "secret": "%s" % secret,
+            "timestamp": "%s" % timestamp
+        }
+        self.send_update(payload, lambda: Metrics.ring_latency.observe(time.time() - pressed))
+
+        if Application.has_valid_slack_config():
+            open_link = "%s%s" % (Application.config('slack.baseurl'), self.path("/slack/%s" % secret))
+            SlackHandler.send('@here DING DONG ... RING RING ... KNOCK KNOCK', open_link, ring=True,
+                              username=self.config('door.name'))
+
+    def handle_presses(self, pressed, presses):
+        """
+           Tells the clients how often the ring button was pressed in a burst
+           after its first press rang. Must run on the IOLoop.
+
+           :param pressed: When the first press of the burst was detected
+           :param presses: Number of presses of the burst
+           :type pressed: float
+           :type presses: int
+        """
+        if self.session is None:
+            # the ring was ignored or the door opened meanwhile
+            return
+
+        logging.info("RING at %s pressed %d times", self.id, presses,
+                     extra={"event": "ring_presses", "door": self.id, "presses": presses})
+        self.send_update({
+            "action": "presses",
+            "presses": presses,
+            "timestamp": "%s" % pressed
+        })
+
+    def handle_open(self, secret=None):
+        """
+           Handle a open event by disabling the _Open Door_ button and flipping the GPIO open pin.
+           Must run on the IOLoop.
+
+           :param secret: The secret of the running ring session
+           :type secret: str
+           :return: True if the door was opened, False otherwise
+           :rtype: bool
+        """
+        session = self.session
+        if session is None:
+            logging.info("ignoring OPEN of %s without prior ring", self.id,
+                         extra={"event": "open_ignored", "door": self.id})
+            return False
+
+        if not session.open(secret):
+            logging.info("ignoring OPEN of %s without correct ring secret", self.id,
+                         extra={"event": "open_ignored", "door": self.id})
+            return False
+
+        logging.info("handling OPEN of %s", self.id, extra={"event": "open", "door": self.id})
+        self.session = None
+        Metrics.opens.inc()
+
+        timestamp = time.time()
+        self.state.last_open = timestamp
+        EventLog.append(EventLog.OPEN, timestamp, self.id)
+        StatePersister.mark_dirty()
+        self.actuator.trigger()
+
+        payload = {
+            "action": "open",
+            "timestamp": "%s" % timestamp
+        }
+        self.send_update(payload)
+
+        if Application.has_valid_slack_config():
+            SlackHandler.send('DoorPI has opened the door.', username=self.config('door.name'))
+
+        return True
+
+    @tornado.gen.coroutine
+    def handle_api_open(self, apikey):
+        """
+           Handle an open by api-key by flipping the GPIO open pin if the key is valid.
+           Must run on the IOLoop.
+
+           :param apikey: The apikey
+           :type apikey: str
+           :return: A future resolving to True if the door was opened, False otherwise
+        """
+        if not (yield Application.valid_apikey(apikey, self.id)):
+            raise tornado.gen.Return(False)
+
+        self.state.last_open = time.time()
+        StatePersister.mark_dirty()
+        EventLog.append(EventLog.API_OPEN, self.state.last_open, self.id)
+        self.actuator.trigger()
+
+        if EventBus.server is not None:
+            EventBus.server.publish(self)
+        raise tornado.gen.Return(True)
+
+    @tornado.gen.coroutine
+    def request_open(self, secret=None):
+        """
+           Opens the door on behalf of a request handler, see handle_open(secret).
+
+           :return: A future resolving to True if the door was opened
+        """
+        raise tornado.gen.Return(self.handle_open(secret))
+
+    @tornado.gen.coroutine
+    def request_api_open(self, apikey):
+        """
+           Opens the door on behalf of a request handler, see handle_api_open(apikey).
+
+           :return: A future resolving to True if the door was opened
+        """
+        opened = yield self.handle_api_open(apikey)
+        raise tornado.gen.Return(opened)
+
+    def handle_timeout(self, session):
+        """
+           Handle the expiry of a ring session by disabling the _Open Door_ button
+        """
+        if self.session is session:
+            self.session = None
+
+        logging.info("ring session of %s timed out", self.id, extra={"event": "timeout", "door": self.id})
+        EventLog.append(EventLog.TIMEOUT, detail=self.id)
+        self.send_update({"action": "timeout"})
+
+    def send_update(self, message, callback=None):
+        """
+           Broadcasts a message to all clients of the door, numbered with the next
+           sequence number and kept in the replay buffer. Safe to call from any thread.
+
+           :param message: The message
+           :param callback: Called on the IOLoop once the message is handed to all clients
+           :type message: dict
+           :type callback: callable
+        """
+        with self._lock:
+            self.sequence += 1
+            seq = self.sequence
+            message = tornado.escape.json_encode(dict(message, seq=seq))
+            self.replay.append((seq, message))
+
+        self.hub.publish(message, callback)
+        if EventBus.server is not None:
+            self.io_loop.add_callback(EventBus.server.publish, self, message, seq)
+
+
+class RemoteDoor(Door):
+    """
+    A door as seen by a web worker process. Rings and opens are requested
+    from the hardware process over the EventBus, the door state and the
+    messages to the clients of the door come back from there.
+    """
+
+    def start(self, io_loop):
+        """
+        Sets up the broadcast hub of the door, the GPIO devices are left to
+        the hardware process.
+
+        :param io_loop: The IOLoop the door is driven from
+        :type io_loop: tornado.ioloop.IOLoop
+        """
+        self.io_loop = io_loop
+        self.hub = BroadcastHub(max_pending=Application.config('webui.client.pending'),
+                                compress_min=Application.config('webui.compression.min'),
+                                ping_interval=Application.config('webui.ping.interval'),
+                                idle_timeout=Application.config('webui.idle.timeout'))
+        self.hub.start(io_loop)
+
+    def apply(self, event):
+        """
+        Applies an event of the hardware process. Must run on the IOLoop.
+
+        :param event: The event as sent by EventBus.publish(door, message)
+        :type event: dict
+        """
+        self.state.last_ring, self.state.last_open = event["state"]
+        seq = event.get("seq")
+        with self._lock:
+            if event["epoch"] != self.epoch:
+                self.epoch = event["epoch"]
+                self.sequence = 0
+                self.replay.clear()
+            if seq is None or seq <= self.sequence:
+                return
+            self.sequence = seq
+            self.replay.append((seq, event["message"]))
+        self.hub.publish(event["message"])
+
+    def ring_pressed(self):
+        return EventBus.client.request(self.id, "ring")
+
+    def handle_open(self, secret=None):
+        return EventBus.client.request(self.id, "open", secret=secret)
+
+    def request_open(self, secret=None):
+        return self.handle_open(secret)
+
+    def request_api_open(self, apikey):
+        return EventBus.client.request(self.id, "api_open", apikey=apikey)
+
+
+class DoorRegistry(object):
+    """
+    The doors driven by this agent from a single IOLoop, by door id. The
+    door of the top-level settings has the id "default", further doors are
+    configured at "doors" in doorpi.json.
+    """
+    DEFAULT = "default"
+
+    doors = collections.OrderedDict()
+    io_loop = None
+
+    @classmethod
+    def setup(cls, io_loop):
+        """
+        Starts the doors of the current config snapshot that are not yet running.
+
+        :param io_loop: The IOLoop the doors are driven from
+        :type io_loop: tornado.ioloop.IOLoop
+        """
+        if DoorRegistry.io_loop is None:
+            DoorRegistry.io_loop = io_loop
+
+        door_class = RemoteDoor if WORKER else Door
+        for door_id, settings in Application.config().doors.items():
+            if door_id not in DoorRegistry.doors:
+                door = door_class(door_id, settings)
+                door.start(DoorRegistry.io_loop)
+                DoorRegistry.doors[door_id] = door
+
+    @classmethod
+    def get(cls, door_id=None):
+        """
+        Returns a door by its id.
+
+        :param door_id: The door id, defaults to the default door
+        :type door_id: str
+        :return: The door, None if there is no such door
+        :rtype: Door
+        """
+        return DoorRegistry.doors.get(door_id or DoorRegistry.DEFAULT)
+
+    @classmethod
+    def clients(cls):
+        """
+        :return: The number of websocket and event stream clients of all doors
+        :rtype: int
+        """
+        return sum(len(door.hub.clients) + len(door.hub.streams) for door in DoorRegistry.doors.values())
+
+    @classmethod
+    def admit(cls):
+        """
+        Checks if another websocket or event stream client may connect,
+        counting those turned away.
+
+        :return: False if webui.clients.max clients are connected, True otherwise
+        :rtype: bool
+        """
+        limit = Application.config('webui.clients.max')
+        if limit > 0 and DoorRegistry.clients() >= limit:
+            Metrics.clients_rejected.inc()
+            return False
+        return True
+
+
+class BroadcastHub(object):
+    """
+    Fans messages out to websocket clients. Each message is serialized once
+    and written on the IOLoop without waiting for any client to receive it.
+    A client with more than max_pending messages not yet flushed to its
+    socket is disconnected.
+
+    The websocket frames are built by the hub and shared by all clients: a
+    message of at least compress_min bytes is deflated once, without context
+    takeover, for all clients that negotiated permessage-deflate, smaller
+    messages are sent uncompressed. All messages to clients must therefore
+    go through the hub, never through write_message.
+
+    Server-Sent Events streams get the same messages, the event is built
+    once for all streams.
+
+    Every ping_interval seconds a single timer pings all websocket clients,
+    a client that answered neither a ping nor sent a message for
+    idle_timeout seconds is gone without a close, e.g. a phone that left the
+    Wi-Fi, and its connection is dropped. The streams get a comment line
+    instead, so proxies don't close them while they are quiet.
+    """
+    FIN, RSV1, TEXT = 0x80, 0x40, 0x1
+    KEEPALIVE = ":\n\n"
+
+    def __init__(self, max_pending=32, compress_min=256, compression_level=6, ping_interval=0, idle_timeout=0):
+        """
+        BroadcastHub initialisation
+
+        :param max_pending: Maximum unflushed messages per client
+        :param compress_min: Minimum message size in bytes to be compressed, negative to never compress
+        :param compression_level: zlib compression level
+        :param ping_interval: Seconds between pings to the clients, 0 to not ping
+        :param idle_timeout: Seconds without a pong or message after which a client is dropped, 0 to keep it
+        :type max_pending: int
+        :type compress_min: int
+        :type compression_level: int
+        :type ping_interval: float
+        :type idle_timeout: float
+        """
+        self.max_pending = max_pending
+        self.compress_min = compress_min
+        self.compression_level = compression_level
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.clients = set()
+        self.streams = set()
+        self.io_loop = None
+        self.dropped = 0
+        self.compressed = 0
+        self.reaped = 0
+        self._heartbeat = None
+
+    def start(self, io_loop=None):
+        """
+        Binds the hub to the IOLoop messages are sent on and starts pinging the clients.
+
+        :param io_loop: The IOLoop, defaults to the current one
+        :type io_loop: tornado.ioloop.IOLoop
+        """
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        if self.ping_interval > 0:
+            self._heartbeat = tornado.ioloop.PeriodicCallback(self._beat, self.ping_interval * 1000)
+            self._heartbeat.start()
+
+    def add(self, client):
+        self.clients.add(client)
+
+    def add_stream(self, stream):
+        self.streams.add(stream)
+
+    def remove(self, client):
+        self.clients.discard(client)
+        self.streams.discard(client)
+
+    def publish(self, message, callback=None):
+        """
+        Queues a message for all clients. Safe to call from any thread.
+
+        :param message: The message, either a dict or already JSON encoded
+        :param callback: Called on the IOLoop once the message is handed to all clients
+        :type message: dict, str
+        :type callback: callable
+        """
+        if not isinstance(message, basestring):
+            message = tornado.escape.json_encode(message)
+        self.io_loop.add_callback(self._fan_out, tornado.escape.utf8(message), callback)
+
+    def _fan_out(self, message, callback=None):
+        logging.info("sending message to %d clients", len(self.clients) + len(self.streams))
+        frames = {}
+        for client in list(self.clients):
+            self.send(client, message, frames)
+        if self.streams:
+            event = BroadcastHub.event(message)
+            for stream in list(self.streams):
+                self.send_event(stream, message, event)
+        if callback is not None:
+            callback()
+
+    def send(self, client, message, frames=None):
+        """
+        Writes a message to a single client, disconnecting it if it fell
+        too far behind. Must run on the IOLoop.
+
+        :param client: The client
+        :param message: The JSON encoded message
+        :param frames: Frames of this message already built for other clients
+        :type client: DoorSocketHandler
+        :type message: str
+        :type frames: dict
+        """
+        connection = client.ws_connection
+        if connection is None or connection.stream.closed():
+            self.remove(client)
+            return
+
+        if client.pending >= self.max_pending:
+            logging.warn("disconnecting Client IP: %s, %d messages behind",
+                         client.request.remote_ip, client.pending)
+            self.dropped += 1
+            self.remove(client)
+            client.close()
+            return
+
+        if frames is None:
+            frames = {}
+        wbits = self._wbits(connection, message)
+        if wbits not in frames:
+            frames[wbits] = self._frame(tornado.escape.utf8(message), wbits)
+
+        try:
+            future = connection.stream.write(frames[wbits])
+        except tornado.iostream.StreamClosedError:
+            self.remove(client)
+            return
+
+        client.pending += 1
+        future.add_done_callback(lambda f: self._flushed(client, f))
+
+    def send_event(self, stream, message, event=None):
+        """
+        Writes a message to a single Server-Sent Events stream, closing it if
+        it fell too far behind. Must run on the IOLoop.
+
+        :param stream: The stream
+        :param message: The JSON encoded message, None if event is given
+        :param event: The event of this message already built for other streams
+        :type stream: EventStreamHandler
+        :type message: str
+        :type event: str
+        """
+        if stream.pending >= self.max_pending:
+            logging.warn("disconnecting Client IP: %s, %d messages behind",
+                         stream.request.remote_ip, stream.pending)
+            self.dropped += 1
+            self.remove(stream)
+            stream.request.connection.close()
+            return
+
+        try:
+            stream.write(event or BroadcastHub.event(message))
+            future = stream.flush()
+        except (tornado.iostream.StreamClosedError, RuntimeError):
+            self.remove(stream)
+            return
+
+        stream.pending += 1
+        future.add_done_callback(lambda f: self._flushed(stream, f))
+
+    def reap(self, client):
+        """
+        Drops the connection of an unresponsive client without a closing
+        handshake. Must run on the IOLoop.
+
+        :param client: The client
+        :type client: DoorSocketHandler
+        """
+        logging.info("reaping Client IP: %s, silent for %.0fs", client.request.remote_ip,
+                     self.io_loop.time() - client.last_seen,
+                     extra={"event": "client_reaped", "remote_ip": client.request.remote_ip})
+        self.reaped += 1
+        Metrics.clients_reaped.inc()
+        self.remove(client)
+        if client.ws_connection is not None:
+            client.ws_connection.stream.close()
+
+    def _beat(self):
+        now = self.io_loop.time()
+        for client in list(self.clients):
+            if self.idle_timeout > 0 and now - client.last_seen > self.idle_timeout:
+                self.reap(client)
+                continue
+            try:
+                client.ping(b"")
+            except (tornado.websocket.WebSocketClosedError, tornado.iostream.StreamClosedError):
+                self.remove(client)
+        for stream in list(self.streams):
+            self.send_event(stream, None, BroadcastHub.KEEPALIVE)
+
+    @classmethod
+    def event(cls, message):
+        # JSON encoded messages are single lines and need no escaping
+        return "data: %s\n\n" % tornado.escape.utf8(message)
+
+    def _wbits(self, connection, message):
+        """
+        The deflate window the message is compressed with for a connection,
+        0 to send it uncompressed.
+        """
+        compressor = getattr(connection, '_compressor', None)
+        if compressor is None or self.compress_min < 0 or len(message) < self.compress_min:
+            return 0
+        # zlib can't produce raw deflate streams with a 256 byte window
+        if compressor._max_wbits < 9:
+            return 0
+        return compressor._max_wbits
+
+    def _frame(self, data, wbits):
+        flags = 0
+        if wbits:
+            compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -wbits)
+            data = (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+            flags = BroadcastHub.RSV1
+            self.compressed += 1
+
+        length = len(data)
+        if length < 126:
+            header = struct.pack("!BB", BroadcastHub.FIN | flags | BroadcastHub.TEXT, length)
+        elif length <= 0xFFFF:
+            header = struct.pack("!BBH", BroadcastHub.FIN | flags | BroadcastHub.TEXT, 126, length)
+        else:
+            header = struct.pack("!BBQ", BroadcastHub.FIN | flags | BroadcastHub.TEXT, 127, length)
+        return header + data
+
+    def _flushed(self, client, future):
+        client.pending -= 1
+        if future.exception() is not None:
+            self.remove(client)
+
+
+class DoorActuator(object):
+    """
+    Drives the door-open GPIO pulse with IOLoop timers instead of sleeping
+    on the loop. Open requests arriving while a pulse is in progress are
+    coalesced into that pulse.
+    """
+
+    def __init__(self, device=None, pulse=0.5):
+        """
+        DoorActuator initialisation
+
+        :param device: The output device flipping the door-open relay
+        :param pulse: Pulse length in seconds
+        :type device: DigitalOutputDevice
+        :type pulse: float
+        """
+        self.device = device
+        self.pulse = pulse
+        self.io_loop = None
+        self.pulses = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._pulsing = False
+
+    def start(self, io_loop=None):
+        """
+        Binds the actuator to the IOLoop its timers run on.
+
+        :param io_loop: The IOLoop, defaults to the current one
+        :type io_loop: tornado.ioloop.IOLoop
+        """
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+
+    def trigger(self):
+        """
+        Requests a door pulse. Safe to call from any thread, returns immediately.
+
+        :return: True if a new pulse was scheduled, False if coalesced into a running one
+        :rtype: bool
+        """
+        with self._lock:
+            if self._pulsing:
+                self.coalesced += 1
+                logging.info("coalescing OPEN into running pulse")
+                return False
+            self._pulsing = True
+            self.pulses += 1
+
+        self.io_loop.add_callback(self._pulse_on)
+        return True
+
+    def _pulse_on(self):
+        self._set(True)
+        self.io_loop.call_later(self.pulse, self._pulse_off, self.io_loop.time())
+
+    def _pulse_off(self, started):
+        self._set(False)
+        Metrics.pulse_duration.observe(self.io_loop.time() - started)
+        with self._lock:
+            self._pulsing = False
+
+    def _set(self, state):
+        try:
+            if state:
+                self.device.on()
+            else:
+                self.device.off()
+        except AttributeError, e:
+            if SIMULATION:
+                pass
             else:
-                # check if is Mo-Fr
-                if datetime.datetime.today().weekday() > 4:
-                    return False
+                logging.fatal("%s :: DoorActuator.device not initialized.", e)
 
-                # check 07:00-18:00
-                hour = datetime.datetime.today().hour
-                if hour < 7 or hour > 18:
-                    return False
 
-                if api_key_type == "restricted":
-                    return True
+class RingInput(object):
+    """
+    Turns presses of a ring button into rings. A press following the last
+    accepted one within the debounce time is contact bounce and dropped.
+    The first press of a burst rings at once, presses following it within
+    the burst window are only counted and their number is handed on once the
+    burst is over or has lasted the burst limit, so a bell pressed over and
+    over or a chattering contact costs one secret, broadcast and Slack
+    message instead of one per edge.
+    """
 
-                # check if date is in range
-                if datetime.datetime.strptime(Application._apikeys.get(apikey).get("from"), "%d.%m.%Y").date() \
-                        <= datetime.datetime.today().date() \
-                        <= datetime.datetime.strptime(Application._apikeys.get(apikey).get("till"), "%d.%m.%Y").date():
+    def __init__(self, on_ring, on_presses=None, debounce=0.05, window=0.3, limit=2.0, io_loop=None):
+        """
+        RingInput initialisation
+
+        :param on_ring: Called on the IOLoop with the time of the first press of a burst
+        :param on_presses: Called on the IOLoop with the time of the first press and the number of presses
+                           of a burst that had more than one press
+        :param debounce: Seconds after a press in which further presses are bounce
+        :param window: Seconds after a press in which another press belongs to the same burst, 0 to not coalesce
+        :param limit: Seconds after the first press of a burst another press rings again at the earliest
+        :param io_loop: The IOLoop, defaults to the current one
+        :type on_ring: callable
+        :type on_presses: callable
+        :type debounce: float
+        :type window: float
+        :type limit: float
+        :type io_loop: tornado.ioloop.IOLoop
+        """
+        self.on_ring = on_ring
+        self.on_presses = on_presses
+        self.debounce = debounce
+        self.window = window
+        self.limit = limit
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.last = None
+        self.first = None
+        self.presses = 0
+        self._timer = None
+
+    def press(self, timestamp=None):
+        """
+        Records a press. Safe to call from any thread, returns immediately.
 
-                    if api_key_type == "limited":
-                        return True
+        :param timestamp: When the button was pressed, defaults to now
+        :type timestamp: float
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self.io_loop.add_callback(self._press, timestamp)
 
-                    elif api_key_type == "once":
-                        try:
-                            with open('usedkeys.json', 'r') as keys_file:
-                                used = json.load(keys_file)
-                        except IOError:
-                            used = {}
+    def flush(self):
+        """
+        Ends the running burst, if any, handing on its number of presses. Must
+        run on the IOLoop.
+        """
+        if self._timer is not None:
+            self.io_loop.remove_timeout(self._timer)
+            self._timer = None
+        if self.first is None:
+            return
 
-                        if apikey in used:
-                            logging.warn("one-time key already used.")
-                            return False
+        first, presses = self.first, self.presses
+        self.first = None
+        self.presses = 0
+        if presses > 1 and self.on_presses is not None:
+            self.on_presses(first, presses)
 
-                        used.update({"%s" % apikey: "%s" % time.time()})
+    def _press(self, timestamp):
+        if self.last is not None and timestamp - self.last < self.debounce:
+            Metrics.ring_bounces.inc()
+            return
+        Metrics.ring_presses.inc()
+
+        # presses are timestamped where they are detected, a burst that
+        # ended before this press is over even if its timer is late
+        if self.first is not None and (timestamp - self.last >= self.window or
+                                       timestamp - self.first >= self.limit):
+            self.flush()
+
+        self.last = timestamp
+        self.presses += 1
+        if self.first is None:
+            self.first = timestamp
+            self.on_ring(timestamp)
+
+        if self.window <= 0:
+            self.flush()
+            return
 
-                        with open('usedkeys.json', 'w') as keys_file:
-                            json.dump(used, keys_file)
+        if self._timer is not None:
+            self.io_loop.remove_timeout(self._timer)
+        deadline = min(timestamp + self.window, self.first + self.limit)
+        self._timer = self.io_loop.call_later(max(0.0, deadline - time.time()), self.flush)
 
-                        logging.warn("one-time key invalidated.")
-                        return True
 
-        return False
+class RingSession(object):
+    """
+    A ring session is started by the first ring and holds the secret needed
+    to open the door until its deadline. The deadline is a single IOLoop
+    timeout, re-armed when a follow-up ring extends the session. All methods
+    must run on the IOLoop.
+    """
+    RINGING, OPENED, EXPIRED = range(3)
 
+    def __init__(self, timeout=60, on_expire=None, io_loop=None):
+        """
+        RingSession initialisation
 
-    @classmethod
-    def config(cls, key=None):
+        :param timeout: Timeout in seconds
+        :param on_expire: Called with the session when the deadline passes
+        :param io_loop: The IOLoop, defaults to the current one
+        :type timeout: int
+        :type on_expire: callable
+        :type io_loop: tornado.ioloop.IOLoop
         """
-        Returns the value for a given key or when no key is given or
-        key is not found, the whole config
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.timeout = timeout
+        self.on_expire = on_expire
+        self.secret = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(2)) + \
+            "%s" % calendar.timegm(time.gmtime())
+        self.state = RingSession.RINGING
+        self.deadline = self.io_loop.time() + timeout
+        self._timer = self.io_loop.call_at(self.deadline, self._expire)
 
-        :param key: The key to lookup
-        :return: The value or the config.
-        :rtype: dict, str
+    def extend(self):
         """
-        try:
-            return Application._config[key]
-        except KeyError:
-            return Application._config
+        Extends the deadline by the timeout
+        """
+        if self.state != RingSession.RINGING:
+            return
+        self.deadline += self.timeout
+        self.io_loop.remove_timeout(self._timer)
+        self._timer = self.io_loop.call_at(self.deadline, self._expire)
 
-    @classmethod
-    def __config__(cls, _config):
+    def open(self, secret):
         """
-        Check essential config settings, use default if unset
+        Ends the session as opened if the secret matches.
 
-        :param _config: dictionary with the application configuration.
-        :type _config: dict
+        :param secret: The secret given by the opener
+        :type secret: str
+        :return: True if the session is now opened, False otherwise
+        :rtype: bool
         """
-        defaults = (("webui.port", "8080"),
-                    ("webui.cookie.secret", "__TODO:_GENERATE_YOUR_OWN_RANDOM_VALUE__"),
-                    ("door.name", "Door"),
-                    ("door.open.timeout", "60"),
-                    ("gpio.ring", "18"),
-                    ("gpio.open", "23"))
-        for setting, default in defaults:
-            try:
-                _config[setting]
-            except KeyError:
-                _config[setting] = default
+        if self.state != RingSession.RINGING or secret != self.secret:
+            return False
+        self.state = RingSession.OPENED
+        self.io_loop.remove_timeout(self._timer)
+        return True
+
+    def _expire(self):
+        if self.state != RingSession.RINGING:
+            return
+        self.state = RingSession.EXPIRED
+        if self.on_expire is not None:
+            self.on_expire(self)
 
-        # Empty last ring and open, make persistent maybe later
-        _config['_door.last.ring'] = ''
-        _config['_door.last.open'] = ''
 
-        if os.path.isfile('local_settings.json'):
-            _config.update(load('local_settings.json'))
+class StatePersister(object):
+    """
+    Write-behind checkpointing of the door state. Changes only mark the state
+    dirty, all changes within the flush window are written together by one
+    atomic replace of the state file on a worker thread, bounding the number
+    of writes to the SD card.
+    """
+    KEYS = (('last.open', 'last_open'), ('last.ring', 'last_ring'))
 
-        return _config
+    io_loop = None
+    filename = None
+    window = None
+    writes = 0
+    generation = 0
+    _written = 0
+    _timer = None
+    _lock = threading.Lock()
 
     @classmethod
-    def has_valid_slack_config(cls, _config):
+    def setup(cls, io_loop, filename, window=10.0):
         """
-        Check essential config settings for Slack
+        Sets up the persister.
+
+        :param io_loop: The IOLoop flushes are scheduled on
+        :param filename: The state file
+        :param window: Seconds changes are collected before they are written
+        :type io_loop: tornado.ioloop.IOLoop
+        :type filename: str
+        :type window: float
+        """
+        StatePersister.io_loop = io_loop
+        StatePersister.filename = filename
+        StatePersister.window = window
 
-        :param _config:
-        :return: True is setup is valid, False otherwise
+    @classmethod
+    def restore(cls, filename):
         """
-        if Application._slack is None:
-            Application._slack = False
-            try:
-                if not validators.url(_config["slack.webhook"]):
-                    logging.warn("slack.webhook doesn't validate as URL")
+        Restores the state saved in the state file into the DoorState of
+        each door in the DoorRegistry.
 
-                if not validators.url(_config["slack.baseurl"]):
-                    logging.warn("slack.baseurl  doesn't validate as URL")
+        :param filename: The state file
+        :type filename: str
+        """
+        state = load(filename)
+        for door in DoorRegistry.doors.values():
+            for key, attribute in StatePersister.KEYS:
+                try:
+                    setattr(door.state, attribute, float(state[StatePersister.key(door, key)]))
+                except (KeyError, ValueError):
+                    pass
 
-                if _config["slack.baseurl"][-1] == '/':
-                    _config["slack.baseurl"] = _config["slack.baseurl"][0:-1]
-                    logging.info("removed trailing '/' from slack.baseurl")
+    @classmethod
+    def mark_dirty(cls):
+        """
+        Schedules a flush at the end of the flush window. Must run on the IOLoop.
+        """
+        if StatePersister.io_loop is not None and StatePersister._timer is None:
+            StatePersister._timer = StatePersister.io_loop.call_later(StatePersister.window,
+                                                                      StatePersister._flush_behind)
 
-                Application._slack = True
-            except KeyError:
-                Application._slack = False
-                logging.warn("Slack deactivated because minimum setup for Slack is incomplete or incorrect.")
+    @classmethod
+    def flush(cls):
+        """
+        Writes the state immediately, e.g. on shutdown.
+        """
+        if StatePersister._timer is not None:
+            StatePersister.io_loop.remove_timeout(StatePersister._timer)
+            StatePersister._timer = None
+        StatePersister.write(*StatePersister.snapshot())
 
-        return Application._slack
+    @classmethod
+    def snapshot(cls):
+        """
+        Takes the state to write. Must run on the IOLoop.
 
+        :return: The state and its generation, increasing with every snapshot
+        :rtype: tuple
+        """
+        StatePersister.generation += 1
+        return (dict((StatePersister.key(door, key), DoorState.format(getattr(door.state, attribute)))
+                     for door in DoorRegistry.doors.values() for key, attribute in StatePersister.KEYS),
+                StatePersister.generation)
 
-class ApiHandler(tornado.web.RequestHandler):
-    loader = None
+    @classmethod
+    def key(cls, door, key):
+        # the default door keeps the keys of the single door agent
+        if door.id == DoorRegistry.DEFAULT:
+            return "_door.%s" % key
+        return "_door.%s.%s" % (door.id, key)
 
-    def get(self, apikey=None):
+    @classmethod
+    def write(cls, state, generation):
         """
-        Handles get requests to /api/{apikey}
-
-        :param apikey: Everything in query_path behind /api/
-        :type apikey: str
+        Replaces the state file atomically by writing to a temporary file,
+        fsync'ing and renaming it. A snapshot older than the one written last,
+        e.g. a write-behind still queued on the executor when the state was
+        flushed on shutdown, is dropped.
+
+        :param state: The state to write
+        :param generation: The generation of the snapshot
+        :type state: dict
+        :type generation: int
         """
-
-        if Application.valid_apikey(apikey):
-            Application.config()['_door.last.open'] = "%s" % time.time()
-            time.sleep(0.5)
-            response = {'open': "%s" % time.time()}
-            logging.info("API open for %s (%s)" % (apikey, self.request.remote_ip))
+        filename = StatePersister.filename or 'doorpi_state.json'
+        temp = filename + '.tmp'
+        with StatePersister._lock:
+            if generation <= StatePersister._written:
+                return
             try:
-                DoorSocketHandler.door.on()
-                time.sleep(0.5)
-                DoorSocketHandler.door.off()
-            except AttributeError, e:
-                if SIMULATION:
-                    pass
-                else:
-                    logging.fatal(str(e) + " :: DoorSocketHandler.door not initialized.")
-        else:
-            response = {'error': "Unauthorized"}
-            self.set_status(401)
+                with open(temp, 'w') as state_file:
+                    json.dump(state, state_file)
+                    state_file.flush()
+                    os.fsync(state_file.fileno())
+                os.rename(temp, filename)
+                StatePersister._written = generation
+                fsync_directory(filename)
+                StatePersister.writes += 1
+            except (IOError, OSError), e:
+                logging.error("can't write %s: %s", filename, e)
 
-        self.set_header('Content-Type', 'text/json')
-        self.write(response)
-        self.finish()
+    @classmethod
+    @tornado.gen.coroutine
+    def _flush_behind(cls):
+        StatePersister._timer = None
+        yield StatePersister.io_loop.run_in_executor(None, StatePersister.write, *StatePersister.snapshot())
 
 
-class SlackHandler(tornado.web.RequestHandler):
-    loader = None
+class Profiler(object):
+    """
+    Low-overhead stack sampler with a detector for callbacks blocking the
+    IOLoop, toggled at runtime by SIGUSR2. While running, a background thread
+    samples the stacks of all threads every interval seconds and logs the
+    stack of the IOLoop thread whenever the loop didn't run for threshold
+    seconds. On stop the samples are written in the collapsed-stack format
+    read by flamegraph tools. At most max_stacks distinct stacks are kept,
+    samples of further stacks are counted as "[other]" of their thread.
+    """
+    active = None
 
-    def get(self, secret=None):
+    def __init__(self, io_loop, interval=0.05, threshold=0.1, filename='doorpi-profile.folded', max_stacks=1000):
         """
-        Handles get request to /slack/{secret}
-
-        :param secret: Everything in query_path behind /slack/
-        :type secret: str
+        Profiler initialisation
+
+        :param io_loop: The IOLoop to watch
+        :param interval: Seconds between two samples
+        :param threshold: Seconds the IOLoop may be blocked before its stack is logged
+        :param filename: File the collapsed stacks are written to
+        :param max_stacks: Maximum number of distinct stacks kept
+        :type io_loop: tornado.ioloop.IOLoop
+        :type interval: float
+        :type threshold: float
+        :type filename: str
+        :type max_stacks: int
         """
-        do_open = False
-        if secret == Application.config().pop('_door.open.secret', None):
-            payload = {
-                "action": "open",
-                "timestamp": "%s" % time.time()
-            }
-            DoorSocketHandler.send_update(tornado.escape.json_encode(payload))
-            do_open = True
-        else:
-            logging.info("ignoring OPEN without correct ring secret")
+        self.io_loop = io_loop
+        self.interval = interval
+        self.threshold = threshold
+        self.filename = filename
+        self.max_stacks = max_stacks
+        self.stacks = {}
+        self.samples = 0
+        self.stalls = 0
+        self._running = False
+        self._loop_thread = None
+        self._last_beat = None
+        self._thread = None
+
+    def start(self):
+        """
+        Starts sampling. Must run on the IOLoop.
+        """
+        self._loop_thread = threading.current_thread().ident
+        self._running = True
+        self._beat()
+        self._thread = threading.Thread(target=self._run, name="profiler")
+        self._thread.daemon = True
+        self._thread.start()
+        logging.warn("profiler started, sampling every %sms", self.interval * 1000)
 
-        self.render("slack.html", config=Application.config(), opened=do_open)
-        if do_open:
-            DoorSocketHandler.handle_open()
+    def stop(self):
+        """
+        Stops sampling, the samples are written by the sampling thread.
+        """
+        self._running = False
+
+    def _beat(self):
+        self._last_beat = time.time()
+        if self._running:
+            self.io_loop.call_later(self.threshold / 2, self._beat)
+
+    def _run(self):
+        stalled = False
+        while self._running:
+            frames = sys._current_frames()
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in frames.items():
+                if ident == self._thread.ident:
+                    continue
+                stack = Profiler.collapse(names.get(ident, ident), frame)
+                if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                    stack = "%s;[other]" % names.get(ident, ident)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+            blocked = time.time() - self._last_beat
+            if blocked > self.threshold and not stalled and self._loop_thread in frames:
+                stalled = True
+                self.stalls += 1
+                logging.warn("IOLoop blocked for %.3fs at:\n%s", blocked,
+                             ''.join(traceback.format_stack(frames[self._loop_thread])))
+            elif blocked <= self.threshold:
+                stalled = False
+
+            time.sleep(self.interval)
+
+        self.dump()
+
+    def dump(self):
+        """
+        Writes the samples in the collapsed-stack format.
+        """
+        try:
+            with open(self.filename, 'w') as profile_file:
+                for stack, count in sorted(self.stacks.items()):
+                    profile_file.write("%s %d\n" % (stack, count))
+            logging.warn("profiler stopped, %d samples and %d IOLoop stalls written to %s",
+                         self.samples, self.stalls, self.filename)
+        except IOError, e:
+            logging.error("can't write profile: %s", e)
 
     @classmethod
-    def send(cls, text, open_link=None):
+    def collapse(cls, thread_name, frame):
         """
+        Collapses a stack into "thread;file:function;file:function", outermost first.
 
-        :param text: The message
-        :param open_link: The open link
-        :type text: str
-        :type open_link: str
+        :rtype: str
         """
+        functions = []
+        while frame is not None:
+            code = frame.f_code
+            functions.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        functions.append("%s" % thread_name)
+        return ';'.join(reversed(functions))
 
-        if Application.has_valid_slack_config(Application.config()):
-
-            template_file = 'slack.json'
-            try:
-                message = SlackHandler.loader.load(template_file).generate(channel=Application.config('slack.channel'),
-                                                                           username=Application.config('door.name'),
-                                                                           text=text,
-                                                                           open_link=open_link)
-            except AttributeError:
-                SlackHandler.loader = tornado.template.Loader(os.path.join(os.path.dirname(__file__), "templates"),
-                                                              autoescape=None)
-                message = SlackHandler.loader.load(template_file).generate(channel=Application.config('slack.channel'),
-                                                                           username=Application.config('door.name'),
-                                                                           text=text,
-                                                                           open_link=open_link)
-            try:
-                req = urllib2.Request(Application.config('slack.webhook'),
-                                      data=message,
-                                      headers={'Content-Type': 'application/json'})
-                response = urllib2.urlopen(req, timeout=10)
-                logging.info("Slack responded: %s on message '%s'", response.getcode(), text)
-
-            except IOError, e:
-                if hasattr(e, 'code'):  # HTTPError
-                    logging.info("HTTP Error Code: %s" % e.errno)
-                elif hasattr(e, 'reason'):  # URLError
-                    logging.info("can't connect, reason: %s" % e.message)
-                else:
-                    pass
 
-
-class MainHandler(tornado.web.RequestHandler):
+class ConfigWatcher(object):
     """
-        Handles request to /
+    Reloads the configuration when one of its files changes, in addition
+    to the reload on SIGUSR1.
     """
+    FILES = ('doorpi.json', 'local_settings.json', 'apikeys.json')
 
-    def get(self):
-        self.render("index.html", config=Application.config())
+    def __init__(self, interval):
+        """
+        ConfigWatcher initialisation
 
+        :param interval: Seconds between two checks of the files
+        :type interval: float
+        """
+        self._mtimes = ConfigWatcher._stat()
+        self._callback = tornado.ioloop.PeriodicCallback(self._check, interval * 1000)
 
-class SimulationHandler(tornado.web.RequestHandler):
-    """
-        Handles request to /
-    """
+    def start(self):
+        self._callback.start()
 
-    def get(self):
-        self.render("simulation.html", config=Application.config())
+    def _check(self):
+        mtimes = ConfigWatcher._stat()
+        if mtimes != self._mtimes:
+            self._mtimes = mtimes
+            logging.info("configuration changed, reloading")
+            load_setup()
 
+    @classmethod
+    def _stat(cls):
+        return dict((filename, os.path.getmtime(filename) if os.path.isfile(filename) else None)
+                    for filename in ConfigWatcher.FILES)
 
-class DoorSocketHandler(tornado.websocket.WebSocketHandler):
-    waiters = set()
 
-    door = None
-    ring = None
+class EventBus(tornado.tcpserver.TCPServer):
+    """
+    Connects the hardware process with the web worker processes over a Unix
+    socket. The hardware process sends the state and the client messages of
+    its doors to all workers, the workers request rings and opens and get
+    the result back. Messages are JSON objects, one per line.
+    """
+    server = None
+    client = None
+    # seconds to wait for the metrics of a worker
+    COLLECT_TIMEOUT = 1.0
 
-    timeout_thread = None
+    def __init__(self):
+        super(EventBus, self).__init__()
+        self.streams = set()
+        # the last metrics of each worker, and the counts of workers that went away
+        self.collected = {}
+        self.retired = {}
+        self._collecting = {}
+        self._next_id = 0
+
+    def listen_unix(self, path):
+        """
+        Accepts workers at a Unix socket, replacing a stale one.
 
-    def __init__(self, *args, **kwargs):
-        super(DoorSocketHandler, self).__init__(*args, **kwargs)
+        :param path: The socket path
+        :type path: str
+        """
+        self.add_socket(tornado.netutil.bind_unix_socket(path))
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        self.streams.add(stream)
+        for door in DoorRegistry.doors.values():
+            self._write(stream, EventBus.event(door))
+            with door._lock:
+                replay = list(door.replay)
+            for seq, message in replay:
+                self._write(stream, EventBus.event(door, message, seq))
 
-    def get_compression_options(self):
-        # Non-None enables compression with default options.
-        return {}
+        try:
+            while True:
+                line = yield stream.read_until("\n")
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    logging.warn("ignoring malformed event bus request %r", line)
+                    continue
+                if "collected" in request:
+                    future = self._collecting.get(request["collected"])
+                    if future is not None and not future.done():
+                        future.set_result(request["metrics"])
+                    continue
+                # answered when done, a redemption waiting for the disk must not hold up the worker's next request
+                tornado.ioloop.IOLoop.current().spawn_callback(self._reply, stream, request)
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self.streams.discard(stream)
+            # a restarted worker counts from 0 again, the totals must not go down
+            last = self.collected.pop(stream, None)
+            if last is not None:
+                self.retired = Metrics.merge([self.retired, last], gauges=False)
+
+    @tornado.gen.coroutine
+    def collect(self):
+        """
+        Collects the metrics of all workers. Must run on the IOLoop.
 
-    def open(self):
-        logging.info('Client IP: %s connected.' % self.request.remote_ip)
-        DoorSocketHandler.waiters.add(self)
+        :return: A future resolving to the merged snapshot of this process and the workers, see Metrics.snapshot()
+        """
+        pending = []
+        for stream in list(self.streams):
+            self._next_id += 1
+            future = self._collecting[self._next_id] = tornado.concurrent.Future()
+            self._write(stream, {"collect": self._next_id})
+            pending.append((stream, self._next_id, future))
+
+        snapshots = [Metrics.snapshot(), self.retired]
+        for stream, collect_id, future in pending:
+            try:
+                self.collected[stream] = yield tornado.gen.with_timeout(
+                    datetime.timedelta(seconds=EventBus.COLLECT_TIMEOUT), future)
+            except tornado.gen.TimeoutError:
+                logging.warn("no metrics from a web worker within %ss", EventBus.COLLECT_TIMEOUT)
+            finally:
+                self._collecting.pop(collect_id, None)
+            if stream in self.collected:
+                snapshots.append(self.collected[stream])
+        raise tornado.gen.Return(Metrics.merge(snapshots))
+
+    @tornado.gen.coroutine
+    def _reply(self, stream, request):
+        result = yield EventBus.dispatch(request)
+        self._write(stream, {"reply": request["id"], "result": result})
+
+    def publish(self, door, message=None, seq=None):
+        """
+        Sends the state of a door and a message to its clients to all workers.
+        Must run on the IOLoop.
+
+        :param door: The door
+        :param message: The JSON encoded message
+        :param seq: The sequence number of the message
+        :type door: Door
+        :type message: str
+        :type seq: int
+        """
+        event = EventBus.event(door, message, seq)
+        for stream in list(self.streams):
+            self._write(stream, event)
 
-        message = {
-            "action": "update",
-            "last_open": "%s" % Application.config('_door.last.open'),
-            "last_ring": "%s" % Application.config('_door.last.ring'),
-            "timestamp": "%s" % time.time()
-        }
+    def _write(self, stream, event):
+        try:
+            stream.write(json.dumps(event) + "\n")
+        except tornado.iostream.StreamClosedError:
+            self.streams.discard(stream)
 
-        self.write_message(message)
+    @classmethod
+    def event(cls, door, message=None, seq=None):
+        return {"door": door.id, "state": [door.state.last_ring, door.state.last_open],
+                "epoch": door.epoch, "seq": seq, "message": message}
 
-    def on_close(self):
-        logging.info('Client IP: %s disconnected.' % self.request.remote_ip)
-        DoorSocketHandler.waiters.remove(self)
+    @classmethod
+    @tornado.gen.coroutine
+    def dispatch(cls, request):
+        """
+        Runs a request of a worker on the door it names.
 
-    def on_message(self, message):
-        logging.info("got message %s from %s", message, self.request.remote_ip)
-        payload = tornado.escape.json_decode(message)
+        :param request: The request as sent by EventBusClient.request(door_id, command)
+        :type request: dict
+        :return: A future resolving to the result of the request
+        """
+        if request.get("command") == "metrics":
+            snapshot = yield EventBus.server.collect()
+            raise tornado.gen.Return(snapshot)
+
+        door = DoorRegistry.get(request.get("door"))
+        if door is None:
+            raise tornado.gen.Return(False)
+
+        command = request.get("command")
+        if command == "open":
+            raise tornado.gen.Return(door.handle_open(request.get("secret")))
+        if command == "api_open":
+            opened = yield door.handle_api_open(request.get("apikey"))
+            raise tornado.gen.Return(opened)
+        if command == "ring" and SIMULATION:
+            door.ring_pressed()
+            raise tornado.gen.Return(True)
+        raise tornado.gen.Return(False)
+
+
+class EventBusClient(object):
+    """
+    The web worker side of the EventBus. Reconnects to the hardware process
+    until the worker stops, requests fail while it is not connected.
+    """
 
-        payload.update({
-            "timestamp": "%s" % time.time()
-        })
+    def __init__(self, path, timeout=5.0):
+        """
+        EventBusClient initialisation
 
-        if payload['action'] == "open":
-            try:
-                if payload['secret'] == Application.config().pop('_door.open.secret', None):
-                    payload.pop('secret', None)
-                    DoorSocketHandler.send_update(tornado.escape.json_encode(payload))
-                    self.handle_open()
-                else:
-                    logging.info("ignoring OPEN without correct ring secret")
-            except KeyError:
-                logging.info("ignoring OPEN without any secret given")
-        elif payload['action'] == "simulate_ring":
-            if SIMULATION:
-                DoorSocketHandler.handle_ring()
+        :param path: The socket path of the EventBus
+        :param timeout: Seconds to wait for the result of a request
+        :type path: str
+        :type timeout: float
+        """
+        self.path = path
+        self.timeout = timeout
+        self.stream = None
+        self._requests = {}
+        self._next_id = 0
 
-    @classmethod
-    def handle_ring(cls):
+    def start(self):
+        tornado.ioloop.IOLoop.current().spawn_callback(self._run)
+
+    @tornado.gen.coroutine
+    def request(self, door_id, command, **arguments):
         """
-           Handle a ring event by enabling the _Open Door_ button for a given time
+        Sends a request to the hardware process.
+
+        :param door_id: The door
+        :param command: One of "ring", "open", "api_open" or "metrics"
+        :param arguments: The arguments of the command
+        :type door_id: str
+        :type command: str
+        :return: A future resolving to the result, False if the request failed
         """
-        timestamp = time.time()
+        if self.stream is None or self.stream.closed():
+            logging.warn("event bus not connected, dropping %s of %s", command, door_id)
+            raise tornado.gen.Return(False)
 
+        self._next_id += 1
+        request_id = self._next_id
+        future = self._requests[request_id] = tornado.concurrent.Future()
         try:
-            if timestamp - float(Application.config('_door.last.open')) < 1.0:
-                logging.info("RING too close to last open")
-                return
-            else:
-                logging.info("handling RING")
-        except ValueError:
-            pass
-
-        Application.config()['_door.last.ring'] = "%s" % timestamp
-
-        if DoorSocketHandler.timeout_thread is None:
-            # 1st ring: create secret
-            secret = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(2)) + \
-                     "%s" % calendar.timegm(time.gmtime())
-            Application.config()['_door.open.secret'] = secret
+            self.stream.write(json.dumps(dict(arguments, id=request_id, door=door_id, command=command)) + "\n")
+            result = yield tornado.gen.with_timeout(datetime.timedelta(seconds=self.timeout), future)
+        except (tornado.iostream.StreamClosedError, tornado.gen.TimeoutError):
+            logging.warn("event bus request %s of %s failed", command, door_id)
+            result = False
+        finally:
+            self._requests.pop(request_id, None)
+
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def _run(self):
+        while True:
+            try:
+                stream = tornado.iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+                yield stream.connect(self.path)
+                self.stream = stream
+                logging.info("event bus connected")
+                while True:
+                    line = yield stream.read_until("\n")
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        logging.warn("ignoring malformed event bus event %r", line)
+                        continue
+                    self._receive(event)
+            except (tornado.iostream.StreamClosedError, socket.error), e:
+                logging.warn("event bus disconnected: %s", e)
+            finally:
+                self.stream = None
+                for future in self._requests.values():
+                    if not future.done():
+                        future.set_result(False)
+            yield tornado.gen.sleep(1.0)
+
+    def _receive(self, event):
+        if "collect" in event:
+            self.stream.write(json.dumps({"collected": event["collect"], "metrics": Metrics.snapshot()}) + "\n")
+            return
 
-            # Start a thread enabling open button for door.open.timeout seconds
-            DoorSocketHandler.timeout_thread = TimeoutThread(timeout=int(Application.config('door.open.timeout')))
-            DoorSocketHandler.timeout_thread.start()
-        else:
-            while True:
-                # Follow-up ring: reuse existing secret
-                if '_door.open.secret' in Application.config():
-                    secret = Application.config('_door.open.secret')
-                    break
+        if "reply" in event:
+            future = self._requests.get(event["reply"])
+            if future is not None and not future.done():
+                future.set_result(event["result"])
+            return
 
-            # Extend the time if another ring occurs
-            DoorSocketHandler.timeout_thread.extend()
+        door = DoorRegistry.get(event["door"])
+        if door is not None:
+            door.apply(event)
 
-        payload = {
-            "action": "ring",
-            "secret": "%s" % secret,
-            "timestamp": "%s" % timestamp
-        }
-        DoorSocketHandler.send_update(tornado.escape.json_encode(payload))
 
-        if Application.has_valid_slack_config(Application.config()):
-            open_link = "%s/slack/%s" % (Application.config('slack.baseurl'), secret)
-            SlackHandler.send('@here DING DONG ... RING RING ... KNOCK KNOCK', open_link)
-            time.sleep(60)
+class WorkerPool(object):
+    """
+    The web worker processes started by the hardware process. Each worker
+    is a fresh interpreter running doorpi.py --worker, so none of them ever
+    touches the GPIO devices. A worker that dies is restarted.
+    """
+    active = None
 
-    @classmethod
-    def handle_open(cls):
-        """
-           Handle a open event by disabling the _Open Door_ button and flipping the GPIO open pin
+    def __init__(self, count, fds=None):
         """
-        if DoorSocketHandler.timeout_thread is None:
-            logging.info("ignoring OPEN without prior ring")
-            return
+        WorkerPool initialisation
 
-        logging.info("handling OPEN")
+        :param count: Number of web workers
+        :param fds: File descriptors of inherited listening sockets the workers share, if any
+        :type count: int
+        :type fds: list
+        """
+        self.count = count
+        self.fds = fds or []
+        self.processes = {}
+        self.stopping = False
 
-        DoorSocketHandler.timeout_thread.stop()
-        DoorSocketHandler.timeout_thread = None
+    def start(self):
+        for _ in range(self.count):
+            self._spawn()
 
-        # TODO: put the on-sleep-off into a thread to mitigate impact on website delivery
+    def signal(self, signum):
+        """
+        Sends a signal to all workers, e.g. to reload the configuration.
 
-        Application.config()['_door.last.open'] = "%s" % time.time()
-        try:
-            DoorSocketHandler.door.on()
-        except AttributeError, e:
-            if SIMULATION:
+        :param signum: The signal
+        :type signum: int
+        """
+        for pid in self.processes.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError:
                 pass
-            else:
-                logging.fatal(str(e) + " :: DoorSocketHandler.door not initialized.")
 
-        if Application.has_valid_slack_config(Application.config()):
-            SlackHandler.send('DoorPI has opened the door.')
+    def stop(self):
+        self.stopping = True
+        self.signal(signal.SIGTERM)
+
+    def _spawn(self):
+        arguments = [sys.executable, os.path.abspath(__file__), "--worker"]
+        if self.fds:
+            arguments.append("--listen-fds=%s" % ",".join("%d" % fd for fd in self.fds))
+        process = tornado.process.Subprocess(arguments)
+        # Subprocess copies pid from its Popen object in a way pylint doesn't follow
+        pid = process.proc.pid
+        self.processes[pid] = process
+        process.set_exit_callback(lambda code: self._exited(pid, code))
+        logging.info("started web worker %d", pid)
+
+    def _exited(self, pid, code):
+        self.processes.pop(pid, None)
+        if not self.stopping:
+            logging.warn("web worker %d exited with %s, restarting", pid, code)
+            tornado.ioloop.IOLoop.current().call_later(1.0, self._spawn)
+
+
+class Prewarm(object):
+    """
+    Compiles the templates on a background thread, started by main() once
+    the configuration is loaded, while the web interface socket is bound and
+    the static assets are built. Compiling imports nothing, so the thread
+    never waits for the import lock held by the main thread.
+    """
+    thread = None
+    loaders = None
+
+    @classmethod
+    def start(cls):
+        Prewarm.thread = threading.Thread(target=Prewarm.run, name="prewarm")
+        Prewarm.thread.daemon = True
+        Prewarm.thread.start()
 
-        time.sleep(0.5)
+    @classmethod
+    def join(cls):
+        """
+        Waits for the background work, or does it now if it was not started.
 
-        try:
-            DoorSocketHandler.door.off()
-        except AttributeError, e:
-            if SIMULATION:
-                pass
-            else:
-                logging.fatal(str(e))
+        :return: The template loaders, see Application.compile_templates()
+        :rtype: tuple
+        """
+        if Prewarm.thread is not None:
+            Prewarm.thread.join()
+        if Prewarm.loaders is None:
+            Prewarm.run()
+        return Prewarm.loaders
 
     @classmethod
-    def send_update(cls, message):
-        logging.info("sending message to %d waiters", len(cls.waiters))
-        for waiter in cls.waiters:
-            try:
-                waiter.write_message(message)
-            except:
-                logging.error("Error sending message", exc_info=True)
+    def run(cls):
+        Prewarm.loaders = Application.compile_templates()
 
 
-class TimeoutThread(threading.Thread):
-    def __init__(self, timeout=60):
-        """
-        TimeoutThread initialisation
+def import_gpiozero():
+    """
+    Imports the gpiozero devices, switching to SIMULATION mode without them.
+    gpiozero probes for a pin library and is the slowest import of the agent
+    on a Raspberry Pi, it is imported by main() once the socket is bound.
+    """
+    global SIMULATION, Button, DigitalOutputDevice
+    try:
+        from gpiozero import Button, DigitalOutputDevice
+    except ImportError:
+        logging.warn("RUNNING IN SIMULATION MODE")
+        SIMULATION = True
 
-        :param timeout: Timeout in seconds
-        :type timeout: int
-        """
-        threading.Thread.__init__(self)
-        self.timeout = timeout
-        self.finish = int(time.time())+timeout
-        self.wait = True
 
-    def run(self):
-        """
-        Wait for timeout to occur and stop
-        """
-        while self.wait and int(time.time()) < self.finish:
-            time.sleep(1)
-            logging.info("remaining time to open: %s seconds" % (self.finish - int(time.time())))
-        if self.wait:
-            DoorSocketHandler.send_update({"action": "timeout"})
+def activated_fds(arguments):
+    """
+    Returns the file descriptors of the listening sockets passed by systemd
+    socket activation, see sd_listen_fds(3), or by the hardware process to
+    its workers as --listen-fds=3,4.
+
+    :param arguments: The command line arguments
+    :type arguments: list
+    :return: The file descriptors, empty if none were passed
+    :rtype: list
+    """
+    for argument in arguments:
+        if argument.startswith("--listen-fds="):
+            return [int(fd) for fd in argument.split("=", 1)[1].split(",")]
 
-    def extend(self):
-        """
-        Extends the timeout
-        """
-        self.finish += self.timeout
+    if os.environ.get("LISTEN_PID") != "%d" % os.getpid():
+        return []
+    count = int(os.environ.get("LISTEN_FDS", 0))
+    # meant for this process only, not the workers
+    for key in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+        os.environ.pop(key, None)
+    return range(LISTEN_FDS_START, LISTEN_FDS_START + count)
 
-    def stop(self):
-        """
-        Lets the thread stop
-        """
-        self.wait = False
+
+def listen_sockets(port, fds=None, reuse_port=False):
+    """
+    Returns the sockets the web interface is served on: the inherited
+    listening sockets if any, e.g. of systemd socket activation, which
+    queue connections made before the agent is up, otherwise newly bound
+    ones.
+
+    :param port: The port to bind to without inherited sockets
+    :param fds: The file descriptors of inherited sockets
+    :param reuse_port: Sets SO_REUSEPORT on newly bound sockets
+    :type port: int
+    :type fds: list
+    :type reuse_port: bool
+    :rtype: list
+    """
+    if not fds:
+        return tornado.netutil.bind_sockets(port, reuse_port=reuse_port)
+
+    sockets = []
+    for fd in fds:
+        sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        family = sock.getsockopt(socket.SOL_SOCKET, SO_DOMAIN)
+        if family != socket.AF_INET:
+            sock.close()
+            sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        sockets.append(sock)
+    logging.info("serving on inherited sockets %s, ignoring webui.port", fds)
+    return sockets
+
+
+def fsync_directory(filename):
+    """
+    Flushes the directory entry of a file, e.g. after replacing the file by
+    a rename, which is lost on a power cut otherwise.
+
+    :param filename: The file
+    :type filename: str
+    :raises OSError: if the directory can't be flushed
+    """
+    fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def load(filename):
@@ -579,68 +3808,212 @@ def date_time_string(timestamp=None):
     return return_str
 
 
-def load_setup(signum=None, frame=None):
+def load_setup():
     """
-    Reloads configuration on sigusr1 (systemctl reload doorpi-agent.service)
-
-    :param signum: signature parameter
-    :param frame: signature parameter
+    Loads the configuration at startup and reloads it on sigusr1 (systemctl
+    reload doorpi-agent.service). Must run on the IOLoop once it is started,
+    never in the signal handler, as the keystore and the logging take locks
+    the interrupted thread may hold.
     """
-    config = load('doorpi.json')
+    try:
+        config = load('doorpi.json')
+        apikeys = load('apikeys.json')
+    except ValueError, e:
+        if Application.config() is None:
+            raise
+        logging.error("keeping current configuration, %s", e)
+        return
+
     Application.set_config(config)
 
-    apikeys = load('apikeys.json')
-    Application.set_apikeys(apikeys)
+    # api keys are checked and one-time keys redeemed by the hardware process only
+    store = Application.config('apikeys.store')
+    if store and not WORKER:
+        if apikeys:
+            logging.warn("ignoring apikeys.json, api keys are kept in %s", store)
+        if Application._keystore is None or Application._keystore.filename != store:
+            Application.set_keystore(KeyStore(store, Application.config('apikeys.cache.size')))
+        Application._keystore.reset(Application.config('api.window'))
+    else:
+        Application.set_keystore(None)
+        Application.set_apikeys(apikeys)
+
+    if Application._ledger is None and not WORKER:
+        Application.set_ledger(UsedKeyLedger('usedkeys.json'))
+
+    # the first one is set up by the application when it starts
+    if Application.limiter is not None:
+        Application.setup_limiter()
+
+    if WorkerPool.active is not None:
+        WorkerPool.active.signal(signal.SIGUSR1)
 
 
 def handle_sigterm(signum=None, frame=None):
     """
-    Saves current state on sigterm (systemctl stop doorpi-agent.service)
-    end exists.
+    Shuts down on sigterm (systemctl stop doorpi-agent.service), the state
+    is saved by shutdown() on the IOLoop.
 
     :param signum: signature parameter
     :param frame: signature parameter
     """
-    with open('doorpi_state.json', 'w') as settings_file:
-        json.dump({
-            "_door.last.open": "%s" % Application.config('_door.last.open'),
-            "_door.last.ring": "%s" % Application.config('_door.last.ring')
-        }, settings_file)
-    tornado.ioloop.IOLoop.current().stop()
+    tornado.ioloop.IOLoop.current().add_callback_from_signal(shutdown)
+
+
+@tornado.gen.coroutine
+def shutdown():
+    """
+    Announces the stop on Slack and stops the IOLoop once pending Slack
+    messages are delivered or slack.timeout has passed, saving the state
+    right before.
+    """
+    if WORKER:
+        tornado.ioloop.IOLoop.current().stop()
+        return
+
+    if WorkerPool.active is not None:
+        WorkerPool.active.stop()
+
     SlackHandler.send('DoorPI stopped.')
-    sys.exit(0)
+    yield tornado.gen.moment
+
+    if SlackHandler.notifier is not None:
+        try:
+            yield SlackHandler.notifier.join(timeout=Application.config('slack.timeout'))
+        except tornado.gen.TimeoutError:
+            logging.warn("dropping pending Slack messages on shutdown")
+
+    StatePersister.flush()
+    tornado.ioloop.IOLoop.current().stop()
+
+
+def toggle_profiler(signum=None, frame=None):
+    """
+    Starts or stops the profiler on sigusr2 (kill -USR2 <pid>)
+
+    :param signum: signature parameter
+    :param frame: signature parameter
+    """
+    io_loop = tornado.ioloop.IOLoop.current()
+    if Profiler.active is None:
+        Profiler.active = Profiler(io_loop,
+                                   interval=Application.config('profile.interval'),
+                                   threshold=Application.config('profile.threshold'),
+                                   filename=Application.config('profile.file'),
+                                   max_stacks=Application.config('profile.stacks'))
+        io_loop.add_callback_from_signal(Profiler.active.start)
+    else:
+        io_loop.add_callback_from_signal(Profiler.active.stop)
+        Profiler.active = None
+
+
+def manage_keys(arguments):
+    """
+    Adds, revokes and imports api keys of the keystore set as apikeys.store
+    while the agent keeps running:
+
+        python doorpi.py keys add {apikey} '{"type": "once", "owner": ..., ...}'
+        python doorpi.py keys revoke {apikey}
+        python doorpi.py keys import apikeys.json
+
+    :param arguments: The command line arguments following "keys"
+    :type arguments: list
+    :return: The exit status
+    :rtype: int
+    """
+    Application.set_config(load('doorpi.json'))
+    store = Application.config('apikeys.store')
+    if not store:
+        sys.stderr.write("apikeys.store is not set\n")
+        return 1
+    keystore = KeyStore(store, default_window=Application.config('api.window'))
+
+    command = arguments[0] if arguments else None
+    try:
+        if command == "add" and len(arguments) == 3:
+            keystore.add(arguments[1], json.loads(arguments[2]))
+        elif command == "revoke" and len(arguments) == 2:
+            if not keystore.revoke(arguments[1]):
+                sys.stderr.write("unknown api key\n")
+                return 1
+        elif command == "import" and len(arguments) == 2:
+            apikeys = load(arguments[1])
+            keystore.add_all(apikeys)
+            sys.stdout.write("imported %d api keys\n" % len(apikeys))
+        else:
+            sys.stderr.write(manage_keys.__doc__.split("\n\n")[1] + "\n")
+            return 2
+    except ValueError, e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+    return 0
 
 
 def main():
     """
-    Main entry point
+    Main entry point. With webui.workers set the process owns the hardware
+    and starts the web workers, which run main() with --worker.
     """
+    if sys.argv[1:2] == ["keys"]:
+        sys.exit(manage_keys(sys.argv[2:]))
+
+    global WORKER
+    WORKER = "--worker" in sys.argv[1:]
+
     logging.basicConfig(level=logging.INFO)
 
-    signal.signal(signal.SIGUSR1, load_setup)
+    io_loop = tornado.ioloop.IOLoop.current()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: io_loop.add_callback_from_signal(load_setup))
     signal.signal(signal.SIGTERM, handle_sigterm)
+    signal.signal(signal.SIGUSR2, toggle_profiler)
 
     load_setup()
+    Prewarm.start()
+    LogPipeline.setup(log_format=Application.config('log.format'),
+                      size=Application.config('log.queue.size'),
+                      rate=Application.config('log.rate'),
+                      burst=Application.config('log.burst'))
+
+    if Application.config('config.watch.interval') > 0:
+        ConfigWatcher(Application.config('config.watch.interval')).start()
+
+    if WORKER:
+        EventBus.client = EventBusClient(Application.config('ipc.socket'))
+        EventBus.client.start()
+
+    # listening before the application is set up, connections wait in the backlog instead of being refused
+    fds = activated_fds(sys.argv[1:])
+    sockets = None
+    if WORKER or Application.config('webui.workers') <= 0:
+        sockets = listen_sockets(Application.config('webui.port'), fds, reuse_port=WORKER)
+
+    import_gpiozero()
+    app = Application()
 
-    try:
-        with open('doorpi_state.json', 'r') as settings_file:
-            state = json.load(settings_file)
-            Application.config()['_door.last.open'] = state['_door.last.open']
-            Application.config()['_door.last.ring'] = state['_door.last.ring']
-    except IOError:
-        pass
+    if sockets is not None:
+        # behind a reverse proxy every client would share the rate limits of the proxy's address
+        server = tornado.httpserver.HTTPServer(app, xheaders=Application.config('webui.xheaders') > 0)
+        server.add_sockets(sockets)
 
-    app = Application()
+    if not WORKER:
+        StatePersister.restore(Application.config('state.file'))
 
-    app.listen(int(Application.config('webui.port')))
+        if Application.config('webui.workers') > 0:
+            EventBus.server = EventBus()
+            EventBus.server.listen_unix(Application.config('ipc.socket'))
+            WorkerPool.active = WorkerPool(Application.config('webui.workers'), fds)
+            WorkerPool.active.start()
 
-    if Application.has_valid_slack_config(Application.config()):
-        SlackHandler.send('DoorPI started at %s' % Application.config('slack.baseurl'))
+        if Application.has_valid_slack_config():
+            SlackHandler.send('DoorPI started at %s' % Application.config('slack.baseurl'))
 
     try:
         tornado.ioloop.IOLoop.current().start()
     except KeyboardInterrupt:
-        SlackHandler.send('DoorPI stopped.')
+        tornado.ioloop.IOLoop.current().add_callback(shutdown)
+        tornado.ioloop.IOLoop.current().start()
+
+    LogPipeline.stop()
 
 
 if __name__ == "__main__":
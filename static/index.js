@@ -23,74 +23,111 @@ function notifyRing(date) {
     }
 }
 
+function socketPath() {
+    "use strict";
+    return $('meta[name="doorpi-socket"]').attr('content') || "/door";
+}
+
 var updater = {
     socket: null,
+    secret: null,
+    epoch: null,
+    seq: 0,
+    attempts: 0,
 
-    start: function () {
+    url: function () {
         "use strict";
-        var url = "wss://" + location.host + "/door";
-        if (location.protocol !== 'https:') {
-            url = "ws://" + location.host + "/door";
+        var scheme = location.protocol === 'https:' ? "wss://" : "ws://",
+            url = scheme + location.host + socketPath();
+        if (updater.epoch !== null) {
+            url += "?epoch=" + encodeURIComponent(updater.epoch) + "&seq=" + updater.seq;
         }
-        updater.secret = null;
-        updater.socket = new WebSocket(url);
+        return url;
+    },
+
+    // Waits between 50% and 100% of an exponentially growing delay,
+    // so clients cut off together do not reconnect together.
+    backoff: function () {
+        "use strict";
+        var delay = Math.min(30000, 1000 * Math.pow(2, updater.attempts));
+        updater.attempts += 1;
+        return delay / 2 + Math.random() * delay / 2;
+    },
+
+    start: function () {
+        "use strict";
+        updater.socket = new WebSocket(updater.url());
         updater.socket.onmessage = function (event) {
             console.log(event.data);
-            var action = JSON.parse(event.data).action,
-                pretty = prettyDate(JSON.parse(event.data).timestamp);
-            if (action === "ring") {
-                updater.secret = JSON.parse(event.data).secret;
-                $('#open').removeAttr("disabled");
-                if (audioReady === true) {
-                    audioElement.play().catch(function (error) {
-                        console.log("INFO: play() failed because the user didn't interact " +
-                                    "with the document first. https://goo.gl/xX8pDD");
-                        console.log(error);
-                    });
-                }
-                notifyRing(pretty);
-                $('#last_ring').html(pretty);
-            }
-            if (action === "open") {
-                $('#open').prop("disabled", true);
-                $('#last_open').html(pretty);
-            }
-            if (action === "update") {
-                if (JSON.parse(event.data).last_open.length > 0) {
-                    $('#last_open').html(prettyDate(JSON.parse(event.data).last_open));
-                }
-                if (JSON.parse(event.data).last_ring.length > 0) {
-                    $('#last_ring').html(prettyDate(JSON.parse(event.data).last_ring));
-                }
-            }
-            if (action === 'timeout') {
-                $('#open').prop("disabled", true);
+            var message = JSON.parse(event.data);
+            if (message.action === "replay") {
+                message.events.forEach(function (missed) {
+                    updater.handle(missed, false);
+                });
+            } else {
+                updater.handle(message, true);
             }
         };
         updater.socket.onopen = function () {
             console.log("WS Connected");
+            updater.attempts = 0;
             $("#alert").hide();
         };
-        // Reconnect function
         updater.socket.onclose = function () {
             console.log("WS Disconnected");
             $("#alert").html("Lost connection to DoorPI, trying to reconnect.");
             $("#alert").show();
-            setTimeout(function () {
-                var om = updater.socket.onmessage,
-                    oo = updater.socket.onopen,
-                    oc = updater.socket.onclose,
-                    wu = "wss://" + location.host + "/door";
-                if (location.protocol !== 'https:') {
-                    wu = "ws://" + location.host + "/door";
-                }
-                updater.socket = new WebSocket(wu);
-                updater.socket.onmessage = om;
-                updater.socket.onopen = oo;
-                updater.socket.onclose = oc;
-            }, 1000);
+            setTimeout(updater.start, updater.backoff());
         };
     },
+
+    handle: function (message, live) {
+        "use strict";
+        var pretty;
+        if (message.action === "update") {
+            if (message.epoch !== updater.epoch) {
+                updater.epoch = message.epoch;
+                updater.seq = message.seq;
+            }
+            if (message.last_open.length > 0) {
+                $('#last_open').html(prettyDate(message.last_open));
+            }
+            if (message.last_ring.length > 0) {
+                $('#last_ring').html(prettyDate(message.last_ring));
+            }
+            return;
+        }
+        // a message can arrive live and again in a replay
+        if (message.seq <= updater.seq) {
+            return;
+        }
+        updater.seq = message.seq;
+        pretty = prettyDate(message.timestamp);
+        if (message.action === "ring") {
+            updater.secret = message.secret;
+            $('#open').removeAttr("disabled");
+            if (live && audioReady === true) {
+                audioElement.play().catch(function (error) {
+                    console.log("INFO: play() failed because the user didn't interact " +
+                                "with the document first. https://goo.gl/xX8pDD");
+                    console.log(error);
+                });
+            }
+            notifyRing(pretty);
+            $('#last_ring').html(pretty);
+        }
+        // sent after a burst of presses, the first one of them rang
+        if (message.action === "presses") {
+            $('#last_ring').html(pretty + " (pressed " + message.presses + " times)");
+        }
+        if (message.action === "open") {
+            $('#open').prop("disabled", true);
+            $('#last_open').html(pretty);
+        }
+        if (message.action === 'timeout') {
+            $('#open').prop("disabled", true);
+        }
+    },
 };
 
 function send(message) {
@@ -121,7 +158,7 @@ $(document).ready(function () {
     }, 1000);
 
     audioElement = document.createElement('audio');
-    audioElement.setAttribute('src', '//' + location.host + '/static/ding-dong.mp3');
+    audioElement.setAttribute('src', $('meta[name="doorpi-ring-sound"]').attr('content') || '/static/ding-dong.mp3');
     audioElement.addEventListener("canplay", function () {
         audioReady = true;
     });
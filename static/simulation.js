@@ -1,39 +1,36 @@
 /*jslint browser: true*/
 /*global $, WebSocket, Notification*/
 
+function socketPath() {
+    "use strict";
+    return $('meta[name="doorpi-socket"]').attr('content') || "/door";
+}
+
 var updater = {
     socket: null,
+    attempts: 0,
+
+    backoff: function () {
+        "use strict";
+        var delay = Math.min(30000, 1000 * Math.pow(2, updater.attempts));
+        updater.attempts += 1;
+        return delay / 2 + Math.random() * delay / 2;
+    },
 
     start: function () {
         "use strict";
-        var url = "wss://" + location.host + "/door";
-        if (location.protocol !== 'https:') {
-            url = "ws://" + location.host + "/door";
-        }
-        updater.secret = null;
-        updater.socket = new WebSocket(url);
+        var scheme = location.protocol === 'https:' ? "wss://" : "ws://";
+        updater.socket = new WebSocket(scheme + location.host + socketPath());
         updater.socket.onopen = function () {
             console.log("WS Connected");
+            updater.attempts = 0;
             $("#alert").hide();
         };
-        // Reconnect function
         updater.socket.onclose = function () {
             console.log("WS Disconnected");
             $("#alert").html("Lost connection to DoorPI, trying to reconnect.");
             $("#alert").show();
-            setTimeout(function () {
-                var om = updater.socket.onmessage,
-                    oo = updater.socket.onopen,
-                    oc = updater.socket.onclose,
-                    wu = "wss://" + location.host + "/door";
-                if (location.protocol !== 'https:') {
-                    wu = "ws://" + location.host + "/door";
-                }
-                updater.socket = new WebSocket(wu);
-                updater.socket.onmessage = om;
-                updater.socket.onopen = oo;
-                updater.socket.onclose = oc;
-            }, 1000);
+            setTimeout(updater.start, updater.backoff());
         };
     },
 };
@@ -0,0 +1,19 @@
+#!/usr/bin/env bash
+
+# How fast is it? Fails if a p95 value is more than three times the one in benchmarks/baseline.json, scaled to this host
+python benchmarks/suite.py --clients 50 --output benchmark.json --baseline benchmarks/baseline.json --tolerance 2.0 || exit 1
+
+# Are rings debounced and coalesced? Fails if the mock button presses yield unexpected rings
+python benchmarks/ring_input.py --presses 200 || exit 1
+
+# Do timeouts, time windows and guards hold over days of virtual time?
+python benchmarks/replay.py || exit 1
+
+# Are cached api keys served from memory? Do used one-time keys stay used when moved into or out of the keystore, or after a torn journal entry?
+python benchmarks/keystore.py --keys 1000 --number 1000 || exit 1
+
+# Does the Slack queue keep the IOLoop free, retry with backoff and drop only what doesn't fit?
+python benchmarks/slack_notifier.py --messages 500 --failure-rate 0.2 --max-lag 0.25 || exit 1
+
+# Do time windows of api keys, also those wrapping around the week or midnight, allow what they say?
+python benchmarks/apikey_policy.py --number 10000 || exit 1